@@ -1,4 +1,7 @@
-﻿from .nodes.s3_upload_node import S3UploadNode
+﻿from .nodes.routes import register_routes
+from .nodes.s3_upload_node import S3UploadNode
+
+register_routes()
 
 NODE_CLASS_MAPPINGS = {
     "S3UploadNode": S3UploadNode,
@@ -0,0 +1,329 @@
+﻿"""In-process fake S3 endpoint with latency and fault injection.
+
+It speaks just enough of the S3 REST API (path-style PUT, HEAD, GET and
+multipart uploads) for the upload paths in this package. Object bodies
+are discarded unless `keep_bodies` is set, so long runs stay small.
+"""
+
+import random
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+@dataclass
+class FaultProfile:
+    """What the fake does to each request; change fields at any time.
+
+    `partition_rps` is a crude model of S3 key-range partitions: keys
+    that share their first `partition_chars` characters share one budget
+    of requests per second, and requests over it get 503 SlowDown.
+    Unlike S3, hot partitions are never split.
+    """
+
+    latency_seconds: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    hang_rate: float = 0.0
+    hang_seconds: float = 30.0
+    partition_rps: float = 0.0
+    partition_chars: int = 16
+    seed: int | None = None
+    _random: random.Random = field(default_factory=random.Random)
+
+    def __post_init__(self) -> None:
+        if self.seed is not None:
+            self._random.seed(self.seed)
+
+    def pick(self) -> str:
+        """Return "hang", "throttle", "error" or "ok" for one request."""
+        roll = self._random.random()
+        for outcome, rate in (
+            ("hang", self.hang_rate),
+            ("throttle", self.throttle_rate),
+            ("error", self.error_rate),
+        ):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return "ok"
+
+
+@dataclass
+class FakeStats:
+    """Request counters kept by the fake."""
+
+    requests: int = 0
+    objects: int = 0
+    bytes_received: int = 0
+    errors: int = 0
+    throttles: int = 0
+    hangs: int = 0
+
+
+class FakeS3Server:
+    """Threaded HTTP server that stands in for one S3 endpoint."""
+
+    def __init__(
+        self,
+        faults: FaultProfile | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        keep_bodies: bool = False,
+    ) -> None:
+        self.faults = faults or FaultProfile()
+        self.keep_bodies = keep_bodies
+        self.stats = FakeStats()
+        self.objects: dict[str, bytes | int] = {}
+        self._uploads: dict[str, dict[int, int]] = {}
+        self._partitions: dict[tuple[str, str], tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._httpd.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def endpoint(self) -> str:
+        """Return the http:// URL to pass as the S3 endpoint."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeS3Server":
+        """Serve requests on a daemon thread."""
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever,
+            name="fake-s3",
+            daemon=True,
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "FakeS3Server":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def count(self, name: str, amount: int = 1) -> None:
+        """Bump one of the FakeStats counters."""
+        with self._lock:
+            setattr(self.stats, name, getattr(self.stats, name) + amount)
+
+    def admit(self, bucket: str, key: str) -> bool:
+        """Take a token from the key's partition; False when throttled."""
+        rate = self.faults.partition_rps
+        if not rate:
+            return True
+        partition = (bucket, key[: self.faults.partition_chars])
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._partitions.get(partition, (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            admitted = tokens >= 1.0
+            self._partitions[partition] = (
+                tokens - 1.0 if admitted else tokens,
+                now,
+            )
+        return admitted
+
+    def store_object(self, key: str, body: bytes) -> None:
+        """Record a completed object."""
+        with self._lock:
+            self.objects[key] = body if self.keep_bodies else len(body)
+            self.stats.objects += 1
+
+    def start_upload(self) -> str:
+        """Open a multipart upload and return its id."""
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self._uploads[upload_id] = {}
+        return upload_id
+
+    def add_part(self, upload_id: str, number: int, size: int) -> bool:
+        """Record one part; False if the upload does not exist."""
+        with self._lock:
+            parts = self._uploads.get(upload_id)
+            if parts is None:
+                return False
+            parts[number] = size
+            return True
+
+    def finish_upload(self, upload_id: str, key: str) -> bool:
+        """Complete a multipart upload; False if it does not exist."""
+        with self._lock:
+            parts = self._uploads.pop(upload_id, None)
+            if parts is None:
+                return False
+            self.objects[key] = sum(parts.values())
+            self.stats.objects += 1
+            return True
+
+    def abort_upload(self, upload_id: str) -> None:
+        """Forget a multipart upload."""
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+
+
+def _handler_for(server: FakeS3Server) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args) -> None:
+            pass
+
+        def do_PUT(self) -> None:
+            body = self._body()
+            if self._inject():
+                return
+            key, query = self._target()
+            if "partNumber" in query:
+                number = int(query["partNumber"][0])
+                upload_id = query["uploadId"][0]
+                if not server.add_part(upload_id, number, len(body)):
+                    self._error(404, "NoSuchUpload")
+                    return
+            else:
+                server.store_object(key, body)
+            self._reply(200, headers={"ETag": f'"{uuid.uuid4().hex}"'})
+
+        def do_POST(self) -> None:
+            self._body()
+            if self._inject():
+                return
+            key, query = self._target()
+            if "uploads" in query:
+                upload_id = server.start_upload()
+                self._xml(
+                    "<InitiateMultipartUploadResult>"
+                    f"<Key>{key}</Key><UploadId>{upload_id}</UploadId>"
+                    "</InitiateMultipartUploadResult>"
+                )
+            elif "uploadId" in query:
+                if not server.finish_upload(query["uploadId"][0], key):
+                    self._error(404, "NoSuchUpload")
+                    return
+                self._xml(
+                    "<CompleteMultipartUploadResult>"
+                    f"<Key>{key}</Key><ETag>\"{uuid.uuid4().hex}\"</ETag>"
+                    "</CompleteMultipartUploadResult>"
+                )
+            else:
+                self._error(400, "InvalidRequest")
+
+        def do_DELETE(self) -> None:
+            self._body()
+            key, query = self._target()
+            if "uploadId" in query:
+                server.abort_upload(query["uploadId"][0])
+            self._reply(204)
+
+        def do_HEAD(self) -> None:
+            if self._inject():
+                return
+            key, _ = self._target()
+            if key not in server.objects:
+                self._reply(404)
+                return
+            self._reply(200)
+
+        def do_GET(self) -> None:
+            if self._inject():
+                return
+            key, _ = self._target()
+            stored = server.objects.get(key)
+            if not isinstance(stored, bytes):
+                self._error(404, "NoSuchKey")
+                return
+            self._reply(200, stored, "application/octet-stream")
+
+        def _target(self) -> tuple[str, dict]:
+            parts = urlsplit(self.path)
+            # Path style: /bucket/key
+            key = parts.path.lstrip("/").partition("/")[2]
+            return key, parse_qs(parts.query, keep_blank_values=True)
+
+        def _body(self) -> bytes:
+            server.count("requests")
+            if "chunked" in self.headers.get("Transfer-Encoding", ""):
+                return self._read_chunked()
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+            server.count("bytes_received", len(body))
+            return body
+
+        def _read_chunked(self) -> bytes:
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    # Skip trailers up to the blank line.
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            body = b"".join(chunks)
+            server.count("bytes_received", len(body))
+            return body
+
+        def _inject(self) -> bool:
+            if self.command in ("HEAD", "GET"):
+                server.count("requests")
+            faults = server.faults
+            if faults.latency_seconds:
+                time.sleep(faults.latency_seconds)
+            outcome = faults.pick()
+            path = urlsplit(self.path).path.lstrip("/")
+            bucket, _, key = path.partition("/")
+            if outcome == "ok" and not server.admit(bucket, key):
+                outcome = "throttle"
+            if outcome == "ok":
+                return False
+            if outcome == "hang":
+                server.count("hangs")
+                time.sleep(faults.hang_seconds)
+                self._error(500, "InternalError")
+            elif outcome == "throttle":
+                server.count("throttles")
+                self._error(503, "SlowDown")
+            else:
+                server.count("errors")
+                self._error(500, "InternalError")
+            return True
+
+        def _error(self, status: int, code: str) -> None:
+            self._xml(
+                f"<Error><Code>{code}</Code><Message>{code}</Message></Error>",
+                status,
+            )
+
+        def _xml(self, text: str, status: int = 200) -> None:
+            body = ('<?xml version="1.0" encoding="UTF-8"?>' + text).encode()
+            self._reply(status, body, "application/xml")
+
+        def _reply(
+            self,
+            status: int,
+            body: bytes = b"",
+            content_type: str = "",
+            headers: dict | None = None,
+        ) -> None:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            if content_type:
+                self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body and self.command != "HEAD":
+                self.wfile.write(body)
+
+    return Handler
@@ -0,0 +1,417 @@
+﻿"""Load-test the upload, spool and retry paths against a fake S3.
+
+Run from the directory that contains this package, for example::
+
+    python -m s3up.benchmarks.load_test store --batch 1 4 --format png webp
+    python -m s3up.benchmarks.load_test spool --images 500
+    python -m s3up.benchmarks.load_test drain --jobs 500 --concurrency 1 8
+    python -m s3up.benchmarks.load_test all --latency-ms 20 --throttle-rate .05
+    python -m s3up.benchmarks.load_test keys --partition-rps 50 --images 400
+    python -m s3up.benchmarks.load_test wakeup --jobs 200 --interval 30
+    python -m s3up.benchmarks.load_test probe --jobs 50
+"""
+
+import argparse
+import itertools
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+
+import numpy as np
+
+from ..domain.config import S3Config
+from ..domain.object_key_strategy import ObjectKeyStrategy
+from ..infrastructure.circuit_breaker import get_circuit_breaker
+from ..infrastructure.retry_targets import get_target_registry
+from ..infrastructure.retry_worker import RetryWorker
+from ..infrastructure.s3_client import S3ClientAdapter
+from ..infrastructure.spool_repository import SpoolRepository
+from ..infrastructure.upload_orchestrator import UploadOrchestrator
+from ..nodes.s3_upload_node import S3UploadNode
+from .fake_s3 import FakeS3Server, FaultProfile
+
+_bucket_ids = itertools.count()
+
+
+def base_overrides(server: FakeS3Server, spool_dir: Path) -> dict:
+    """Node inputs pointing at the fake, with a fresh bucket name.
+
+    Each scenario gets its own bucket so circuit breakers opened by one
+    scenario do not leak into the next.
+    """
+    return {
+        "endpoint": server.endpoint,
+        "bucket": f"bench-{next(_bucket_ids)}",
+        "access_key_id": "bench",
+        "secret_access_key": "bench",
+        "use_ssl": False,
+        "force_path_style": True,
+        "spool_dir": str(spool_dir),
+    }
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def make_batch(batch: int, size: int) -> np.ndarray:
+    """Random 0-1 float images, the worst case for compression."""
+    rng = np.random.default_rng(0)
+    return rng.random((batch, size, size, 3), dtype=np.float32)
+
+
+def bench_store(server: FakeS3Server, args: argparse.Namespace) -> None:
+    """Time S3UploadNode.store across batch, format and concurrency."""
+    print("store: batch format conc | img/s   p50 ms   p99 ms  spooled")
+    node = S3UploadNode()
+    for batch, image_format, concurrency in itertools.product(
+        args.batch, args.format, args.concurrency
+    ):
+        images = make_batch(batch, args.size)
+        with tempfile.TemporaryDirectory() as spool_dir:
+            overrides = base_overrides(server, Path(spool_dir))
+            overrides.update(
+                image_format=image_format,
+                upload_concurrency=concurrency,
+                encode_workers=args.encode_workers,
+            )
+            latencies = []
+            for _ in range(args.rounds):
+                started = time.perf_counter()
+                node.store(images, **overrides)
+                latencies.append(time.perf_counter() - started)
+            repository = SpoolRepository.from_config(
+                S3Config.from_sources(node._base_dir, overrides)
+            )
+            spooled = repository.count_jobs()
+        rate = batch * args.rounds / sum(latencies)
+        print(
+            f"  {batch:>10} {image_format:>6} {concurrency:>4} |"
+            f" {rate:6.1f} {percentile(latencies, 0.5) * 1000:8.1f}"
+            f" {percentile(latencies, 0.99) * 1000:8.1f} {spooled:8d}"
+        )
+
+
+def bench_spool(server: FakeS3Server, args: argparse.Namespace) -> None:
+    """Measure how fast images can be written to the spool."""
+    print("spool: layout threads | img/s     MB/s")
+    payload = np.random.default_rng(0).bytes(args.payload_kb * 1024)
+    for layout, threads in itertools.product(args.layout, args.concurrency):
+        with tempfile.TemporaryDirectory() as spool_dir:
+            overrides = base_overrides(server, Path(spool_dir))
+            overrides["spool_layout"] = layout
+            orchestrator = _orchestrator(overrides)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                for _ in range(args.images):
+                    executor.submit(
+                        orchestrator.defer,
+                        payload,
+                        orchestrator.key_strategy.build_key("png"),
+                        "png",
+                        "image/png",
+                    )
+            elapsed = time.perf_counter() - started
+        rate = args.images / elapsed
+        megabytes = rate * len(payload) / (1024 * 1024)
+        print(f"  {layout:>12} {threads:>7} | {rate:7.1f} {megabytes:8.1f}")
+
+
+def bench_drain(server: FakeS3Server, args: argparse.Namespace) -> None:
+    """Time how long the retry worker takes to empty a spool backlog."""
+    print("drain: jobs conc | seconds    jobs/s  dead")
+    payload = np.random.default_rng(0).bytes(args.payload_kb * 1024)
+    for concurrency in args.concurrency:
+        with tempfile.TemporaryDirectory() as spool_dir:
+            overrides = base_overrides(server, Path(spool_dir))
+            overrides.update(
+                retry_concurrency=concurrency,
+                retry_interval_seconds=1,
+                retry_backoff_seconds=1,
+            )
+            orchestrator = _orchestrator(overrides)
+            for _ in range(args.jobs):
+                orchestrator.defer(
+                    payload,
+                    orchestrator.key_strategy.build_key("png"),
+                    "png",
+                    "image/png",
+                )
+            repository = orchestrator.spool_repository
+            get_target_registry().register(orchestrator.config)
+            worker = RetryWorker(
+                config=orchestrator.config,
+                spool_repository=repository,
+            )
+            started = time.perf_counter()
+            worker.start()
+            deadline = started + args.timeout
+            while time.perf_counter() < deadline:
+                dead = repository.count_dead_jobs()
+                if repository.count_jobs() == dead:
+                    break
+                time.sleep(0.05)
+            elapsed = time.perf_counter() - started
+            worker.stop()
+            dead = repository.count_dead_jobs()
+            drained = args.jobs - repository.count_jobs()
+        print(
+            f"  {args.jobs:>9} {concurrency:>4} | {elapsed:7.2f}"
+            f" {drained / elapsed:9.1f} {dead:5d}"
+        )
+
+
+def bench_keys(server: FakeS3Server, args: argparse.Namespace) -> None:
+    """Compare key layouts when the fake throttles per key partition."""
+    print("keys: layout  conc | img/s  throttles  spooled  partitions")
+    payload = np.random.default_rng(0).bytes(args.payload_kb * 1024)
+    layouts = itertools.product(args.shards, args.concurrency)
+    for layout, concurrency in layouts:
+        depth, _, width = layout.partition("x")
+        with tempfile.TemporaryDirectory() as spool_dir:
+            overrides = base_overrides(server, Path(spool_dir))
+            overrides["upload_concurrency"] = concurrency
+            orchestrator = _orchestrator(overrides)
+            orchestrator = replace(
+                orchestrator,
+                key_strategy=ObjectKeyStrategy(
+                    prefix="bench",
+                    use_timestamp_prefix=True,
+                    shard_depth=int(depth),
+                    shard_width=int(width or 1),
+                ),
+            )
+            throttles = server.stats.throttles
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                keys = list(
+                    executor.map(
+                        lambda _: orchestrator.upload_or_spool(
+                            payload, "png", "image/png"
+                        ),
+                        range(args.images),
+                    )
+                )
+            elapsed = time.perf_counter() - started
+            spooled = orchestrator.spool_repository.count_jobs()
+        partitions = {key[: server.faults.partition_chars] for key in keys}
+        print(
+            f"  {layout:>11} {concurrency:>4} | {args.images / elapsed:5.1f}"
+            f" {server.stats.throttles - throttles:10d} {spooled:8d}"
+            f" {len(partitions):11d}"
+        )
+
+
+def bench_wakeup(server: FakeS3Server, args: argparse.Namespace) -> None:
+    """Time how fast the retry worker reacts to new and recovered jobs.
+
+    Retry interval and backoff are both `--interval` seconds, which is
+    how late a polling worker could be.
+    """
+    print("wakeup: jobs | spooled->sent ms  recovery ms  idle cpu ms/s")
+    payload = np.random.default_rng(0).bytes(args.payload_kb * 1024)
+    with tempfile.TemporaryDirectory() as spool_dir:
+        overrides = base_overrides(server, Path(spool_dir))
+        overrides.update(
+            retry_interval_seconds=args.interval,
+            retry_backoff_seconds=args.interval,
+            retry_backoff_max_seconds=args.interval,
+            # Keep the hot path trying, so its success can end the outage.
+            breaker_failure_threshold=args.jobs + 1,
+        )
+        orchestrator = _orchestrator(overrides)
+        repository = orchestrator.spool_repository
+        get_target_registry().register(orchestrator.config)
+        worker = RetryWorker(
+            config=orchestrator.config, spool_repository=repository
+        )
+        worker.start()
+        latencies = []
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            orchestrator.defer(
+                payload,
+                orchestrator.key_strategy.build_key("png"),
+                "png",
+                "image/png",
+            )
+            _wait_until_empty(repository, args.timeout)
+            latencies.append(time.perf_counter() - started)
+        # An outage: every job fails once and backs off for `interval`.
+        breaker = get_circuit_breaker(orchestrator.config)
+        for _ in range(args.jobs):
+            breaker.record_failure()
+            orchestrator._spool(
+                payload,
+                orchestrator.key_strategy.build_key("png"),
+                "png",
+                "image/png",
+                None,
+                "bench outage",
+            )
+        started = time.perf_counter()
+        orchestrator.upload_or_spool(payload, "png", "image/png")
+        _wait_until_empty(repository, args.timeout)
+        recovery = time.perf_counter() - started
+        time.sleep(0.5)
+        cpu_started = time.process_time()
+        time.sleep(args.idle_seconds)
+        idle_cpu = time.process_time() - cpu_started
+        worker.stop()
+    print(
+        f"  {args.jobs:>10} | {statistics.median(latencies) * 1000:16.1f}"
+        f" {recovery * 1000:12.1f}"
+        f" {idle_cpu * 1000 / args.idle_seconds:14.2f}"
+    )
+
+
+def bench_probe(server: FakeS3Server, args: argparse.Namespace) -> None:
+    """Check that a half-open breaker recovers when a lease is lost.
+
+    The first lease the worker asks for fails, as if the drain CLI had
+    taken the job in between; the breaker's probe must still go to the
+    next job instead of staying claimed.
+    """
+    print("probe: jobs | recovery ms  breaker")
+    payload = np.random.default_rng(0).bytes(args.payload_kb * 1024)
+    with tempfile.TemporaryDirectory() as spool_dir:
+        overrides = base_overrides(server, Path(spool_dir))
+        overrides.update(
+            retry_interval_seconds=args.interval,
+            breaker_failure_threshold=1,
+            breaker_reset_seconds=1,
+        )
+        orchestrator = _orchestrator(overrides)
+        repository = orchestrator.spool_repository
+        get_target_registry().register(orchestrator.config)
+        for _ in range(args.jobs):
+            orchestrator._spool(
+                payload,
+                orchestrator.key_strategy.build_key("png"),
+                "png",
+                "image/png",
+                None,
+                "bench outage",
+            )
+        breaker = get_circuit_breaker(orchestrator.config)
+        breaker.record_failure()
+        worker = RetryWorker(
+            config=orchestrator.config, spool_repository=repository
+        )
+        lost = []
+        lease_job = worker.lease_job
+
+        def lose_first_lease(job):
+            if not lost:
+                lost.append(job.job_id)
+                return False
+            return lease_job(job)
+
+        worker.lease_job = lose_first_lease
+        started = time.perf_counter()
+        worker.start()
+        _wait_until_empty(repository, args.timeout)
+        recovery = time.perf_counter() - started
+        worker.stop()
+        remaining = repository.count_jobs()
+    print(f"  {args.jobs:>4} | {recovery * 1000:11.1f}  {breaker.state}")
+    if remaining:
+        raise SystemExit(
+            f"probe: {remaining} jobs still spooled, breaker {breaker.state}"
+        )
+
+
+def _wait_until_empty(repository: SpoolRepository, timeout: float) -> None:
+    deadline = time.perf_counter() + timeout
+    while repository.count_jobs() and time.perf_counter() < deadline:
+        time.sleep(0.005)
+
+
+def _orchestrator(overrides: dict) -> UploadOrchestrator:
+    config = S3Config.from_sources(Path(tempfile.gettempdir()), overrides)
+    return UploadOrchestrator(
+        config=config,
+        s3_client=S3ClientAdapter(config=config),
+        spool_repository=SpoolRepository.from_config(config),
+        key_strategy=ObjectKeyStrategy(
+            prefix="bench", use_timestamp_prefix=False
+        ),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "scenario",
+        choices=(
+            "store", "spool", "drain", "keys", "wakeup", "probe", "all"
+        ),
+    )
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--format", nargs="+", default=["png"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--layout", nargs="+", default=["files", "segments"])
+    parser.add_argument(
+        "--shards",
+        nargs="+",
+        default=["0x1", "1x1", "2x1", "1x2"],
+        help="key layouts as DEPTHxWIDTH; 0x1 is the flat layout",
+    )
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--encode-workers", type=int, default=2)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--images", type=int, default=200)
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--payload-kb", type=int, default=256)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--interval", type=int, default=30)
+    parser.add_argument("--idle-seconds", type=float, default=5.0)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--hang-seconds", type=float, default=30.0)
+    parser.add_argument("--partition-rps", type=float, default=0.0)
+    parser.add_argument("--partition-chars", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    faults = FaultProfile(
+        latency_seconds=args.latency_ms / 1000,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        hang_rate=args.hang_rate,
+        hang_seconds=args.hang_seconds,
+        partition_rps=args.partition_rps,
+        partition_chars=args.partition_chars,
+        seed=args.seed,
+    )
+    with FakeS3Server(faults) as server:
+        if args.scenario in ("store", "all"):
+            bench_store(server, args)
+        if args.scenario in ("spool", "all"):
+            bench_spool(server, args)
+        if args.scenario in ("drain", "all"):
+            bench_drain(server, args)
+        if args.scenario in ("keys", "all"):
+            bench_keys(server, args)
+        if args.scenario in ("wakeup", "all"):
+            bench_wakeup(server, args)
+        if args.scenario in ("probe", "all"):
+            bench_probe(server, args)
+        stats = server.stats
+        print(
+            f"fake s3: {stats.requests} requests, {stats.objects} objects,"
+            f" {stats.errors} errors, {stats.throttles} throttles,"
+            f" {stats.hangs} hangs"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+﻿"""Measure peak memory and time per megapixel of tensor→uint8 conversion.
+
+Run from the directory that contains this package, for example::
+
+    python -m s3up.benchmarks.tensor_conversion --size 4096 --batch 4
+"""
+
+import argparse
+import time
+import tracemalloc
+from typing import Callable, Iterable
+
+import numpy as np
+
+from ..infrastructure.image_serializer import iter_image_arrays
+
+
+def legacy_arrays(images: Iterable) -> Iterable[np.ndarray]:
+    """The previous conversion, kept here as the baseline."""
+    for tensor in images:
+        array = np.asarray(tensor)
+        batch = array if array.ndim == 4 else array[None]
+        for image in batch:
+            if image.shape[-1] == 1:
+                image = np.repeat(image, 3, axis=-1)
+            yield (image * 255).clip(0, 255).astype(np.uint8)
+
+
+def measure(
+    convert: Callable[[Iterable], Iterable[np.ndarray]], batch: np.ndarray
+) -> tuple[float, float]:
+    """Return (peak MiB above baseline, milliseconds per megapixel)."""
+    megapixels = batch.shape[0] * batch.shape[1] * batch.shape[2] / 1e6
+    tracemalloc.start()
+    started = time.perf_counter()
+    for array in convert([batch]):
+        # Drop each image as an encoder would once it has the bytes.
+        del array
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / (1024 * 1024), elapsed * 1000 / megapixels
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=2048)
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    shape = (args.batch, args.size, args.size, args.channels)
+    batch = np.random.default_rng(0).random(shape, dtype=np.float32)
+    input_mib = batch.nbytes / (1024 * 1024)
+    print(f"input {shape} float32, {input_mib:.1f} MiB")
+    for name, convert in (
+        ("legacy", legacy_arrays),
+        ("strip", iter_image_arrays),
+    ):
+        results = [measure(convert, batch) for _ in range(args.rounds)]
+        peak = max(r[0] for r in results)
+        per_mp = min(r[1] for r in results)
+        print(f"{name:>8}: peak {peak:8.1f} MiB  {per_mp:7.2f} ms/MP")
+
+
+if __name__ == "__main__":
+    main()
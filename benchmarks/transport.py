@@ -0,0 +1,118 @@
+﻿"""Compare the boto3 and native transports: startup and per-PUT CPU.
+
+Run from the directory that contains this package, for example::
+
+    python -m s3up.benchmarks.transport --puts 2000 --payload-kb 64
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from ..domain.config import TRANSPORTS, S3Config
+from ..infrastructure.s3_client import S3ClientAdapter
+from ..infrastructure.s3_client_pool import get_client_pool
+from .fake_s3 import FakeS3Server
+
+_PACKAGE = __package__.rpartition(".")[0]
+
+# Run in a fresh interpreter: import the plugin as ComfyUI does, then
+# build the first client for the transport, as the first upload does.
+_STARTUP_SCRIPT = """
+import sys, time
+started = time.perf_counter()
+import {package}
+imported = time.perf_counter()
+from {package}.domain.config import S3Config
+from {package}.infrastructure.s3_client_pool import get_client_pool
+config = S3Config.from_sources(
+    __import__("pathlib").Path("."),
+    {{"endpoint": "http://127.0.0.1:9", "bucket": "bench",
+      "access_key_id": "bench", "secret_access_key": "bench",
+      "transport": "{transport}"}},
+)
+get_client_pool().get(config)
+ready = time.perf_counter()
+print(imported - started, ready - imported)
+"""
+
+
+def measure_startup(transport: str, repeats: int) -> tuple[float, float]:
+    """Median seconds to import the package and to build a first client."""
+    imports, clients = [], []
+    script = _STARTUP_SCRIPT.format(package=_PACKAGE, transport=transport)
+    for _ in range(repeats):
+        output = subprocess.run(
+            [sys.executable, "-c", script],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        imported, client = (float(value) for value in output.split())
+        imports.append(imported)
+        clients.append(client)
+    return statistics.median(imports), statistics.median(clients)
+
+
+def measure_puts(
+    server: FakeS3Server, transport: str, args: argparse.Namespace
+) -> tuple[float, float]:
+    """Return (CPU microseconds, wall milliseconds) per PUT.
+
+    The fake S3 serves from other threads of this process, so CPU is
+    taken with thread_time() on the uploading thread alone.
+    """
+    config = S3Config.from_sources(
+        Path("."),
+        {
+            "endpoint": server.endpoint,
+            "bucket": f"bench-{transport}",
+            "access_key_id": "bench",
+            "secret_access_key": "bench",
+            "use_ssl": False,
+            "force_path_style": True,
+            "transport": transport,
+            "upload_checksum": "crc32",
+        },
+    )
+    adapter = S3ClientAdapter(config=config)
+    payload = bytes(args.payload_kb * 1024)
+    # Warm up: connect, and let boto3 load its models and handlers.
+    for index in range(10):
+        adapter.upload_bytes(payload, f"warmup/{index}.png", "image/png")
+    cpu_started = time.thread_time()
+    wall_started = time.perf_counter()
+    for index in range(args.puts):
+        adapter.upload_bytes(payload, f"put/{index}.png", "image/png")
+    cpu = time.thread_time() - cpu_started
+    wall = time.perf_counter() - wall_started
+    get_client_pool().clear()
+    return cpu / args.puts * 1e6, wall / args.puts * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--transport", nargs="+", choices=TRANSPORTS, default=list(TRANSPORTS)
+    )
+    parser.add_argument("--puts", type=int, default=1000)
+    parser.add_argument("--payload-kb", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    print("transport | import ms  client ms | cpu us/put  wall ms/put")
+    with FakeS3Server() as server:
+        for transport in args.transport:
+            imported, client = measure_startup(transport, args.repeats)
+            cpu, wall = measure_puts(server, transport, args)
+            print(
+                f"  {transport:>7} | {imported * 1000:9.1f}"
+                f" {client * 1000:10.1f} | {cpu:10.1f} {wall:12.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
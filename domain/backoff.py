@@ -0,0 +1,15 @@
+﻿import random
+from typing import Callable
+
+
+def backoff_delay(
+    attempt: int,
+    base_seconds: float,
+    max_seconds: float,
+    rand: Callable[[], float] = random.random,
+) -> float:
+    """Exponential backoff with full jitter for the given attempt (1-based)."""
+    if attempt <= 0 or base_seconds <= 0:
+        return 0.0
+    ceiling = min(max_seconds, base_seconds * 2 ** (attempt - 1))
+    return ceiling * rand()
@@ -0,0 +1,53 @@
+﻿import base64
+import hashlib
+import zlib
+from dataclasses import dataclass
+
+# S3 request parameter carrying each precomputed checksum.
+_PARAMS = {"crc32": "ChecksumCRC32", "sha256": "ChecksumSHA256"}
+
+
+@dataclass(frozen=True)
+class PayloadChecksum:
+    """Checksum of an object body, computed once and sent with uploads."""
+
+    algorithm: str
+    value: str
+
+    @classmethod
+    def compute(
+        cls, content: bytes, algorithm: str
+    ) -> "PayloadChecksum | None":
+        """Checksum content, or return None when the algorithm is "none"."""
+        if algorithm == "crc32":
+            raw = zlib.crc32(content).to_bytes(4, "big")
+        elif algorithm == "sha256":
+            raw = hashlib.sha256(content).digest()
+        else:
+            return None
+        return cls(algorithm=algorithm, value=base64.b64encode(raw).decode())
+
+    @classmethod
+    def from_sha256_hex(cls, digest: str) -> "PayloadChecksum":
+        """Reuse a hex SHA-256 digest, such as the dedup digest."""
+        raw = bytes.fromhex(digest)
+        return cls(algorithm="sha256", value=base64.b64encode(raw).decode())
+
+    def sha256_hex(self) -> str:
+        """Return the hex digest for SHA-256 checksums, else ""."""
+        if self.algorithm != "sha256":
+            return ""
+        return base64.b64decode(self.value).hex()
+
+    def request_args(self) -> dict:
+        """Return the put_object arguments that carry this checksum."""
+        return {_PARAMS[self.algorithm]: self.value}
+
+    def to_dict(self) -> dict:
+        """Serialize the checksum to a JSON-serializable dict."""
+        return {"algorithm": self.algorithm, "value": self.value}
+
+    @classmethod
+    def from_dict(cls, payload: dict) -> "PayloadChecksum":
+        """Load a checksum from a dict."""
+        return cls(algorithm=payload["algorithm"], value=payload["value"])
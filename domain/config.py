@@ -1,9 +1,21 @@
-﻿import os
-from dataclasses import dataclass
+﻿import hashlib
+import json
+import os
+from dataclasses import dataclass, fields, replace
 from pathlib import Path
 
+from ..domain.derivative_spec import DerivativeSpec
 from ..domain.exceptions import DomainException
 
+ENCODE_EXECUTORS = ("thread", "process")
+IMAGE_FORMATS = ("png", "webp", "jpeg", "avif")
+PNG_STRATEGIES = ("default", "filtered", "huffman", "rle", "fixed")
+SPOOL_LAYOUTS = ("files", "segments")
+SPOOL_EVICTIONS = ("dead-first", "oldest-first", "lowest-priority-first")
+SPOOL_COMPRESSIONS = ("none", "zlib", "zstd")
+UPLOAD_CHECKSUMS = ("none", "crc32", "sha256")
+TRANSPORTS = ("boto3", "native")
+
 
 @dataclass(frozen=True)
 class S3Config:
@@ -23,6 +35,42 @@ class S3Config:
     retry_backoff_seconds: int
     retry_interval_seconds: int
     retry_concurrency: int
+    upload_concurrency: int
+    async_upload: bool
+    upload_queue_size: int
+    encode_workers: int
+    encode_executor: str
+    png_compress_level: int
+    png_optimize: bool
+    png_strategy: str
+    image_format: str
+    image_quality: int
+    image_lossless: bool
+    multipart_threshold_mb: int
+    multipart_chunk_mb: int
+    multipart_concurrency: int
+    retry_backoff_max_seconds: int
+    breaker_failure_threshold: int
+    breaker_reset_seconds: int
+    spool_layout: str
+    spool_segment_mb: int
+    dedup: bool
+    dedup_verify: bool
+    content_addressed_keys: bool
+    dedup_cache_size: int
+    spool_max_mb: int
+    spool_max_jobs: int
+    spool_eviction: str
+    spool_compression: str
+    spool_priority: int
+    upload_checksum: str
+    key_shard_depth: int
+    key_shard_width: int
+    key_date_partition: bool
+    destinations: str
+    derivatives: str
+    transport: str
+    jpeg_optimize: bool
 
     @classmethod
     def from_env(cls, base_dir: Path) -> "S3Config":
@@ -42,6 +90,42 @@ class S3Config:
         retry_backoff_seconds = env["retry_backoff_seconds"]
         retry_interval_seconds = env["retry_interval_seconds"]
         retry_concurrency = env["retry_concurrency"]
+        upload_concurrency = env["upload_concurrency"]
+        async_upload = env["async_upload"]
+        upload_queue_size = env["upload_queue_size"]
+        encode_workers = env["encode_workers"]
+        encode_executor = env["encode_executor"]
+        png_compress_level = env["png_compress_level"]
+        png_optimize = env["png_optimize"]
+        png_strategy = env["png_strategy"]
+        image_format = env["image_format"]
+        image_quality = env["image_quality"]
+        image_lossless = env["image_lossless"]
+        multipart_threshold_mb = env["multipart_threshold_mb"]
+        multipart_chunk_mb = env["multipart_chunk_mb"]
+        multipart_concurrency = env["multipart_concurrency"]
+        retry_backoff_max_seconds = env["retry_backoff_max_seconds"]
+        breaker_failure_threshold = env["breaker_failure_threshold"]
+        breaker_reset_seconds = env["breaker_reset_seconds"]
+        spool_layout = env["spool_layout"]
+        spool_segment_mb = env["spool_segment_mb"]
+        dedup = env["dedup"]
+        dedup_verify = env["dedup_verify"]
+        content_addressed_keys = env["content_addressed_keys"]
+        dedup_cache_size = env["dedup_cache_size"]
+        spool_max_mb = env["spool_max_mb"]
+        spool_max_jobs = env["spool_max_jobs"]
+        spool_eviction = env["spool_eviction"]
+        spool_compression = env["spool_compression"]
+        spool_priority = env["spool_priority"]
+        upload_checksum = env["upload_checksum"]
+        key_shard_depth = env["key_shard_depth"]
+        key_shard_width = env["key_shard_width"]
+        key_date_partition = env["key_date_partition"]
+        destinations = env["destinations"]
+        derivatives = env["derivatives"]
+        transport = env["transport"]
+        jpeg_optimize = env["jpeg_optimize"]
         config = cls(
             endpoint=endpoint,
             bucket=bucket,
@@ -57,6 +141,42 @@ class S3Config:
             retry_backoff_seconds=retry_backoff_seconds,
             retry_interval_seconds=retry_interval_seconds,
             retry_concurrency=retry_concurrency,
+            upload_concurrency=upload_concurrency,
+            async_upload=async_upload,
+            upload_queue_size=upload_queue_size,
+            encode_workers=encode_workers,
+            encode_executor=encode_executor,
+            png_compress_level=png_compress_level,
+            png_optimize=png_optimize,
+            png_strategy=png_strategy,
+            image_format=image_format,
+            image_quality=image_quality,
+            image_lossless=image_lossless,
+            multipart_threshold_mb=multipart_threshold_mb,
+            multipart_chunk_mb=multipart_chunk_mb,
+            multipart_concurrency=multipart_concurrency,
+            retry_backoff_max_seconds=retry_backoff_max_seconds,
+            breaker_failure_threshold=breaker_failure_threshold,
+            breaker_reset_seconds=breaker_reset_seconds,
+            spool_layout=spool_layout,
+            spool_segment_mb=spool_segment_mb,
+            dedup=dedup,
+            dedup_verify=dedup_verify,
+            content_addressed_keys=content_addressed_keys,
+            dedup_cache_size=dedup_cache_size,
+            spool_max_mb=spool_max_mb,
+            spool_max_jobs=spool_max_jobs,
+            spool_eviction=spool_eviction,
+            spool_compression=spool_compression,
+            spool_priority=spool_priority,
+            upload_checksum=upload_checksum,
+            key_shard_depth=key_shard_depth,
+            key_shard_width=key_shard_width,
+            key_date_partition=key_date_partition,
+            destinations=destinations,
+            derivatives=derivatives,
+            transport=transport,
+            jpeg_optimize=jpeg_optimize,
         )
         config._validate()
         return config
@@ -104,6 +224,150 @@ class S3Config:
                 overrides.get("retry_concurrency"),
                 env["retry_concurrency"],
             ),
+            upload_concurrency=_pick_int(
+                overrides.get("upload_concurrency"),
+                env["upload_concurrency"],
+            ),
+            async_upload=_pick_bool(
+                overrides.get("async_upload"),
+                env["async_upload"],
+            ),
+            upload_queue_size=_pick_int(
+                overrides.get("upload_queue_size"),
+                env["upload_queue_size"],
+            ),
+            encode_workers=_pick_int(
+                overrides.get("encode_workers"),
+                env["encode_workers"],
+            ),
+            encode_executor=_pick_str(
+                overrides.get("encode_executor"),
+                env["encode_executor"],
+            ),
+            png_compress_level=_pick_int(
+                overrides.get("png_compress_level"),
+                env["png_compress_level"],
+            ),
+            png_optimize=_pick_bool(
+                overrides.get("png_optimize"),
+                env["png_optimize"],
+            ),
+            png_strategy=_pick_str(
+                overrides.get("png_strategy"),
+                env["png_strategy"],
+            ),
+            image_format=_pick_str(
+                overrides.get("image_format"),
+                env["image_format"],
+            ),
+            image_quality=_pick_int(
+                overrides.get("image_quality"),
+                env["image_quality"],
+            ),
+            image_lossless=_pick_bool(
+                overrides.get("image_lossless"),
+                env["image_lossless"],
+            ),
+            multipart_threshold_mb=_pick_int(
+                overrides.get("multipart_threshold_mb"),
+                env["multipart_threshold_mb"],
+            ),
+            multipart_chunk_mb=_pick_int(
+                overrides.get("multipart_chunk_mb"),
+                env["multipart_chunk_mb"],
+            ),
+            multipart_concurrency=_pick_int(
+                overrides.get("multipart_concurrency"),
+                env["multipart_concurrency"],
+            ),
+            retry_backoff_max_seconds=_pick_int(
+                overrides.get("retry_backoff_max_seconds"),
+                env["retry_backoff_max_seconds"],
+            ),
+            breaker_failure_threshold=_pick_int(
+                overrides.get("breaker_failure_threshold"),
+                env["breaker_failure_threshold"],
+            ),
+            breaker_reset_seconds=_pick_int(
+                overrides.get("breaker_reset_seconds"),
+                env["breaker_reset_seconds"],
+            ),
+            spool_layout=_pick_str(
+                overrides.get("spool_layout"),
+                env["spool_layout"],
+            ),
+            spool_segment_mb=_pick_int(
+                overrides.get("spool_segment_mb"),
+                env["spool_segment_mb"],
+            ),
+            dedup=_pick_bool(
+                overrides.get("dedup"),
+                env["dedup"],
+            ),
+            dedup_verify=_pick_bool(
+                overrides.get("dedup_verify"),
+                env["dedup_verify"],
+            ),
+            content_addressed_keys=_pick_bool(
+                overrides.get("content_addressed_keys"),
+                env["content_addressed_keys"],
+            ),
+            dedup_cache_size=_pick_int(
+                overrides.get("dedup_cache_size"),
+                env["dedup_cache_size"],
+            ),
+            spool_max_mb=_pick_int(
+                overrides.get("spool_max_mb"),
+                env["spool_max_mb"],
+            ),
+            spool_max_jobs=_pick_int(
+                overrides.get("spool_max_jobs"),
+                env["spool_max_jobs"],
+            ),
+            spool_eviction=_pick_str(
+                overrides.get("spool_eviction"),
+                env["spool_eviction"],
+            ),
+            spool_compression=_pick_str(
+                overrides.get("spool_compression"),
+                env["spool_compression"],
+            ),
+            spool_priority=_pick_int(
+                overrides.get("spool_priority"),
+                env["spool_priority"],
+            ),
+            upload_checksum=_pick_str(
+                overrides.get("upload_checksum"),
+                env["upload_checksum"],
+            ),
+            key_shard_depth=_pick_int(
+                overrides.get("key_shard_depth"),
+                env["key_shard_depth"],
+            ),
+            key_shard_width=_pick_int(
+                overrides.get("key_shard_width"),
+                env["key_shard_width"],
+            ),
+            key_date_partition=_pick_bool(
+                overrides.get("key_date_partition"),
+                env["key_date_partition"],
+            ),
+            destinations=_pick_str(
+                overrides.get("destinations"),
+                env["destinations"],
+            ),
+            derivatives=_pick_str(
+                overrides.get("derivatives"),
+                env["derivatives"],
+            ),
+            transport=_pick_str(
+                overrides.get("transport"),
+                env["transport"],
+            ),
+            jpeg_optimize=_pick_bool(
+                overrides.get("jpeg_optimize"),
+                env["jpeg_optimize"],
+            ),
         )
         config._validate()
         return config
@@ -139,6 +403,100 @@ class S3Config:
         retry_concurrency = _parse_int_default(
             os.getenv("S3_RETRY_CONCURRENCY", "1"), 1
         )
+        upload_concurrency = _parse_int_default(
+            os.getenv("S3_UPLOAD_CONCURRENCY", "4"), 4
+        )
+        async_upload = _parse_bool_default(
+            os.getenv("S3_ASYNC_UPLOAD", "false"), False
+        )
+        upload_queue_size = _parse_int_default(
+            os.getenv("S3_UPLOAD_QUEUE_SIZE", "64"), 64
+        )
+        encode_workers = _parse_int_default(
+            os.getenv("S3_ENCODE_WORKERS", "2"), 2
+        )
+        encode_executor = os.getenv("S3_ENCODE_EXECUTOR", "thread").strip()
+        png_compress_level = _parse_int_default(
+            os.getenv("S3_PNG_COMPRESS_LEVEL", "6"), 6
+        )
+        png_optimize = _parse_bool_default(
+            os.getenv("S3_PNG_OPTIMIZE", "false"), False
+        )
+        png_strategy = os.getenv("S3_PNG_STRATEGY", "default").strip()
+        image_format = os.getenv("S3_IMAGE_FORMAT", "png").strip().lower()
+        image_quality = _parse_int_default(
+            os.getenv("S3_IMAGE_QUALITY", "90"), 90
+        )
+        image_lossless = _parse_bool_default(
+            os.getenv("S3_IMAGE_LOSSLESS", "false"), False
+        )
+        multipart_threshold_mb = _parse_int_default(
+            os.getenv("S3_MULTIPART_THRESHOLD_MB", "16"), 16
+        )
+        multipart_chunk_mb = _parse_int_default(
+            os.getenv("S3_MULTIPART_CHUNK_MB", "8"), 8
+        )
+        multipart_concurrency = _parse_int_default(
+            os.getenv("S3_MULTIPART_CONCURRENCY", "4"), 4
+        )
+        retry_backoff_max_seconds = _parse_int_default(
+            os.getenv("S3_RETRY_BACKOFF_MAX_SECONDS", "300"), 300
+        )
+        breaker_failure_threshold = _parse_int_default(
+            os.getenv("S3_BREAKER_FAILURE_THRESHOLD", "5"), 5
+        )
+        breaker_reset_seconds = _parse_int_default(
+            os.getenv("S3_BREAKER_RESET_SECONDS", "30"), 30
+        )
+        spool_layout = os.getenv("S3_SPOOL_LAYOUT", "files").strip().lower()
+        spool_segment_mb = _parse_int_default(
+            os.getenv("S3_SPOOL_SEGMENT_MB", "64"), 64
+        )
+        dedup = _parse_bool_default(
+            os.getenv("S3_DEDUP", "false"), False
+        )
+        dedup_verify = _parse_bool_default(
+            os.getenv("S3_DEDUP_VERIFY", "false"), False
+        )
+        content_addressed_keys = _parse_bool_default(
+            os.getenv("S3_CONTENT_KEYS", "false"), False
+        )
+        dedup_cache_size = _parse_int_default(
+            os.getenv("S3_DEDUP_CACHE_SIZE", "4096"), 4096
+        )
+        spool_max_mb = _parse_int_default(
+            os.getenv("S3_SPOOL_MAX_MB", "0"), 0
+        )
+        spool_max_jobs = _parse_int_default(
+            os.getenv("S3_SPOOL_MAX_JOBS", "0"), 0
+        )
+        spool_eviction = (
+            os.getenv("S3_SPOOL_EVICTION", "dead-first").strip().lower()
+        )
+        spool_compression = (
+            os.getenv("S3_SPOOL_COMPRESSION", "none").strip().lower()
+        )
+        spool_priority = _parse_int_default(
+            os.getenv("S3_SPOOL_PRIORITY", "0"), 0
+        )
+        upload_checksum = (
+            os.getenv("S3_UPLOAD_CHECKSUM", "none").strip().lower()
+        )
+        key_shard_depth = _parse_int_default(
+            os.getenv("S3_KEY_SHARD_DEPTH", "0"), 0
+        )
+        key_shard_width = _parse_int_default(
+            os.getenv("S3_KEY_SHARD_WIDTH", "1"), 1
+        )
+        key_date_partition = _parse_bool_default(
+            os.getenv("S3_KEY_DATE_PARTITION", "false"), False
+        )
+        destinations = os.getenv("S3_DESTINATIONS", "").strip()
+        derivatives = os.getenv("S3_DERIVATIVES", "").strip()
+        transport = os.getenv("S3_TRANSPORT", "boto3").strip().lower()
+        jpeg_optimize = _parse_bool_default(
+            os.getenv("S3_JPEG_OPTIMIZE", "false"), False
+        )
         return {
             "endpoint": endpoint,
             "bucket": bucket,
@@ -154,8 +512,80 @@ class S3Config:
             "retry_backoff_seconds": retry_backoff_seconds,
             "retry_interval_seconds": retry_interval_seconds,
             "retry_concurrency": retry_concurrency,
+            "upload_concurrency": upload_concurrency,
+            "async_upload": async_upload,
+            "upload_queue_size": upload_queue_size,
+            "encode_workers": encode_workers,
+            "encode_executor": encode_executor,
+            "png_compress_level": png_compress_level,
+            "png_optimize": png_optimize,
+            "png_strategy": png_strategy,
+            "image_format": image_format,
+            "image_quality": image_quality,
+            "image_lossless": image_lossless,
+            "multipart_threshold_mb": multipart_threshold_mb,
+            "multipart_chunk_mb": multipart_chunk_mb,
+            "multipart_concurrency": multipart_concurrency,
+            "retry_backoff_max_seconds": retry_backoff_max_seconds,
+            "breaker_failure_threshold": breaker_failure_threshold,
+            "breaker_reset_seconds": breaker_reset_seconds,
+            "spool_layout": spool_layout,
+            "spool_segment_mb": spool_segment_mb,
+            "dedup": dedup,
+            "dedup_verify": dedup_verify,
+            "content_addressed_keys": content_addressed_keys,
+            "dedup_cache_size": dedup_cache_size,
+            "spool_max_mb": spool_max_mb,
+            "spool_max_jobs": spool_max_jobs,
+            "spool_eviction": spool_eviction,
+            "spool_compression": spool_compression,
+            "spool_priority": spool_priority,
+            "upload_checksum": upload_checksum,
+            "key_shard_depth": key_shard_depth,
+            "key_shard_width": key_shard_width,
+            "key_date_partition": key_date_partition,
+            "destinations": destinations,
+            "derivatives": derivatives,
+            "transport": transport,
+            "jpeg_optimize": jpeg_optimize,
         }
 
+    def credential_ref(self) -> str:
+        """返回凭证的不可逆标识，可写入暂存任务而不泄露密钥。"""
+        digest = hashlib.sha256(self.access_key_id.encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    def derivative_specs(self) -> tuple[DerivativeSpec, ...]:
+        """解析需要随原图生成的衍生图。"""
+        specs = DerivativeSpec.parse_list(
+            self.derivatives, self.image_format, self.image_quality
+        )
+        for spec in specs:
+            if spec.image_format not in IMAGE_FORMATS:
+                raise DomainException(
+                    f"S3_DERIVATIVES 的格式只能是 {'、'.join(IMAGE_FORMATS)}"
+                )
+        return specs
+
+    def mirror_configs(self) -> list["S3Config"]:
+        """解析镜像目标，未写出的字段沿用本配置。"""
+        names = {item.name for item in fields(self)} - {"destinations"}
+        configs = []
+        for entry in _parse_destinations(self.destinations):
+            unknown = sorted(set(entry) - names)
+            if unknown:
+                raise DomainException(
+                    f"S3_DESTINATIONS 不支持字段 {', '.join(unknown)}"
+                )
+            values = {
+                name: _coerce_like(getattr(self, name), value)
+                for name, value in entry.items()
+            }
+            config = replace(self, destinations="", **values)
+            config._validate()
+            configs.append(config)
+        return configs
+
     def _validate(self) -> None:
         """检查必填配置。"""
         if not self.bucket:
@@ -164,6 +594,38 @@ class S3Config:
             raise DomainException("S3_ACCESS_KEY_ID 必须填写")
         if not self.secret_access_key:
             raise DomainException("S3_SECRET_ACCESS_KEY 必须填写")
+        if self.encode_executor not in ENCODE_EXECUTORS:
+            raise DomainException("S3_ENCODE_EXECUTOR 只能是 thread 或 process")
+        if self.png_strategy not in PNG_STRATEGIES:
+            raise DomainException("S3_PNG_STRATEGY 取值不正确")
+        if not 0 <= self.png_compress_level <= 9:
+            raise DomainException("S3_PNG_COMPRESS_LEVEL 必须在 0 到 9 之间")
+        if self.image_format not in IMAGE_FORMATS:
+            raise DomainException(
+                f"S3_IMAGE_FORMAT 只能是 {'、'.join(IMAGE_FORMATS)}"
+            )
+        if not 1 <= self.image_quality <= 100:
+            raise DomainException("S3_IMAGE_QUALITY 必须在 1 到 100 之间")
+        if self.spool_layout not in SPOOL_LAYOUTS:
+            raise DomainException("S3_SPOOL_LAYOUT 只能是 files 或 segments")
+        if self.spool_eviction not in SPOOL_EVICTIONS:
+            raise DomainException("S3_SPOOL_EVICTION 取值不正确")
+        if self.spool_compression not in SPOOL_COMPRESSIONS:
+            raise DomainException("S3_SPOOL_COMPRESSION 只能是 none、zlib 或 zstd")
+        if self.upload_checksum not in UPLOAD_CHECKSUMS:
+            raise DomainException("S3_UPLOAD_CHECKSUM 只能是 none、crc32 或 sha256")
+        if self.transport not in TRANSPORTS:
+            raise DomainException("S3_TRANSPORT 只能是 boto3 或 native")
+        if not 0 <= self.key_shard_depth <= 4:
+            raise DomainException("S3_KEY_SHARD_DEPTH 必须在 0 到 4 之间")
+        if not 1 <= self.key_shard_width <= 4:
+            raise DomainException("S3_KEY_SHARD_WIDTH 必须在 1 到 4 之间")
+        if self.multipart_chunk_mb < 5:
+            raise DomainException("S3_MULTIPART_CHUNK_MB 不能小于 5")
+        if self.derivatives:
+            self.derivative_specs()
+        if self.destinations:
+            self.mirror_configs()
 
 
 def _parse_bool(value: str) -> bool:
@@ -220,6 +682,34 @@ def _pick_int(value: int | None, fallback: int) -> int:
     return int(value)
 
 
+def _parse_destinations(text: str) -> list[dict]:
+    """把镜像目标 JSON 解析为字典列表。"""
+    if not text.strip():
+        return []
+    try:
+        entries = json.loads(text)
+    except ValueError as exc:
+        raise DomainException("S3_DESTINATIONS 不是合法的 JSON") from exc
+    if not isinstance(entries, list) or not all(
+        isinstance(entry, dict) for entry in entries
+    ):
+        raise DomainException("S3_DESTINATIONS 必须是对象列表")
+    return entries
+
+
+def _coerce_like(current, value):
+    """按已有字段的类型转换镜像目标里的值。"""
+    if isinstance(current, bool):
+        if isinstance(value, str):
+            return _parse_bool(value)
+        return bool(value)
+    if isinstance(current, int):
+        return _parse_int(str(value))
+    if isinstance(current, Path):
+        return Path(str(value))
+    return str(value).strip()
+
+
 def _pick_path(value: str | None, fallback: Path) -> Path:
     """读取路径，空值就用默认值。"""
     if value is None:
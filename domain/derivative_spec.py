@@ -0,0 +1,69 @@
+﻿import json
+import re
+from dataclasses import dataclass
+
+from ..domain.exceptions import DomainException
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+@dataclass(frozen=True)
+class DerivativeSpec:
+    """随原图一起生成的缩略图或预览图。"""
+
+    name: str
+    size: int
+    image_format: str
+    quality: int
+
+    @classmethod
+    def parse_list(
+        cls, text: str, image_format: str, quality: int
+    ) -> tuple["DerivativeSpec", ...]:
+        """解析 JSON 列表，未写格式和质量时沿用原图设置。"""
+        if not text.strip():
+            return ()
+        try:
+            entries = json.loads(text)
+        except ValueError as exc:
+            raise DomainException("S3_DERIVATIVES 不是合法的 JSON") from exc
+        if not isinstance(entries, list) or not all(
+            isinstance(entry, dict) for entry in entries
+        ):
+            raise DomainException("S3_DERIVATIVES 必须是对象列表")
+        specs = tuple(
+            cls(
+                name=str(entry.get("name", "")).strip(),
+                size=_to_int(entry.get("size", 0)),
+                image_format=str(
+                    entry.get("format", image_format)
+                ).strip().lower(),
+                quality=_to_int(entry.get("quality", quality)),
+            )
+            for entry in entries
+        )
+        names = [spec.name for spec in specs]
+        if len(set(names)) != len(names):
+            raise DomainException("S3_DERIVATIVES 的名称不能重复")
+        for spec in specs:
+            spec._validate()
+        return specs
+
+    def _validate(self) -> None:
+        """检查名称、尺寸与质量。"""
+        if not _NAME_PATTERN.match(self.name):
+            raise DomainException(
+                "S3_DERIVATIVES 的名称只能包含字母、数字、下划线和连字符"
+            )
+        if self.size <= 0:
+            raise DomainException("S3_DERIVATIVES 的尺寸必须大于 0")
+        if not 1 <= self.quality <= 100:
+            raise DomainException("S3_DERIVATIVES 的质量必须在 1 到 100 之间")
+
+
+def _to_int(value) -> int:
+    """把整数值转为整数。"""
+    try:
+        return int(value)
+    except (TypeError, ValueError) as exc:
+        raise DomainException("S3_DERIVATIVES 的数值格式不正确") from exc
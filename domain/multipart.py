@@ -0,0 +1,47 @@
+﻿from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class MultipartProgress:
+    """Resumable state of an unfinished multipart upload."""
+
+    upload_id: str
+    part_size: int
+    parts: tuple[tuple[int, str], ...] = ()
+
+    def completed_numbers(self) -> set[int]:
+        """Return the part numbers that already have an ETag."""
+        return {number for number, _ in self.parts}
+
+    def with_parts(self, parts: dict[int, str]) -> "MultipartProgress":
+        """Return progress with the given parts merged in."""
+        merged = dict(self.parts)
+        merged.update(parts)
+        return MultipartProgress(
+            upload_id=self.upload_id,
+            part_size=self.part_size,
+            parts=tuple(sorted(merged.items())),
+        )
+
+    def to_dict(self) -> dict:
+        """Serialize progress to a JSON-serializable dict."""
+        return {
+            "upload_id": self.upload_id,
+            "part_size": self.part_size,
+            "parts": [
+                {"part_number": number, "etag": etag}
+                for number, etag in self.parts
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, payload: dict) -> "MultipartProgress":
+        """Load progress from a dict."""
+        return cls(
+            upload_id=payload["upload_id"],
+            part_size=payload["part_size"],
+            parts=tuple(
+                (item["part_number"], item["etag"])
+                for item in payload.get("parts", [])
+            ),
+        )
@@ -1,5 +1,6 @@
 ﻿from dataclasses import dataclass
 from datetime import datetime, timezone
+import posixpath
 import uuid
 
 
@@ -9,21 +10,54 @@ class ObjectKeyStrategy:
 
     prefix: str
     use_timestamp_prefix: bool
+    content_addressed: bool = False
+    shard_depth: int = 0
+    shard_width: int = 1
+    date_partition: bool = False
 
     def build_key(
-        self, extension: str, now: datetime | None = None
+        self,
+        extension: str,
+        now: datetime | None = None,
+        digest: str = "",
     ) -> str:
-        """生成对象名称，不创建目录层级。"""
+        """生成对象名称，按配置加入哈希分片和日期目录。
+
+        开启哈希命名并传入摘要时，文件名就是摘要，分片也取自摘要，
+        且不加日期目录，同一内容总是得到同一名称。
+        """
         current = now or datetime.now(timezone.utc)
         timestamp = current.strftime("%Y%m%d_%H%M%S_%f")
-        random_hex = uuid.uuid4().hex[:8]
+        random_hex = uuid.uuid4().hex
         safe_ext = extension.lstrip(".") or "bin"
         safe_prefix = self.prefix.strip("/")
-        if self.use_timestamp_prefix:
-            filename = f"{timestamp}_{random_hex}.{safe_ext}"
+        addressed = self.content_addressed and bool(digest)
+        if addressed:
+            filename = f"{digest}.{safe_ext}"
+        elif self.use_timestamp_prefix:
+            filename = f"{timestamp}_{random_hex[:8]}.{safe_ext}"
         else:
-            filename = f"{random_hex}.{safe_ext}"
-        if safe_prefix:
-            return f"{safe_prefix}/{filename}"
-        return filename
+            filename = f"{random_hex[:8]}.{safe_ext}"
+        parts = [safe_prefix] if safe_prefix else []
+        parts.extend(self._shards(digest if addressed else random_hex))
+        if self.date_partition and not addressed:
+            parts.append(current.strftime("%Y/%m/%d"))
+        parts.append(filename)
+        return "/".join(parts)
 
+    def derivative_key(
+        self, object_key: str, name: str, extension: str
+    ) -> str:
+        """由原图名称得到衍生图名称，与原图位于同一目录。"""
+        stem, _ = posixpath.splitext(object_key)
+        safe_ext = extension.lstrip(".") or "bin"
+        return f"{stem}_{name}.{safe_ext}"
+
+    def _shards(self, seed: str) -> list[str]:
+        """从十六进制串切出各级分片目录名。"""
+        width = self.shard_width
+        return [
+            seed[level * width : (level + 1) * width]
+            for level in range(self.shard_depth)
+        ]
+
@@ -1,5 +1,8 @@
-﻿from dataclasses import dataclass
-from datetime import datetime, timezone
+﻿from dataclasses import dataclass, replace
+from datetime import datetime, timedelta, timezone
+
+from ..domain.checksum import PayloadChecksum
+from ..domain.multipart import MultipartProgress
 
 
 @dataclass(frozen=True)
@@ -15,6 +18,16 @@ class SpoolJob:
     retry_count: int
     last_error: str
     created_at: str
+    content_type: str = ""
+    multipart: MultipartProgress | None = None
+    next_attempt_at: str = ""
+    payload_offset: int = 0
+    payload_length: int | None = None
+    credential_ref: str = ""
+    priority: int = 0
+    compression: str = ""
+    stored_bytes: int = 0
+    checksum: PayloadChecksum | None = None
 
     @classmethod
     def create(
@@ -25,6 +38,10 @@ class SpoolJob:
         endpoint: str,
         file_path: str,
         file_ext: str,
+        content_type: str = "",
+        credential_ref: str = "",
+        priority: int = 0,
+        checksum: PayloadChecksum | None = None,
     ) -> "SpoolJob":
         """Create a new job with default retry values."""
         created_at = datetime.now(timezone.utc).isoformat()
@@ -38,6 +55,10 @@ class SpoolJob:
             retry_count=0,
             last_error="",
             created_at=created_at,
+            content_type=content_type,
+            credential_ref=credential_ref,
+            priority=priority,
+            checksum=checksum,
         )
 
     def to_dict(self) -> dict:
@@ -52,6 +73,18 @@ class SpoolJob:
             "retry_count": self.retry_count,
             "last_error": self.last_error,
             "created_at": self.created_at,
+            "content_type": self.content_type,
+            "multipart": (
+                self.multipart.to_dict() if self.multipart else None
+            ),
+            "next_attempt_at": self.next_attempt_at,
+            "payload_offset": self.payload_offset,
+            "payload_length": self.payload_length,
+            "credential_ref": self.credential_ref,
+            "priority": self.priority,
+            "compression": self.compression,
+            "stored_bytes": self.stored_bytes,
+            "checksum": self.checksum.to_dict() if self.checksum else None,
         }
 
     @classmethod
@@ -67,19 +100,60 @@ class SpoolJob:
             retry_count=payload["retry_count"],
             last_error=payload["last_error"],
             created_at=payload["created_at"],
+            content_type=payload.get("content_type", ""),
+            multipart=_load_multipart(payload.get("multipart")),
+            next_attempt_at=payload.get("next_attempt_at", ""),
+            payload_offset=payload.get("payload_offset", 0),
+            payload_length=payload.get("payload_length"),
+            credential_ref=payload.get("credential_ref", ""),
+            priority=payload.get("priority", 0),
+            compression=payload.get("compression", ""),
+            stored_bytes=payload.get("stored_bytes", 0),
+            checksum=_load_checksum(payload.get("checksum")),
         )
 
-    def increment_retry(self, error: str) -> "SpoolJob":
-        """Return a new job with incremented retry count."""
-        return SpoolJob(
-            job_id=self.job_id,
-            object_key=self.object_key,
-            bucket=self.bucket,
-            endpoint=self.endpoint,
-            file_path=self.file_path,
-            file_ext=self.file_ext,
+    def increment_retry(
+        self, error: str, delay_seconds: float = 0.0
+    ) -> "SpoolJob":
+        """Return a new job with incremented retry count.
+
+        The next attempt is scheduled `delay_seconds` from now.
+        """
+        next_attempt = datetime.now(timezone.utc) + timedelta(
+            seconds=delay_seconds
+        )
+        return replace(
+            self,
             retry_count=self.retry_count + 1,
             last_error=error,
-            created_at=self.created_at,
+            next_attempt_at=next_attempt.isoformat(),
         )
 
+    def with_multipart(
+        self, multipart: MultipartProgress | None
+    ) -> "SpoolJob":
+        """Return a new job carrying multipart upload progress."""
+        return replace(self, multipart=multipart)
+
+    def in_segment(self) -> bool:
+        """Return whether the payload is a slice of a segment file."""
+        return self.payload_length is not None
+
+    def due_timestamp(self) -> float:
+        """Return the POSIX time this job may be retried (0 = now)."""
+        if not self.next_attempt_at:
+            return 0.0
+        return datetime.fromisoformat(self.next_attempt_at).timestamp()
+
+
+def _load_multipart(payload: dict | None) -> MultipartProgress | None:
+    if not payload:
+        return None
+    return MultipartProgress.from_dict(payload)
+
+
+def _load_checksum(payload: dict | None) -> PayloadChecksum | None:
+    if not payload:
+        return None
+    return PayloadChecksum.from_dict(payload)
+
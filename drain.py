@@ -0,0 +1,360 @@
+﻿"""Drain the upload spool from outside ComfyUI.
+
+Reads credentials from the same S3_* environment variables as the node
+and pushes spooled jobs with many parallel uploads, for example::
+
+    python -m s3up.drain --concurrency 64 --max-mbps 200
+    python -m s3up.drain --bucket outputs --older-than 3600 --dry-run
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+from .domain.config import S3Config
+from .domain.exceptions import DomainException
+from .domain.spool_job import SpoolJob
+from .infrastructure.circuit_breaker import get_circuit_breaker
+from .infrastructure.retry_targets import get_target_registry
+from .infrastructure.retry_worker import RetryWorker
+from .infrastructure.spool_repository import SpoolRepository
+
+_MB = 1024 * 1024
+
+
+@dataclass(frozen=True)
+class DrainFilter:
+    """Select jobs by target and age (seconds since they were spooled)."""
+
+    bucket: str = ""
+    endpoint: str = ""
+    older_than: float | None = None
+    newer_than: float | None = None
+
+    def matches(self, job: SpoolJob, now: datetime) -> bool:
+        """Return whether a job passes every configured filter."""
+        if self.bucket and job.bucket != self.bucket:
+            return False
+        if self.endpoint and job.endpoint != self.endpoint:
+            return False
+        if self.older_than is None and self.newer_than is None:
+            return True
+        age = (now - _parse_time(job.created_at)).total_seconds()
+        if self.older_than is not None and age < self.older_than:
+            return False
+        if self.newer_than is not None and age > self.newer_than:
+            return False
+        return True
+
+
+class RateLimiter:
+    """Token bucket; a rate of 0 means unlimited."""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1.0) -> None:
+        """Block until `amount` tokens are available, then take them."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.rate, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                # Oversized requests may drive the bucket negative rather
+                # than waiting forever.
+                if self._tokens >= min(amount, self.rate):
+                    self._tokens -= amount
+                    return
+                wait = (min(amount, self.rate) - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+@dataclass
+class DrainStats:
+    """Counters for one drain run."""
+
+    succeeded: int = 0
+    failed: int = 0
+    skipped: int = 0
+    bytes_sent: int = 0
+    started: float = field(default_factory=time.monotonic)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def record(self, succeeded: bool, size: int) -> None:
+        """Count one finished job."""
+        with self._lock:
+            if succeeded:
+                self.succeeded += 1
+                self.bytes_sent += size
+            else:
+                self.failed += 1
+
+    def skip(self) -> None:
+        """Count one job left to the worker already retrying it."""
+        with self._lock:
+            self.skipped += 1
+
+    def to_dict(self) -> dict:
+        """Return the counters and rates as a dict."""
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            done = self.succeeded + self.failed
+            return {
+                "succeeded": self.succeeded,
+                "failed": self.failed,
+                "skipped": self.skipped,
+                "bytes_sent": self.bytes_sent,
+                "elapsed_seconds": round(elapsed, 3),
+                "jobs_per_second": round(done / elapsed, 2),
+                "mb_per_second": round(self.bytes_sent / _MB / elapsed, 2),
+            }
+
+
+class SpoolDrainer:
+    """Upload spooled jobs in parallel with optional rate limits."""
+
+    def __init__(
+        self,
+        config: S3Config,
+        spool_repository: SpoolRepository,
+        concurrency: int,
+        job_rate: float = 0.0,
+        byte_rate: float = 0.0,
+    ) -> None:
+        self.concurrency = max(1, concurrency)
+        # Size the shared connection pool for the drain's parallelism.
+        self.config = replace(config, retry_concurrency=self.concurrency)
+        self.spool_repository = spool_repository
+        self.stats = DrainStats()
+        self._job_limiter = RateLimiter(job_rate)
+        self._byte_limiter = RateLimiter(byte_rate)
+        # Jobs are routed to the target they were spooled for; the
+        # environment's credentials are the ones available here.
+        get_target_registry().register(self.config)
+        self._worker = RetryWorker(
+            config=self.config, spool_repository=spool_repository
+        )
+
+    def run(self, jobs: Iterable[SpoolJob]) -> DrainStats:
+        """Drain every job and return the final counters."""
+        slots = threading.BoundedSemaphore(self.concurrency * 2)
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="s3up-drain"
+        ) as executor:
+            for job in jobs:
+                slots.acquire()
+                future = executor.submit(self._drain_one, job)
+                future.add_done_callback(lambda _: slots.release())
+        return self.stats
+
+    def _drain_one(self, job: SpoolJob) -> None:
+        # A ComfyUI retry worker may be draining the same spool.
+        if not self._worker.lease_job(job):
+            self.stats.skip()
+            return
+        size = _job_size(job)
+        probe = None
+        try:
+            self._job_limiter.acquire()
+            self._byte_limiter.acquire(size)
+            breaker = get_circuit_breaker(
+                self.config, job.endpoint, job.bucket
+            )
+            while not breaker.try_probe():
+                time.sleep(
+                    max(0.1, min(1.0, breaker.seconds_until_probe()))
+                )
+            probe = breaker
+            succeeded = self._worker.retry_job(job)
+        except Exception:
+            succeeded = False
+            if probe is not None:
+                # No result reached the breaker; let another thread
+                # probe instead of waiting on this one forever.
+                probe.release_probe()
+        finally:
+            self._worker.release_job(job)
+        self.stats.record(succeeded, size)
+
+
+def select_jobs(
+    spool_repository: SpoolRepository,
+    job_filter: DrainFilter,
+    include_dead: bool,
+) -> Iterator[SpoolJob]:
+    """Stream the jobs that pass the filter."""
+    now = datetime.now(timezone.utc)
+    for job in spool_repository.iter_jobs(include_dead=include_dead):
+        if job_filter.matches(job, now):
+            yield job
+
+
+def summarize(jobs: Iterable[SpoolJob], retry_max: int) -> dict:
+    """Count jobs and bytes per target without uploading anything."""
+    counts: Counter = Counter()
+    sizes: Counter = Counter()
+    dead: Counter = Counter()
+    for job in jobs:
+        target = f"{job.endpoint or 'aws'}/{job.bucket}"
+        counts[target] += 1
+        sizes[target] += _job_size(job)
+        if job.retry_count >= retry_max:
+            dead[target] += 1
+    return {
+        target: {
+            "jobs": counts[target],
+            "bytes": sizes[target],
+            "dead": dead[target],
+        }
+        for target in sorted(counts)
+    }
+
+
+def _job_size(job: SpoolJob) -> int:
+    if job.payload_length is not None:
+        return job.payload_length
+    try:
+        return os.path.getsize(job.file_path)
+    except OSError:
+        return 0
+
+
+def _parse_time(value: str) -> datetime:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.now(timezone.utc)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _report_every(
+    seconds: float, report: Callable[[], None], stop: threading.Event
+) -> threading.Thread:
+    def loop() -> None:
+        while not stop.wait(seconds):
+            report()
+
+    thread = threading.Thread(
+        target=loop, name="s3up-drain-stats", daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Run the drain CLI and return the process exit code."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--spool-dir", help="defaults to S3_SPOOL_DIR")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--rate", type=float, default=0.0, help="max jobs per second"
+    )
+    parser.add_argument(
+        "--max-mbps", type=float, default=0.0, help="max MB per second"
+    )
+    parser.add_argument("--bucket", default="")
+    parser.add_argument("--endpoint", default="")
+    parser.add_argument(
+        "--older-than", type=float, help="only jobs spooled >= N seconds ago"
+    )
+    parser.add_argument(
+        "--newer-than", type=float, help="only jobs spooled <= N seconds ago"
+    )
+    parser.add_argument(
+        "--include-dead",
+        action="store_true",
+        help="also retry jobs that ran out of retries",
+    )
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--stats-interval", type=float, default=5.0)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args(argv)
+
+    base_dir = Path(__file__).resolve().parent
+    try:
+        config = S3Config.from_env(base_dir)
+    except DomainException as exc:
+        print(f"s3up drain: {exc}", file=sys.stderr)
+        return 2
+    if args.spool_dir:
+        config = replace(config, spool_dir=Path(args.spool_dir))
+    spool_repository = SpoolRepository.from_config(config)
+    job_filter = DrainFilter(
+        bucket=args.bucket,
+        endpoint=args.endpoint,
+        older_than=args.older_than,
+        newer_than=args.newer_than,
+    )
+    jobs = select_jobs(spool_repository, job_filter, args.include_dead)
+
+    if args.dry_run:
+        summary = summarize(jobs, config.retry_max)
+        if args.json:
+            print(json.dumps(summary, indent=2))
+        else:
+            for target, row in summary.items():
+                print(
+                    f"{target}: {row['jobs']} jobs,"
+                    f" {row['bytes'] / _MB:.1f} MB, {row['dead']} dead"
+                )
+        return 0
+
+    drainer = SpoolDrainer(
+        config=config,
+        spool_repository=spool_repository,
+        concurrency=args.concurrency,
+        job_rate=args.rate,
+        byte_rate=args.max_mbps * _MB,
+    )
+
+    def report() -> None:
+        stats = drainer.stats.to_dict()
+        print(
+            f"ok={stats['succeeded']} failed={stats['failed']}"
+            f" {stats['jobs_per_second']} jobs/s"
+            f" {stats['mb_per_second']} MB/s"
+            f" spool={spool_repository.count_jobs()}",
+            file=sys.stderr,
+        )
+
+    stop = threading.Event()
+    if args.stats_interval > 0:
+        _report_every(args.stats_interval, report, stop)
+    try:
+        stats = drainer.run(jobs).to_dict()
+    finally:
+        stop.set()
+    stats["remaining"] = spool_repository.count_jobs()
+    if args.json:
+        print(json.dumps(stats, indent=2))
+    else:
+        print(
+            f"drained {stats['succeeded']} jobs"
+            f" ({stats['bytes_sent'] / _MB:.1f} MB)"
+            f" in {stats['elapsed_seconds']}s,"
+            f" {stats['failed']} failed, {stats['skipped']} held elsewhere,"
+            f" {stats['remaining']} left in spool"
+        )
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
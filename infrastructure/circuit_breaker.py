@@ -0,0 +1,165 @@
+﻿import threading
+import time
+
+from ..domain.config import S3Config
+from ..infrastructure.metrics import get_metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_THROTTLE_CODES = {"SlowDown", "Throttling", "RequestLimitExceeded"}
+
+
+class CircuitBreaker:
+    """Fail-fast guard for one (endpoint, bucket) target.
+
+    Opens after `failure_threshold` consecutive endpoint failures. Once
+    `reset_seconds` have passed a single probe is let through; its
+    outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float) -> None:
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_seconds = reset_seconds
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """Return the current breaker state."""
+        with self._lock:
+            return self._state
+
+    def allow_request(self) -> bool:
+        """Return whether the hot path may try the network."""
+        with self._lock:
+            return self._state == CLOSED
+
+    def try_probe(self) -> bool:
+        """Return whether a retry may run, claiming the probe if needed."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN and self._probe_ready():
+                self._state = HALF_OPEN
+                return True
+            return False
+
+    def seconds_until_probe(self) -> float:
+        """Return how long until an open breaker admits a probe."""
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            elapsed = time.monotonic() - self._opened_at
+            return max(0.0, self.reset_seconds - elapsed)
+
+    def record_success(self) -> bool:
+        """Close the breaker; return whether it had seen failures."""
+        with self._lock:
+            recovered = self._failures > 0 or self._state != CLOSED
+            self._state = CLOSED
+            self._failures = 0
+            return recovered
+
+    def record_failure(self) -> None:
+        """Count a failure, opening the breaker at the threshold."""
+        with self._lock:
+            self._failures += 1
+            if (
+                self._state == HALF_OPEN
+                or self._failures >= self.failure_threshold
+            ):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def record_result(self, exc: Exception | None) -> None:
+        """Feed an upload outcome; client errors do not trip the breaker."""
+        if exc is None:
+            self.record_success()
+        elif is_endpoint_failure(exc):
+            self.record_failure()
+        elif isinstance(getattr(exc, "response", None), dict):
+            # The endpoint answered, so it is reachable.
+            self.record_success()
+        else:
+            # A local error says nothing about the endpoint; let the next
+            # job probe instead.
+            self.release_probe()
+
+    def release_probe(self) -> None:
+        """Hand back a probe that produced no result, keeping it open."""
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._state = OPEN
+
+    def _probe_ready(self) -> bool:
+        return time.monotonic() - self._opened_at >= self.reset_seconds
+
+
+def is_endpoint_failure(exc: Exception) -> bool:
+    """Return whether an error means the endpoint itself is unhealthy."""
+    if isinstance(exc, FileNotFoundError):
+        return False
+    response = getattr(exc, "response", None)
+    if not isinstance(response, dict):
+        return True
+    code = response.get("Error", {}).get("Code", "")
+    status = response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    if code in _THROTTLE_CODES:
+        return True
+    return not 400 <= status < 500
+
+
+_breakers: dict[tuple[str, str], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(
+    config: S3Config, endpoint: str | None = None, bucket: str | None = None
+) -> CircuitBreaker:
+    """Return the shared breaker for a target, defaulting to the config's."""
+    key = (
+        config.endpoint if endpoint is None else endpoint,
+        config.bucket if bucket is None else bucket,
+    )
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                failure_threshold=config.breaker_failure_threshold,
+                reset_seconds=config.breaker_reset_seconds,
+            )
+            _breakers[key] = breaker
+        else:
+            breaker.failure_threshold = max(
+                1, config.breaker_failure_threshold
+            )
+            breaker.reset_seconds = config.breaker_reset_seconds
+        return breaker
+
+
+def breaker_states() -> dict[tuple[str, str], str]:
+    """Return the state of every known breaker."""
+    with _breakers_lock:
+        breakers = dict(_breakers)
+    return {key: breaker.state for key, breaker in breakers.items()}
+
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def _breaker_samples() -> list[tuple[dict, float]]:
+    return [
+        ({"endpoint": endpoint, "bucket": bucket}, _STATE_VALUES[state])
+        for (endpoint, bucket), state in breaker_states().items()
+    ]
+
+
+get_metrics().gauge(
+    "s3up_breaker_state",
+    "Circuit breaker state per target (0 closed, 1 half-open, 2 open)",
+    _breaker_samples,
+)
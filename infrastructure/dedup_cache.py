@@ -0,0 +1,102 @@
+﻿import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS digests ("
+    " scope TEXT NOT NULL,"
+    " digest TEXT NOT NULL,"
+    " object_key TEXT NOT NULL,"
+    " stored_at REAL NOT NULL,"
+    " PRIMARY KEY (scope, digest)"
+    ")"
+)
+
+
+def content_digest(content: bytes) -> str:
+    """Return the hex SHA-256 of encoded image bytes."""
+    return hashlib.sha256(content).hexdigest()
+
+
+class DigestCache:
+    """Digest→object key map: an in-memory LRU over a SQLite table.
+
+    `scope` keeps targets apart, so the same image uploaded to two
+    buckets is tracked separately.
+    """
+
+    def __init__(self, path: Path, capacity: int) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.capacity = max(1, capacity)
+        self._lru: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(path), check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Losing the last few entries only costs a re-upload.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(_SCHEMA)
+
+    def get(self, scope: str, digest: str) -> str | None:
+        """Return the stored key for a digest, if any."""
+        entry = (scope, digest)
+        with self._lock:
+            object_key = self._lru.get(entry)
+            if object_key is not None:
+                self._lru.move_to_end(entry)
+                return object_key
+            row = self._conn.execute(
+                "SELECT object_key FROM digests"
+                " WHERE scope = ? AND digest = ?",
+                entry,
+            ).fetchone()
+            if row is None:
+                return None
+            self._remember(entry, row[0])
+            return row[0]
+
+    def put(self, scope: str, digest: str, object_key: str) -> None:
+        """Record that a digest is stored under a key."""
+        entry = (scope, digest)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO digests"
+                " (scope, digest, object_key, stored_at) VALUES (?, ?, ?, ?)",
+                (scope, digest, object_key, time.time()),
+            )
+            self._remember(entry, object_key)
+
+    def forget(self, scope: str, digest: str) -> None:
+        """Drop a digest whose object turned out to be gone."""
+        entry = (scope, digest)
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM digests WHERE scope = ? AND digest = ?", entry
+            )
+            self._lru.pop(entry, None)
+
+    def _remember(self, entry: tuple[str, str], object_key: str) -> None:
+        self._lru[entry] = object_key
+        self._lru.move_to_end(entry)
+        while len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+
+_caches: dict[Path, DigestCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_digest_cache(path: Path, capacity: int) -> DigestCache:
+    """Return the shared digest cache for a database path."""
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = DigestCache(path, capacity)
+            _caches[path] = cache
+        else:
+            cache.capacity = max(1, capacity)
+        return cache
@@ -0,0 +1,64 @@
+﻿import os
+from pathlib import Path
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+class FileLock:
+    """Exclusive, non-blocking lock on a file, held across processes.
+
+    The OS drops the lock when its holder exits, so a lock that can be
+    taken means whoever held it before is gone.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._handle = None
+
+    @property
+    def held(self) -> bool:
+        """Return whether this object currently holds the lock."""
+        return self._handle is not None
+
+    def try_acquire(self) -> bool:
+        """Take the lock if no other holder has it; never block."""
+        if self._handle is not None:
+            return True
+        handle = open(self.path, "a+b")
+        try:
+            _lock(handle)
+        except OSError:
+            handle.close()
+            return False
+        self._handle = handle
+        return True
+
+    def release(self) -> None:
+        """Drop the lock; the lock file itself is left in place."""
+        handle, self._handle = self._handle, None
+        if handle is None:
+            return
+        try:
+            _unlock(handle)
+        except OSError:
+            pass
+        handle.close()
+
+
+def _lock(handle) -> None:
+    if os.name == "nt":
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def _unlock(handle) -> None:
+    if os.name == "nt":
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
@@ -0,0 +1,158 @@
+﻿import threading
+from collections import deque
+from dataclasses import replace
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from ..domain.config import S3Config
+from ..infrastructure.image_serializer import (
+    ENCODE_SECONDS,
+    EncodedImage,
+    EncodeOptions,
+    encode_array,
+    iter_image_arrays,
+)
+
+
+class ImageEncoder:
+    """Pooled encoder that spreads image encoding across cores."""
+
+    def __init__(self, workers: int, executor_kind: str) -> None:
+        self.workers = max(1, workers)
+        self.executor_kind = executor_kind
+        self._executor = _build_executor(self.workers, executor_kind)
+        # Bounds arrays waiting in the pool so callers cannot queue an
+        # unbounded amount of decoded pixels.
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._successor: ImageEncoder | None = None
+
+    def submit(
+        self, array: np.ndarray, options: EncodeOptions
+    ) -> Future:
+        """Encode one uint8 array in the pool."""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(encode_array, array, options)
+        except RuntimeError:
+            self._slots.release()
+            if self._successor is None:
+                raise
+            # Retired while a caller still held it; the pool is gone.
+            return self._successor.submit(array, options)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        future.add_done_callback(_observe_encode)
+        return future
+
+    def submit_with_derivatives(
+        self,
+        array: np.ndarray,
+        options: EncodeOptions,
+        derivatives: tuple[EncodeOptions, ...] = (),
+    ) -> Future:
+        """Encode an array and its derivatives in parallel as one future.
+
+        The future resolves to the original, carrying the derivatives.
+        """
+        if not derivatives:
+            return self.submit(array, options)
+        parts = [self.submit(array, item) for item in (options, *derivatives)]
+        group: Future = Future()
+        remaining = [len(parts)]
+        lock = threading.Lock()
+
+        def _part_done(_: Future) -> None:
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            try:
+                encoded = [part.result() for part in parts]
+            except Exception as exc:
+                group.set_exception(exc)
+                return
+            group.set_result(
+                replace(encoded[0], derivatives=tuple(encoded[1:]))
+            )
+
+        for part in parts:
+            part.add_done_callback(_part_done)
+        return group
+
+    def encode_images(
+        self,
+        images: Iterable,
+        options: EncodeOptions,
+        derivatives: tuple[EncodeOptions, ...] = (),
+    ) -> Iterator[EncodedImage]:
+        """Encode a batch in parallel and yield results in input order."""
+        pending: deque[Future] = deque()
+        count = 0
+        for array in iter_image_arrays(images):
+            count += 1
+            pending.append(
+                self.submit_with_derivatives(array, options, derivatives)
+            )
+            if len(pending) > self.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+        if count == 0:
+            raise ValueError("No images provided")
+
+    def retire(self, successor: "ImageEncoder") -> None:
+        """Send new work to `successor`; workers exit once queued work ends.
+
+        Callers that fetched this encoder before it was replaced keep
+        working: their submissions move to the successor.
+        """
+        self._successor = successor
+        self._executor.shutdown(wait=False)
+
+
+def _observe_encode(future: Future) -> None:
+    # Timed in the worker, recorded here so process pools report too.
+    if future.cancelled() or future.exception() is not None:
+        return
+    image = future.result()
+    ENCODE_SECONDS.observe(image.encode_seconds, format=image.extension)
+
+
+def _build_executor(workers: int, executor_kind: str) -> Executor:
+    if executor_kind == "process":
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="s3up-encode"
+    )
+
+
+_encoder_instance: ImageEncoder | None = None
+_encoder_lock = threading.Lock()
+
+
+def get_image_encoder(config: S3Config) -> ImageEncoder:
+    """Return the shared encoder, rebuilding it when its shape changes."""
+    global _encoder_instance
+    with _encoder_lock:
+        current = _encoder_instance
+        if (
+            current is None
+            or current.workers != max(1, config.encode_workers)
+            or current.executor_kind != config.encode_executor
+        ):
+            _encoder_instance = ImageEncoder(
+                workers=config.encode_workers,
+                executor_kind=config.encode_executor,
+            )
+            if current is not None:
+                current.retire(_encoder_instance)
+        return _encoder_instance
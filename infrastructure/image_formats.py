@@ -0,0 +1,123 @@
+﻿import zlib
+from dataclasses import dataclass
+from typing import Callable
+
+from PIL import features
+
+from ..domain.exceptions import DomainException
+
+_PNG_STRATEGIES = {
+    "default": zlib.Z_DEFAULT_STRATEGY,
+    "filtered": zlib.Z_FILTERED,
+    "huffman": zlib.Z_HUFFMAN_ONLY,
+    "rle": zlib.Z_RLE,
+    "fixed": zlib.Z_FIXED,
+}
+
+
+@dataclass(frozen=True)
+class ImageFormat:
+    """Describes how one output format is saved and served."""
+
+    name: str
+    pil_format: str
+    extension: str
+    content_type: str
+    supports_alpha: bool
+    save_options: Callable[[object], dict]
+    feature: str = ""
+
+    def is_available(self) -> bool:
+        """Return whether the installed Pillow can write this format."""
+        return not self.feature or bool(features.check(self.feature))
+
+
+_formats: dict[str, ImageFormat] = {}
+
+
+def register_format(image_format: ImageFormat) -> None:
+    """Register or replace an output format."""
+    _formats[image_format.name] = image_format
+
+
+def get_format(name: str) -> ImageFormat:
+    """Look up a registered, usable format by name."""
+    image_format = _formats.get(name.strip().lower())
+    if image_format is None:
+        raise DomainException(f"不支持的图像格式: {name}")
+    if not image_format.is_available():
+        raise DomainException(f"当前 Pillow 不支持 {name} 编码")
+    return image_format
+
+
+def _png_options(options) -> dict:
+    return {
+        "compress_level": options.compress_level,
+        "optimize": options.optimize,
+        "compress_type": _PNG_STRATEGIES[options.strategy],
+    }
+
+
+def _webp_options(options) -> dict:
+    return {
+        "quality": options.quality,
+        "lossless": options.lossless,
+        "method": 4,
+    }
+
+
+def _jpeg_options(options) -> dict:
+    return {
+        "quality": options.quality,
+        "optimize": options.jpeg_optimize,
+        "progressive": False,
+    }
+
+
+def _avif_options(options) -> dict:
+    quality = 100 if options.lossless else options.quality
+    return {"quality": quality, "speed": 6}
+
+
+register_format(
+    ImageFormat(
+        name="png",
+        pil_format="PNG",
+        extension="png",
+        content_type="image/png",
+        supports_alpha=True,
+        save_options=_png_options,
+    )
+)
+register_format(
+    ImageFormat(
+        name="webp",
+        pil_format="WEBP",
+        extension="webp",
+        content_type="image/webp",
+        supports_alpha=True,
+        save_options=_webp_options,
+        feature="webp",
+    )
+)
+register_format(
+    ImageFormat(
+        name="jpeg",
+        pil_format="JPEG",
+        extension="jpg",
+        content_type="image/jpeg",
+        supports_alpha=False,
+        save_options=_jpeg_options,
+    )
+)
+register_format(
+    ImageFormat(
+        name="avif",
+        pil_format="AVIF",
+        extension="avif",
+        content_type="image/avif",
+        supports_alpha=True,
+        save_options=_avif_options,
+        feature="avif",
+    )
+)
@@ -1,34 +1,200 @@
-﻿from io import BytesIO
-from typing import Iterable
+﻿import time
+from dataclasses import dataclass, replace
+from io import BytesIO
+from typing import Iterable, Iterator
 
 import numpy as np
 from PIL import Image
 
+from ..domain.checksum import PayloadChecksum
+from ..domain.config import S3Config
+from ..infrastructure.image_formats import get_format
+from ..infrastructure.metrics import get_metrics
 
-def image_tensor_to_bytes(images: Iterable) -> tuple[bytes, str]:
-    """序列化图像并返回二进制与扩展名。"""
-    image_list = list(images)
-    if not image_list:
+# Rows quantized per step; bounds the float scratch buffer to a strip.
+QUANTIZE_ROWS = 64
+
+_CONVERT_SECONDS = get_metrics().histogram(
+    "s3up_convert_seconds", "Time to convert one tensor to uint8"
+)
+ENCODE_SECONDS = get_metrics().histogram(
+    "s3up_encode_seconds", "Time to encode one image"
+)
+
+
+@dataclass(frozen=True)
+class EncodeOptions:
+    """图像编码参数。"""
+
+    image_format: str = "png"
+    quality: int = 90
+    lossless: bool = False
+    compress_level: int = 6
+    optimize: bool = False
+    strategy: str = "default"
+    jpeg_optimize: bool = False
+    checksum: str = "none"
+    max_size: int = 0
+    derivative: str = ""
+
+    @classmethod
+    def from_config(cls, config: S3Config) -> "EncodeOptions":
+        """从配置读取编码参数，并提前检查格式是否可用。"""
+        get_format(config.image_format)
+        return cls(
+            image_format=config.image_format,
+            quality=config.image_quality,
+            lossless=config.image_lossless,
+            compress_level=config.png_compress_level,
+            optimize=config.png_optimize,
+            strategy=config.png_strategy,
+            jpeg_optimize=config.jpeg_optimize,
+            checksum=config.upload_checksum,
+        )
+
+    @classmethod
+    def derivatives_from_config(
+        cls, config: S3Config
+    ) -> tuple["EncodeOptions", ...]:
+        """从配置读取各衍生图的编码参数。"""
+        base = cls.from_config(config)
+        options = []
+        for spec in config.derivative_specs():
+            get_format(spec.image_format)
+            options.append(
+                replace(
+                    base,
+                    image_format=spec.image_format,
+                    quality=spec.quality,
+                    max_size=spec.size,
+                    derivative=spec.name,
+                )
+            )
+        return tuple(options)
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """编码后的图像、耗时与上传校验和。
+
+    原图的 derivatives 中是同一数组生成的衍生图，各自带有名称。
+    """
+
+    content: bytes
+    extension: str
+    content_type: str
+    encode_seconds: float
+    checksum: PayloadChecksum | None = None
+    derivative: str = ""
+    derivatives: tuple["EncodedImage", ...] = ()
+
+
+def image_tensor_to_bytes(
+    images: Iterable,
+    options: EncodeOptions | None = None,
+    derivatives: tuple[EncodeOptions, ...] = (),
+) -> Iterator[EncodedImage]:
+    """逐张序列化批次中的图像，返回二进制与扩展名。"""
+    options = options or EncodeOptions()
+    count = 0
+    for array in iter_image_arrays(images):
+        count += 1
+        encoded = [
+            encode_array(array, item) for item in (options, *derivatives)
+        ]
+        for image in encoded:
+            ENCODE_SECONDS.observe(
+                image.encode_seconds, format=image.extension
+            )
+        yield replace(encoded[0], derivatives=tuple(encoded[1:]))
+    if count == 0:
         raise ValueError("No images provided")
-    tensor = image_list[0]
-    array = _to_numpy(tensor)
+
+
+def encode_array(array: np.ndarray, options: EncodeOptions) -> EncodedImage:
+    """按注册的格式编码 uint8 数组，可在线程池或进程池中调用。"""
+    started = time.perf_counter()
+    image_format = get_format(options.image_format)
     image = Image.fromarray(array)
+    if options.max_size:
+        # Only ever shrinks, keeping the aspect ratio.
+        image.thumbnail(
+            (options.max_size, options.max_size), Image.Resampling.LANCZOS
+        )
+    if not image_format.supports_alpha and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
     buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    return buffer.getvalue(), "png"
+    image.save(
+        buffer,
+        format=image_format.pil_format,
+        **image_format.save_options(options),
+    )
+    content = buffer.getvalue()
+    encode_seconds = time.perf_counter() - started
+    # Hashed here, in the encode pool, so neither the upload nor any
+    # retry of the spooled copy has to read the bytes for it again.
+    checksum = PayloadChecksum.compute(content, options.checksum)
+    return EncodedImage(
+        content=content,
+        extension=image_format.extension,
+        content_type=image_format.content_type,
+        encode_seconds=encode_seconds,
+        checksum=checksum,
+        derivative=options.derivative,
+    )
+
+
+def iter_image_arrays(images: Iterable) -> Iterator[np.ndarray]:
+    """Yield one uint8 HWC array per image, flattening nested batches.
+
+    Images are moved off the device one at a time, so only a single
+    image's worth of host memory is live per step.
+    """
+    for tensor in images:
+        if np.ndim(tensor) == 4:
+            for index in range(len(tensor)):
+                yield _convert(tensor[index])
+        else:
+            yield _convert(tensor)
+
+
+def _convert(tensor) -> np.ndarray:
+    with _CONVERT_SECONDS.time():
+        return to_uint8(_to_numpy(tensor))
+
+
+def to_uint8(array: np.ndarray, rows: int = QUANTIZE_ROWS) -> np.ndarray:
+    """Quantize a 0-1 float image into a preallocated uint8 buffer.
+
+    Work is done a strip of rows at a time in one reused scratch
+    buffer, and single-channel images are broadcast into RGB on
+    assignment instead of being repeated first.
+    """
+    if array.ndim == 3 and array.shape[-1] == 1:
+        out_shape = array.shape[:-1] + (3,)
+    else:
+        out_shape = array.shape
+    out = np.empty(out_shape, dtype=np.uint8)
+    if array.size == 0:
+        return out
+    rows = max(1, min(rows, array.shape[0]))
+    scratch_dtype = np.result_type(array.dtype, np.float32)
+    scratch = np.empty((rows,) + array.shape[1:], dtype=scratch_dtype)
+    for start in range(0, array.shape[0], rows):
+        stop = min(start + rows, array.shape[0])
+        strip = scratch[: stop - start]
+        np.multiply(array[start:stop], 255, out=strip, casting="unsafe")
+        np.clip(strip, 0, 255, out=strip)
+        # Assignment truncates like astype(np.uint8) did.
+        out[start:stop] = strip
+    return out
 
 
 def _to_numpy(tensor) -> np.ndarray:
+    if hasattr(tensor, "detach"):
+        tensor = tensor.detach()
     if hasattr(tensor, "cpu"):
         tensor = tensor.cpu()
     if hasattr(tensor, "numpy"):
-        array = tensor.numpy()
-    else:
-        array = np.asarray(tensor)
-    if array.ndim == 4:
-        array = array[0]
-    if array.shape[-1] == 1:
-        array = np.repeat(array, 3, axis=-1)
-    array = (array * 255).clip(0, 255).astype(np.uint8)
-    return array
-
+        return tensor.numpy()
+    return np.asarray(tensor)
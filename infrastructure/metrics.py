@@ -0,0 +1,265 @@
+﻿import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+Labels = tuple[tuple[str, str], ...]
+GaugeSamples = Iterable[tuple[dict, float]]
+
+
+def _labels(values: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in values.items()))
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._values: dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        """Add to the counter."""
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> list[tuple[Labels, float]]:
+        """Return (labels, value) pairs."""
+        with self._lock:
+            return list(self._values.items())
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram with optional labels."""
+
+    kind = "histogram"
+
+    def __init__(
+        self, name: str, help_text: str, buckets: tuple[float, ...]
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[Labels, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        """Record one observation."""
+        key = _labels(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts, then sum and count.
+                series = [[0] * len(self.buckets), 0.0, 0]
+                self._series[key] = series
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """Observe the wall time of the block, even when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list[tuple[Labels, list[int], float, int]]:
+        """Return (labels, cumulative bucket counts, sum, count)."""
+        with self._lock:
+            items = [
+                (key, list(series[0]), series[1], series[2])
+                for key, series in self._series.items()
+            ]
+        result = []
+        for key, counts, total, count in items:
+            running = 0
+            cumulative = []
+            for bucket_count in counts:
+                running += bucket_count
+                cumulative.append(running)
+            result.append((key, cumulative, total, count))
+        return result
+
+
+class Gauge:
+    """Gauge whose samples are read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(
+        self, name: str, help_text: str, collect: Callable[[], GaugeSamples]
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+
+    def samples(self) -> list[tuple[Labels, float]]:
+        """Return (labels, value) pairs; a failing callback yields none."""
+        try:
+            return [
+                (_labels(labels), float(value))
+                for labels, value in self.collect()
+            ]
+        except Exception:
+            return []
+
+
+class MetricsRegistry:
+    """Process-wide set of named metrics."""
+
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        """Return the counter with this name, creating it if needed."""
+        return self._get_or_add(name, lambda: Counter(name, help_text))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Return the histogram with this name, creating it if needed."""
+        return self._get_or_add(
+            name, lambda: Histogram(name, help_text, buckets)
+        )
+
+    def gauge(
+        self, name: str, help_text: str, collect: Callable[[], GaugeSamples]
+    ) -> Gauge:
+        """Register (or replace) a callback gauge."""
+        gauge = Gauge(name, help_text, collect)
+        with self._lock:
+            self._metrics[name] = gauge
+        return gauge
+
+    def snapshot(self) -> dict:
+        """Return every metric as a JSON-serializable dict."""
+        result = {}
+        for metric in self._all():
+            if isinstance(metric, Histogram):
+                samples = [
+                    {
+                        "labels": dict(labels),
+                        "buckets": dict(
+                            zip(_bucket_labels(metric.buckets), cumulative)
+                        ),
+                        "sum": total,
+                        "count": count,
+                    }
+                    for labels, cumulative, total, count in metric.samples()
+                ]
+            else:
+                samples = [
+                    {"labels": dict(labels), "value": value}
+                    for labels, value in metric.samples()
+                ]
+            result[metric.name] = {
+                "type": metric.kind,
+                "help": metric.help_text,
+                "samples": samples,
+            }
+        return result
+
+    def render_prometheus(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        lines: list[str] = []
+        for metric in self._all():
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if isinstance(metric, Histogram):
+                for labels, cumulative, total, count in metric.samples():
+                    for bound, value in zip(
+                        _bucket_labels(metric.buckets), cumulative
+                    ):
+                        bucket_labels = labels + (("le", bound),)
+                        lines.append(
+                            f"{metric.name}_bucket"
+                            f"{_format_labels(bucket_labels)} {value}"
+                        )
+                    inf_labels = labels + (("le", "+Inf"),)
+                    lines.append(
+                        f"{metric.name}_bucket"
+                        f"{_format_labels(inf_labels)} {count}"
+                    )
+                    lines.append(
+                        f"{metric.name}_sum{_format_labels(labels)}"
+                        f" {_format_value(total)}"
+                    )
+                    lines.append(
+                        f"{metric.name}_count{_format_labels(labels)} {count}"
+                    )
+            else:
+                for labels, value in metric.samples():
+                    lines.append(
+                        f"{metric.name}{_format_labels(labels)}"
+                        f" {_format_value(value)}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def _get_or_add(self, name: str, build: Callable):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = build()
+                self._metrics[name] = metric
+            return metric
+
+    def _all(self) -> list:
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+
+def _bucket_labels(buckets: tuple[float, ...]) -> list[str]:
+    return [_format_value(bound) for bound in buckets]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    body = ",".join(
+        f'{key}="{_escape(value)}"' for key, value in labels
+    )
+    return "{" + body + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+_registry_instance: MetricsRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRegistry:
+    """Return the singleton metrics registry."""
+    global _registry_instance
+    with _registry_lock:
+        if _registry_instance is None:
+            _registry_instance = MetricsRegistry()
+        return _registry_instance
@@ -0,0 +1,94 @@
+﻿import logging
+import queue
+import threading
+
+from ..domain.config import S3Config
+from ..domain.spool_job import SpoolJob
+from ..infrastructure.metrics import get_metrics
+from ..infrastructure.retry_targets import get_target_registry
+from ..infrastructure.s3_client import S3ClientAdapter
+
+logger = logging.getLogger(__name__)
+
+_ABORTS = get_metrics().counter(
+    "s3up_multipart_aborts_total",
+    "Abandoned multipart uploads aborted, by outcome",
+)
+
+
+class MultipartCleanup:
+    """Abort the multipart uploads of jobs that will never finish.
+
+    Jobs that go dead or are evicted from the spool may still have parts
+    stored on S3, which are billed until the upload is aborted. Aborts
+    run on one background thread so the spool path never waits on the
+    network; an abort that fails is logged and left to the bucket's
+    lifecycle rule.
+    """
+
+    def __init__(self) -> None:
+        self._queue: queue.Queue[tuple[SpoolJob, S3Config]] = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def abandon(self, job: SpoolJob, config: S3Config | None = None) -> None:
+        """Queue an abort of the job's multipart upload, if it has one."""
+        if job.multipart is None:
+            return
+        config = config or get_target_registry().resolve(job)
+        if config is None:
+            logger.warning(
+                "s3up cannot abort multipart upload %s of %s: no credentials",
+                job.multipart.upload_id,
+                job.object_key,
+            )
+            _ABORTS.inc(result="skipped")
+            return
+        self._ensure_thread()
+        self._queue.put((job, config))
+
+    def _ensure_thread(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name="s3up-multipart-cleanup",
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            job, config = self._queue.get()
+            try:
+                S3ClientAdapter(config=config).abort_multipart(
+                    job.object_key, job.multipart.upload_id
+                )
+                _ABORTS.inc(result="aborted")
+            except Exception as exc:
+                code = getattr(exc, "response", {}).get("Error", {})
+                if code.get("Code") == "NoSuchUpload":
+                    _ABORTS.inc(result="gone")
+                else:
+                    _ABORTS.inc(result="failed")
+                    logger.warning(
+                        "s3up could not abort multipart upload %s of %s: %s",
+                        job.multipart.upload_id,
+                        job.object_key,
+                        exc,
+                    )
+            finally:
+                self._queue.task_done()
+
+
+_cleanup_instance: MultipartCleanup | None = None
+_cleanup_lock = threading.Lock()
+
+
+def get_multipart_cleanup() -> MultipartCleanup:
+    """Return the singleton multipart cleanup."""
+    global _cleanup_instance
+    with _cleanup_lock:
+        if _cleanup_instance is None:
+            _cleanup_instance = MultipartCleanup()
+        return _cleanup_instance
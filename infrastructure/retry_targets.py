@@ -0,0 +1,83 @@
+﻿import threading
+from dataclasses import replace
+
+from ..domain.config import S3Config
+from ..domain.spool_job import SpoolJob
+
+TargetKey = tuple[str, str, str]
+
+
+class TargetRegistry:
+    """Configs seen per (endpoint, bucket, credential) target.
+
+    Spooled jobs only carry a credential reference, never the secret, so
+    the retry worker resolves each job back to a config registered by a
+    node call (or the environment) for the same target.
+    """
+
+    def __init__(self) -> None:
+        self._configs: dict[TargetKey, S3Config] = {}
+        self._lock = threading.Lock()
+
+    def register(self, config: S3Config) -> None:
+        """Remember the config for its target; cheap when unchanged."""
+        key = (config.endpoint, config.bucket, config.credential_ref())
+        with self._lock:
+            if self._configs.get(key) != config:
+                # Re-inserted so for_target sees the latest settings.
+                self._configs.pop(key, None)
+                self._configs[key] = config
+
+    def for_target(self, endpoint: str, bucket: str) -> S3Config | None:
+        """Return the latest config registered for a target, if any."""
+        with self._lock:
+            configs = list(self._configs.items())
+        for (key_endpoint, key_bucket, _), config in reversed(configs):
+            if key_endpoint == endpoint and key_bucket == bucket:
+                return config
+        return None
+
+    def resolve(self, job: SpoolJob) -> S3Config | None:
+        """Return the config to retry a job with, if one is known."""
+        with self._lock:
+            configs = list(self._configs.items())
+        exact = None
+        same_bucket = None
+        same_account = None
+        same_endpoint = None
+        for (endpoint, bucket, ref), config in configs:
+            if endpoint != job.endpoint:
+                continue
+            if bucket == job.bucket:
+                if ref == job.credential_ref:
+                    exact = config
+                same_bucket = same_bucket or config
+            elif ref == job.credential_ref:
+                same_account = same_account or config
+            else:
+                same_endpoint = same_endpoint or config
+        if exact is not None:
+            return exact
+        if same_account is not None:
+            # Same credentials, another bucket: reuse them for this one.
+            return replace(same_account, bucket=job.bucket)
+        if same_bucket is not None:
+            # The bucket is known under other (e.g. rotated) credentials.
+            return same_bucket
+        if not job.credential_ref and same_endpoint is not None:
+            # Jobs spooled before credential references were recorded.
+            return replace(same_endpoint, bucket=job.bucket)
+        return None
+
+
+_registry_instance: TargetRegistry | None = None
+_registry_lock = threading.Lock()
+
+
+def get_target_registry() -> TargetRegistry:
+    """Return the singleton target registry."""
+    global _registry_instance
+    with _registry_lock:
+        if _registry_instance is None:
+            _registry_instance = TargetRegistry()
+        return _registry_instance
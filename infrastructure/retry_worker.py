@@ -1,28 +1,123 @@
-﻿import threading
+﻿import os
+import threading
 import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from pathlib import Path
 
+from ..domain.backoff import backoff_delay
 from ..domain.config import S3Config
+from ..domain.exceptions import DomainException
 from ..domain.spool_job import SpoolJob
-from ..infrastructure.s3_client import S3ClientAdapter
+from ..infrastructure.circuit_breaker import (
+    CircuitBreaker,
+    get_circuit_breaker,
+)
+from ..infrastructure.metrics import get_metrics
+from ..infrastructure.multipart_cleanup import get_multipart_cleanup
+from ..infrastructure.retry_targets import TargetRegistry, get_target_registry
+from ..infrastructure.s3_client import MultipartUploadError, S3ClientAdapter
+from ..infrastructure.spool_index import target_key
 from ..infrastructure.spool_repository import SpoolRepository
+from ..infrastructure.spool_signal import SpoolSignal, get_spool_signal
+
+_RATE_WINDOW_SECONDS = 60.0
+_MIN_WAIT_SECONDS = 0.1
+# Safety net for missed inotify events, e.g. on network file systems.
+_WATCHED_POLL_SECONDS = 600.0
+_MAINTENANCE_SECONDS = 300.0
+# Longer than any single upload attempt; only matters if a holder dies.
+_LEASE_SECONDS = 900.0
+
+_RETRY_RESULTS = get_metrics().counter(
+    "s3up_retry_results_total", "Retry attempts by outcome"
+)
+_RETRY_CYCLE_SECONDS = get_metrics().histogram(
+    "s3up_retry_cycle_seconds", "Time to dispatch one pass of due jobs"
+)
+
+
+Target = tuple[str, str]
+
+
+class _LaneSlots:
+    """Count a lane's uploads in flight against a size that can change."""
+
+    def __init__(self, size: int) -> None:
+        self._lock = threading.Lock()
+        self._size = size
+        self._busy = 0
+
+    def acquire(self) -> bool:
+        """Take a slot if one is free."""
+        with self._lock:
+            if self._busy >= self._size:
+                return False
+            self._busy += 1
+            return True
+
+    def release(self) -> None:
+        """Free a slot taken by `acquire`."""
+        with self._lock:
+            self._busy -= 1
+
+    def resize(self, size: int) -> None:
+        """Change the limit; uploads already running keep their slots."""
+        with self._lock:
+            self._size = size
+
+
+@dataclass
+class _TargetLane:
+    executor: ThreadPoolExecutor
+    slots: _LaneSlots
+    size: int
 
 
 @dataclass
 class RetryWorker:
-    """Background worker to retry spooled uploads."""
+    """Background worker to retry spooled uploads.
+
+    Each job is retried against the (endpoint, bucket) it was spooled
+    for, with the config the target registry resolves for it. Every
+    target has its own lane of retry_concurrency threads, so a slow or
+    broken backend cannot starve the others.
+
+    Between passes the worker sleeps until the next job is due. The
+    spool signal wakes it early when a job is spooled or a target
+    recovers; retry_interval_seconds only matters when other processes'
+    jobs cannot be watched for.
+    """
 
     config: S3Config
-    s3_client: S3ClientAdapter
     spool_repository: SpoolRepository
+    targets: TargetRegistry = field(default_factory=get_target_registry)
     _thread: threading.Thread | None = None
     _stop_event: threading.Event = field(default_factory=threading.Event)
+    _wake: threading.Event = field(default_factory=threading.Event)
+    _watched: bool = False
+    _horizons: dict[Target, float] = field(default_factory=dict)
+    _lanes: dict[Target, _TargetLane] = field(default_factory=dict)
+    _claimed: dict[str, Target] = field(default_factory=dict)
+    _busy: dict[Target, int] = field(default_factory=dict)
+    _claim_lock: threading.Lock = field(default_factory=threading.Lock)
+    _finished_at: deque = field(default_factory=deque)
+    _succeeded: int = 0
+    _failed: int = 0
+    _maintained_at: float = 0.0
+    _owner: str = field(
+        default_factory=lambda: f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    )
 
     def start(self) -> None:
         """Start the background worker if not running."""
         if self._thread and self._thread.is_alive():
             return
         self._stop_event.clear()
+        self._signal().subscribe(self._wake)
+        self._watched = self._signal().watch()
         self._thread = threading.Thread(
             target=self._run,
             name="s3up-retry-worker",
@@ -33,68 +128,406 @@ class RetryWorker:
     def stop(self) -> None:
         """Stop the background worker."""
         self._stop_event.set()
+        self._signal().unsubscribe(self._wake)
+        self._wake.set()
         if self._thread:
             self._thread.join(timeout=1)
+        for lane in self._lanes.values():
+            lane.executor.shutdown(wait=False)
+        self._lanes.clear()
 
-    def update(
-        self,
-        config: S3Config,
-        s3_client: S3ClientAdapter,
-        spool_repository: SpoolRepository,
-    ) -> None:
-        """Update worker dependencies for new configuration values."""
-        self.config = config
-        self.s3_client = s3_client
-        self.spool_repository = spool_repository
+    def stats(self) -> dict:
+        """Return retry counters and the recent drain rate in jobs/s."""
+        with self._claim_lock:
+            now = time.monotonic()
+            self._trim_window(now)
+            return {
+                "in_flight": len(self._claimed),
+                "succeeded": self._succeeded,
+                "failed": self._failed,
+                "drain_rate": len(self._finished_at) / _RATE_WINDOW_SECONDS,
+                "targets": {
+                    target_key(*target): busy
+                    for target, busy in self._busy.items()
+                    if busy
+                },
+            }
+
+    def lease_job(self, job: SpoolJob) -> bool:
+        """Take a job in the spool index; False if another worker has it.
+
+        Worker threads in other processes, such as the drain CLI, share
+        the spool, so a job is leased before `retry_job` and released
+        after it.
+        """
+        return self.spool_repository.lease_job(
+            job, self._owner, _LEASE_SECONDS
+        )
+
+    def release_job(self, job: SpoolJob) -> None:
+        """Give up a lease that `retry_job` did not end."""
+        self.spool_repository.release_job(job, self._owner)
+
+    def retry_job(self, job: SpoolJob, config: S3Config | None = None) -> bool:
+        """Upload one job now, updating the spool and its breaker."""
+        config = config or self.targets.resolve(job)
+        if config is None:
+            raise DomainException(
+                f"没有可用于 {target_key(job.endpoint, job.bucket)} 的凭证"
+            )
+        breaker = self._breaker(job, config)
+        try:
+            self._upload(job, config)
+        except MultipartUploadError as exc:
+            breaker.record_failure()
+            # Keep the ETags of finished parts so the next attempt only
+            # sends what is still missing.
+            updated = job.with_multipart(exc.progress).increment_retry(
+                str(exc), self._backoff(job, config)
+            )
+            self._store_failure(updated, config)
+        except Exception as exc:
+            breaker.record_result(exc)
+            updated = job.increment_retry(str(exc), self._backoff(job, config))
+            self._store_failure(updated, config)
+        else:
+            if breaker.record_success():
+                self._signal().notify_recovered(job.endpoint, job.bucket)
+            self.spool_repository.delete_job(job)
+            return True
+        return False
 
     def _run(self) -> None:
         while not self._stop_event.is_set():
-            self._process_once()
-            time.sleep(self.config.retry_interval_seconds)
-
-    def _process_once(self) -> None:
-        job_paths = self.spool_repository.list_jobs()
-        for job_path in job_paths:
-            job = self.spool_repository.load_job(job_path)
-            if job.retry_count >= self.config.retry_max:
+            # Cleared before the pass, so a job finishing mid-pass wakes
+            # the next one immediately.
+            self._wake.clear()
+            with _RETRY_CYCLE_SECONDS.time():
+                started, horizons, blocked_seconds = self._process_once()
+            self._maintain()
+            self._wake.wait(
+                self._idle_seconds(started, horizons, blocked_seconds)
+            )
+
+    def _maintain(self) -> None:
+        now = time.monotonic()
+        if now - self._maintained_at < _MAINTENANCE_SECONDS:
+            return
+        self._maintained_at = now
+        try:
+            self.spool_repository.compact_segments()
+        except Exception:
+            # Compaction is best effort; it runs again next time.
+            pass
+
+    def _idle_seconds(
+        self,
+        started: float,
+        horizons: dict[Target, float],
+        blocked_seconds: float | None,
+    ) -> float:
+        # Sleep until a job the pass did not reach falls due. Jobs it left
+        # due are behind a breaker (blocked_seconds) or wait for a lane
+        # slot or their own retry in flight, and a finishing retry wakes
+        # the worker. Without a watch on the spool, poll every
+        # retry_interval_seconds for jobs spooled by other processes.
+        wait = float(self.config.retry_interval_seconds)
+        if self._watched:
+            wait = max(wait, _WATCHED_POLL_SECONDS)
+        if blocked_seconds is not None:
+            wait = min(wait, blocked_seconds)
+        next_due = self.spool_repository.next_due_at(started, horizons)
+        if next_due is not None:
+            wait = min(wait, next_due - time.time())
+        return max(_MIN_WAIT_SECONDS, wait)
+
+    def _process_once(
+        self,
+    ) -> tuple[float, dict[Target, float], float | None]:
+        """Dispatch due jobs per target.
+
+        Returns the pass time, the horizons of recovered targets (jobs due
+        before them were dispatched too) and the shortest block time.
+        """
+        # Jobs that fail during this pass are re-indexed after `started`,
+        # so they wait for a later pass.
+        started = time.time()
+        # A recovered target's jobs are taken as if their backoff had run
+        # out; after retry_backoff_max_seconds they are all due anyway.
+        for target in self._signal().take_recovered():
+            self._horizons[target] = (
+                started + self._target_config(target).retry_backoff_max_seconds
+            )
+        self._horizons = {
+            target: horizon
+            for target, horizon in self._horizons.items()
+            if horizon > started
+        }
+        horizons = dict(self._horizons)
+        for target in self.spool_repository.due_targets(started):
+            horizons.setdefault(target, started)
+        blocked: float | None = None
+        for target, horizon in horizons.items():
+            if self._stop_event.is_set():
+                break
+            wait = self._dispatch_target(target, horizon)
+            if wait is not None:
+                blocked = wait if blocked is None else min(blocked, wait)
+        return started, dict(self._horizons), blocked
+
+    def _dispatch_target(self, target: Target, now: float) -> float | None:
+        """Fill one target's free slots; return seconds it is blocked."""
+        with self._claim_lock:
+            busy = self._busy.get(target, 0)
+        target_config = self._target_config(target)
+        limit = busy + max(1, target_config.retry_concurrency) * 2
+        blocked: float | None = None
+        jobs = self.spool_repository.due_jobs_for(*target, now, limit)
+        for job in jobs:
+            if not self._claim(job.job_id, target):
                 continue
-            self._retry_job(job)
+            config = self.targets.resolve(job)
+            if config is None:
+                # No node has registered credentials for this target yet.
+                self._release(job.job_id)
+                blocked = float(target_config.retry_interval_seconds)
+                continue
+            if job.retry_count >= config.retry_max:
+                self._mark_dead(job, config)
+                self._release(job.job_id)
+                continue
+            lane = self._lane(target, config.retry_concurrency)
+            if not lane.slots.acquire():
+                # The lane is full; a finishing job wakes the worker.
+                self._release(job.job_id)
+                return blocked
+            # Lease before taking the breaker's probe, so a job another
+            # process holds never keeps a half-open breaker waiting.
+            if not self._try_lease(job):
+                lane.slots.release()
+                self._release(job.job_id)
+                continue
+            breaker = self._breaker(job, config)
+            if not breaker.try_probe():
+                self._try_release_lease(job)
+                lane.slots.release()
+                self._release(job.job_id)
+                # Half open: the probe in flight is one of ours and wakes
+                # the worker when it finishes; a failed probe reopens the
+                # breaker for reset_seconds.
+                return breaker.seconds_until_probe() or breaker.reset_seconds
+            lane.executor.submit(
+                self._run_claimed, job, config, breaker, lane.slots
+            )
+        if blocked is None and len(jobs) == limit:
+            # A full page went by without filling the lane, e.g. jobs
+            # that were marked dead; look again right away for the rest.
+            return 0.0
+        return blocked
+
+    def _target_config(self, target: Target) -> S3Config:
+        # Lane sizes and backoff caps follow the node settings for that
+        # target; the worker's own config covers targets none has set.
+        return self.targets.for_target(*target) or self.config
 
-    def _retry_job(self, job: SpoolJob) -> None:
-        if job.retry_count > 0:
-            # Simple backoff to reduce repeated bursts.
-            time.sleep(self.config.retry_backoff_seconds)
+    def _lane(self, target: Target, size: int) -> _TargetLane:
+        size = max(1, size)
+        lane = self._lanes.get(target)
+        if lane is not None and lane.size == size:
+            return lane
+        executor = ThreadPoolExecutor(
+            max_workers=size, thread_name_prefix="s3up-retry"
+        )
+        if lane is None:
+            lane = _TargetLane(executor, _LaneSlots(size), size)
+        else:
+            # The old pool finishes what it has; those uploads still hold
+            # slots, so old and new together stay within the new size.
+            lane.executor.shutdown(wait=False)
+            lane.slots.resize(size)
+            lane = _TargetLane(executor, lane.slots, size)
+        self._lanes[target] = lane
+        return lane
+
+    def _try_lease(self, job: SpoolJob) -> bool:
         try:
-            self.s3_client.upload_file(job.file_path, job.object_key)
-            self.spool_repository.delete_job(job)
-        except Exception as exc:
-            updated = job.increment_retry(str(exc))
-            self.spool_repository.write_job(updated)
+            return self.lease_job(job)
+        except Exception:
+            # The index is busy; the job stays due for the next pass.
+            return False
+
+    def _try_release_lease(self, job: SpoolJob) -> None:
+        try:
+            self.release_job(job)
+        except Exception:
+            # The lease runs out on its own after _LEASE_SECONDS.
+            pass
+
+    def _run_claimed(
+        self,
+        job: SpoolJob,
+        config: S3Config,
+        breaker: CircuitBreaker,
+        slots: _LaneSlots,
+    ) -> None:
+        try:
+            self._record(self.retry_job(job, config))
+        except Exception:
+            # The spool write itself failed; the job stays due. If no
+            # result reached the breaker, its probe goes to the next job.
+            breaker.release_probe()
+        finally:
+            self._try_release_lease(job)
+            self._release(job.job_id)
+            slots.release()
+            self._wake.set()
+
+    def _upload(self, job: SpoolJob, config: S3Config) -> None:
+        s3_client = S3ClientAdapter(config=config)
+        with self.spool_repository.open_payload(job) as body:
+            s3_client.upload_stream(
+                body,
+                job.object_key,
+                job.content_type,
+                job.multipart,
+                job.checksum,
+            )
+
+    def _signal(self) -> SpoolSignal:
+        return get_spool_signal(self.spool_repository.base_dir)
 
+    def _breaker(self, job: SpoolJob, config: S3Config) -> CircuitBreaker:
+        return get_circuit_breaker(config, job.endpoint, job.bucket)
 
-_worker_instance: RetryWorker | None = None
+    def _backoff(self, job: SpoolJob, config: S3Config) -> float:
+        return backoff_delay(
+            job.retry_count + 1,
+            config.retry_backoff_seconds,
+            config.retry_backoff_max_seconds,
+        )
+
+    def _store_failure(self, job: SpoolJob, config: S3Config) -> None:
+        if not self.spool_repository.has_job(job.job_id):
+            # Evicted by the spool quota while it was uploading.
+            return
+        if job.retry_count >= config.retry_max:
+            self._mark_dead(job, config)
+        else:
+            self.spool_repository.write_job(job)
+
+    def _mark_dead(self, job: SpoolJob, config: S3Config) -> None:
+        # A dead job is never resumed, so its stored parts are aborted; a
+        # manual drain of dead jobs starts a fresh upload.
+        get_multipart_cleanup().abandon(job, config)
+        self.spool_repository.mark_dead(job.with_multipart(None))
+        _RETRY_RESULTS.inc(result="dead")
+
+    def _claim(self, job_id: str, target: Target) -> bool:
+        with self._claim_lock:
+            if job_id in self._claimed:
+                return False
+            self._claimed[job_id] = target
+            self._busy[target] = self._busy.get(target, 0) + 1
+            return True
+
+    def _release(self, job_id: str) -> None:
+        with self._claim_lock:
+            target = self._claimed.pop(job_id, None)
+            if target is not None:
+                self._busy[target] -= 1
+
+    def _record(self, succeeded: bool) -> None:
+        with self._claim_lock:
+            now = time.monotonic()
+            if succeeded:
+                self._succeeded += 1
+                self._finished_at.append(now)
+            else:
+                self._failed += 1
+            self._trim_window(now)
+        _RETRY_RESULTS.inc(result="success" if succeeded else "failure")
+
+    def _trim_window(self, now: float) -> None:
+        while (
+            self._finished_at
+            and now - self._finished_at[0] > _RATE_WINDOW_SECONDS
+        ):
+            self._finished_at.popleft()
+
+
+_workers: dict[Path, RetryWorker] = {}
 _worker_lock = threading.Lock()
 
 
-def get_retry_worker(
-    config: S3Config,
-    s3_client: S3ClientAdapter,
-    spool_repository: SpoolRepository,
-) -> RetryWorker:
-    """Return a singleton retry worker."""
-    global _worker_instance
+def get_retry_worker(config: S3Config) -> RetryWorker:
+    """Return the retry worker for the config's spool directory.
+
+    The config is registered as credentials and settings for its target,
+    and becomes the worker's default for spool-wide settings such as
+    retry_interval_seconds; the worker itself is built once per spool.
+    """
+    get_target_registry().register(config)
+    key = config.spool_dir.resolve()
     with _worker_lock:
-        if _worker_instance is None:
-            _worker_instance = RetryWorker(
-                config=config,
-                s3_client=s3_client,
-                spool_repository=spool_repository,
-            )
+        worker = _workers.get(key)
+        if worker is not None:
+            if worker.config != config:
+                worker.config = config
+                # The sleep in progress was sized with the old settings.
+                worker._wake.set()
         else:
-            _worker_instance.update(
+            worker = RetryWorker(
                 config=config,
-                s3_client=s3_client,
-                spool_repository=spool_repository,
+                spool_repository=SpoolRepository.from_config(config),
             )
-        return _worker_instance
+            if not _workers:
+                _register_gauges()
+            _workers[key] = worker
+        return worker
+
+
+def _register_gauges() -> None:
+    metrics = get_metrics()
+    metrics.gauge(
+        "s3up_spool_jobs",
+        "Jobs in the spool by state",
+        lambda: [
+            sample
+            for spool_dir, worker in _all_workers()
+            for sample in _spool_samples(spool_dir, worker.spool_repository)
+        ],
+    )
+    metrics.gauge(
+        "s3up_retry_in_flight",
+        "Retries currently uploading, per target",
+        lambda: [
+            ({"target": target}, busy)
+            for _, worker in _all_workers()
+            for target, busy in worker.stats()["targets"].items()
+        ],
+    )
+    metrics.gauge(
+        "s3up_retry_drain_rate",
+        "Jobs retried successfully per second over the last minute",
+        lambda: [
+            ({"spool": str(spool_dir)}, worker.stats()["drain_rate"])
+            for spool_dir, worker in _all_workers()
+        ],
+    )
+
+
+def _all_workers() -> list[tuple[Path, RetryWorker]]:
+    with _worker_lock:
+        return list(_workers.items())
+
 
+def _spool_samples(
+    spool_dir: Path, spool_repository: SpoolRepository
+) -> list[tuple]:
+    total = spool_repository.count_jobs()
+    dead = spool_repository.count_dead_jobs()
+    spool = str(spool_dir)
+    return [
+        ({"spool": spool, "state": "pending"}, total - dead),
+        ({"spool": spool, "state": "dead"}, dead),
+    ]
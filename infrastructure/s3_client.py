@@ -1,55 +1,268 @@
-﻿import boto3
+﻿import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import BinaryIO, Callable, Iterator
 
+from ..domain.checksum import PayloadChecksum
 from ..domain.config import S3Config
+from ..domain.multipart import MultipartProgress
+from ..infrastructure.metrics import get_metrics
+from ..infrastructure.s3_client_pool import get_client_pool
+
+_MB = 1024 * 1024
+_MAX_PARTS = 10000
+
+_UPLOAD_SECONDS = get_metrics().histogram(
+    "s3up_upload_seconds", "Time to upload one object to S3"
+)
+_UPLOAD_BYTES = get_metrics().counter(
+    "s3up_upload_bytes_total", "Bytes uploaded to S3"
+)
+_UPLOAD_ERRORS = get_metrics().counter(
+    "s3up_upload_errors_total", "Failed S3 uploads"
+)
+
+
+class MultipartUploadError(Exception):
+    """Raised when a multipart upload stops with parts still missing."""
+
+    def __init__(self, message: str, progress: MultipartProgress) -> None:
+        super().__init__(message)
+        self.progress = progress
 
 
 @dataclass(frozen=True)
 class S3ClientAdapter:
-    """S3 client adapter using boto3."""
+    """S3 client adapter over boto3 or the built-in SigV4 client."""
 
     config: S3Config
 
-    def upload_bytes(self, content: bytes, object_key: str) -> str:
+    def upload_bytes(
+        self,
+        content: bytes,
+        object_key: str,
+        content_type: str = "",
+        progress: MultipartProgress | None = None,
+        checksum: PayloadChecksum | None = None,
+    ) -> str:
         """Upload bytes and return ETag."""
-        response = self._client().put_object(
-            Bucket=self.config.bucket,
-            Key=object_key,
-            Body=content,
-        )
+        size = len(content)
+        if self._use_multipart(size, progress):
+
+            def read_part(offset: int, length: int) -> bytes:
+                return content[offset : offset + length]
+
+            with _observe_upload(size, "multipart"):
+                return self._upload_multipart(
+                    size, read_part, object_key, content_type, progress
+                )
+        with _observe_upload(size, "put"):
+            response = self._client().put_object(
+                Body=content,
+                **self._put_args(object_key, content_type, checksum),
+            )
         return response.get("ETag", "")
 
-    def upload_file(self, file_path: str, object_key: str) -> str:
+    def upload_file(
+        self,
+        file_path: str,
+        object_key: str,
+        content_type: str = "",
+        progress: MultipartProgress | None = None,
+        checksum: PayloadChecksum | None = None,
+    ) -> str:
         """Upload file path and return ETag."""
         with open(file_path, "rb") as handle:
+            return self.upload_stream(
+                handle, object_key, content_type, progress, checksum
+            )
+
+    def upload_stream(
+        self,
+        body: BinaryIO,
+        object_key: str,
+        content_type: str = "",
+        progress: MultipartProgress | None = None,
+        checksum: PayloadChecksum | None = None,
+    ) -> str:
+        """Upload a seekable stream from its current position; return ETag.
+
+        With a precomputed checksum the body is read once, sequentially,
+        while it is sent; nothing hashes it beforehand.
+        """
+        start = body.tell()
+        size = body.seek(0, os.SEEK_END) - start
+        body.seek(start)
+        if self._use_multipart(size, progress):
+            lock = threading.Lock()
+
+            def read_part(offset: int, length: int) -> bytes:
+                with lock:
+                    body.seek(start + offset)
+                    return body.read(length)
+
+            with _observe_upload(size, "multipart"):
+                return self._upload_multipart(
+                    size, read_part, object_key, content_type, progress
+                )
+        with _observe_upload(size, "put"):
             response = self._client().put_object(
+                Body=body,
+                ContentLength=size,
+                **self._put_args(object_key, content_type, checksum),
+            )
+        return response.get("ETag", "")
+
+    def abort_multipart(self, object_key: str, upload_id: str) -> None:
+        """Abort a multipart upload so its stored parts are deleted."""
+        self._client().abort_multipart_upload(
+            Bucket=self.config.bucket, Key=object_key, UploadId=upload_id
+        )
+
+    def object_exists(self, object_key: str) -> bool:
+        """Return whether an object is present, via HEAD."""
+        try:
+            self._client().head_object(
+                Bucket=self.config.bucket, Key=object_key
+            )
+        except Exception as exc:
+            response = getattr(exc, "response", None)
+            if isinstance(response, dict):
+                code = response.get("Error", {}).get("Code", "")
+                if code in ("404", "NoSuchKey", "NotFound"):
+                    return False
+            raise
+        return True
+
+    def _use_multipart(
+        self, size: int, progress: MultipartProgress | None
+    ) -> bool:
+        if progress is not None:
+            return True
+        return size >= self.config.multipart_threshold_mb * _MB
+
+    def _upload_multipart(
+        self,
+        size: int,
+        read_part: Callable[[int, int], bytes],
+        object_key: str,
+        content_type: str,
+        progress: MultipartProgress | None,
+    ) -> str:
+        client = self._client()
+        if progress is not None:
+            try:
+                return self._send_parts(
+                    client, size, read_part, object_key, progress
+                )
+            except MultipartUploadError:
+                raise
+            except client.exceptions.NoSuchUpload:
+                # The upload was aborted or expired; start over. Abort it
+                # anyway in case a part landed after S3 reported it gone.
+                try:
+                    self.abort_multipart(object_key, progress.upload_id)
+                except Exception:
+                    pass
+        part_size = max(
+            self.config.multipart_chunk_mb * _MB,
+            math.ceil(size / _MAX_PARTS),
+        )
+        created = client.create_multipart_upload(
+            **self._put_args(object_key, content_type)
+        )
+        progress = MultipartProgress(
+            upload_id=created["UploadId"], part_size=part_size
+        )
+        return self._send_parts(client, size, read_part, object_key, progress)
+
+    def _send_parts(
+        self,
+        client,
+        size: int,
+        read_part: Callable[[int, int], bytes],
+        object_key: str,
+        progress: MultipartProgress,
+    ) -> str:
+        part_count = max(1, math.ceil(size / progress.part_size))
+        done = progress.completed_numbers()
+        missing = [n for n in range(1, part_count + 1) if n not in done]
+        uploaded: dict[int, str] = {}
+        errors: list[str] = []
+
+        def send(number: int) -> str:
+            offset = (number - 1) * progress.part_size
+            response = client.upload_part(
+                Bucket=self.config.bucket,
+                Key=object_key,
+                UploadId=progress.upload_id,
+                PartNumber=number,
+                Body=read_part(offset, progress.part_size),
+            )
+            return response["ETag"]
+
+        workers = max(1, min(self.config.multipart_concurrency, len(missing)))
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="s3up-part"
+        ) as executor:
+            futures = {executor.submit(send, n): n for n in missing}
+            for future in as_completed(futures):
+                try:
+                    uploaded[futures[future]] = future.result()
+                except client.exceptions.NoSuchUpload:
+                    raise
+                except Exception as exc:
+                    errors.append(str(exc))
+        progress = progress.with_parts(uploaded)
+        if errors:
+            raise MultipartUploadError(errors[0], progress)
+        try:
+            response = client.complete_multipart_upload(
                 Bucket=self.config.bucket,
                 Key=object_key,
-                Body=handle,
+                UploadId=progress.upload_id,
+                MultipartUpload={
+                    "Parts": [
+                        {"PartNumber": number, "ETag": etag}
+                        for number, etag in progress.parts
+                    ]
+                },
             )
+        except client.exceptions.NoSuchUpload:
+            raise
+        except Exception as exc:
+            raise MultipartUploadError(str(exc), progress) from exc
         return response.get("ETag", "")
 
-    def _client(self):
-        session = boto3.session.Session()
-        return session.client(
-            "s3",
-            endpoint_url=self._endpoint_url(),
-            region_name=self.config.region,
-            aws_access_key_id=self.config.access_key_id,
-            aws_secret_access_key=self.config.secret_access_key,
-            use_ssl=self.config.use_ssl,
-            config=boto3.session.Config(
-                s3={"addressing_style": self._addressing_style()}
-            ),
-        )
+    def _put_args(
+        self,
+        object_key: str,
+        content_type: str,
+        checksum: PayloadChecksum | None = None,
+    ) -> dict:
+        args = {"Bucket": self.config.bucket, "Key": object_key}
+        if content_type:
+            args["ContentType"] = content_type
+        if checksum is not None:
+            # botocore skips its own checksum pass when one is supplied.
+            args.update(checksum.request_args())
+        return args
 
-    def _endpoint_url(self) -> str | None:
-        if not self.config.endpoint:
-            return None
-        return self.config.endpoint
+    def _client(self):
+        return get_client_pool().get(self.config)
 
-    def _addressing_style(self) -> str:
-        if self.config.force_path_style:
-            return "path"
-        return "virtual"
 
+@contextmanager
+def _observe_upload(size: int, method: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        _UPLOAD_ERRORS.inc(method=method)
+        raise
+    _UPLOAD_SECONDS.observe(time.perf_counter() - started, method=method)
+    _UPLOAD_BYTES.inc(size, method=method)
@@ -0,0 +1,163 @@
+﻿import threading
+import time
+from dataclasses import dataclass
+
+from ..domain.config import S3Config
+from ..infrastructure.sigv4_client import SigV4Client
+
+DEFAULT_IDLE_SECONDS = 300
+DEFAULT_MAX_AGE_SECONDS = 3600
+MIN_POOL_CONNECTIONS = 10
+
+
+@dataclass(frozen=True)
+class ClientKey:
+    """Connection-relevant config fields that identify a shared client."""
+
+    endpoint: str
+    region: str
+    access_key_id: str
+    secret_access_key: str
+    use_ssl: bool
+    force_path_style: bool
+    transport: str
+
+    @classmethod
+    def from_config(cls, config: S3Config) -> "ClientKey":
+        """Build the cache key for a config."""
+        return cls(
+            endpoint=config.endpoint,
+            region=config.region,
+            access_key_id=config.access_key_id,
+            secret_access_key=config.secret_access_key,
+            use_ssl=config.use_ssl,
+            force_path_style=config.force_path_style,
+            transport=config.transport,
+        )
+
+
+@dataclass
+class _PooledClient:
+    client: object
+    max_connections: int
+    created_at: float
+    last_used_at: float
+
+
+class S3ClientPool:
+    """Thread-safe, process-wide cache of keep-alive S3 clients."""
+
+    def __init__(
+        self,
+        idle_seconds: float = DEFAULT_IDLE_SECONDS,
+        max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS,
+    ) -> None:
+        self._idle_seconds = idle_seconds
+        self._max_age_seconds = max_age_seconds
+        self._clients: dict[ClientKey, _PooledClient] = {}
+        self._lock = threading.Lock()
+
+    def get(self, config: S3Config):
+        """Return a shared client for the config, building it if needed."""
+        key = ClientKey.from_config(config)
+        max_connections = pool_size(config)
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._clients.get(key)
+            if entry is None or entry.max_connections < max_connections:
+                # Grow by replacing; callers still holding the old client
+                # keep using it until they drop the reference.
+                entry = _PooledClient(
+                    client=_build_client(key, max_connections),
+                    max_connections=max_connections,
+                    created_at=now,
+                    last_used_at=now,
+                )
+                self._clients[key] = entry
+            entry.last_used_at = now
+            return entry.client
+
+    def clear(self) -> None:
+        """Drop every cached client."""
+        with self._lock:
+            self._clients.clear()
+
+    def _evict(self, now: float) -> None:
+        # Evicted clients are only dereferenced, never closed, so an upload
+        # that is still running on one is not cut off.
+        expired = [
+            key
+            for key, entry in self._clients.items()
+            if now - entry.last_used_at > self._idle_seconds
+            or now - entry.created_at > self._max_age_seconds
+        ]
+        for key in expired:
+            del self._clients[key]
+
+
+def pool_size(config: S3Config) -> int:
+    """Size the urllib3 pool for upload, retry and part concurrency."""
+    wanted = (
+        config.upload_concurrency
+        + config.retry_concurrency
+        + config.multipart_concurrency
+    )
+    return max(MIN_POOL_CONNECTIONS, wanted)
+
+
+def _build_client(key: ClientKey, max_connections: int):
+    if key.transport == "native":
+        return SigV4Client(
+            endpoint=key.endpoint,
+            region=key.region,
+            access_key_id=key.access_key_id,
+            secret_access_key=key.secret_access_key,
+            use_ssl=key.use_ssl,
+            force_path_style=key.force_path_style,
+            max_connections=max_connections,
+        )
+    # Imported here so loading the plugin, and the native transport, do
+    # not pay for importing boto3.
+    import boto3
+
+    session = boto3.session.Session()
+    return session.client(
+        "s3",
+        endpoint_url=key.endpoint or None,
+        region_name=key.region,
+        aws_access_key_id=key.access_key_id,
+        aws_secret_access_key=key.secret_access_key,
+        use_ssl=key.use_ssl,
+        config=boto3.session.Config(
+            max_pool_connections=max_connections,
+            tcp_keepalive=True,
+            s3={
+                "addressing_style": _addressing_style(key),
+                # Integrity comes from TLS and, when S3_UPLOAD_CHECKSUM
+                # is set, the signed x-amz-checksum header; hashing the
+                # body again for SigV4 would cost a second full read of
+                # every payload. Plain HTTP is always signed by botocore.
+                "payload_signing_enabled": False,
+            },
+        ),
+    )
+
+
+def _addressing_style(key: ClientKey) -> str:
+    if key.force_path_style:
+        return "path"
+    return "virtual"
+
+
+_pool_instance: S3ClientPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_client_pool() -> S3ClientPool:
+    """Return the singleton client pool."""
+    global _pool_instance
+    with _pool_lock:
+        if _pool_instance is None:
+            _pool_instance = S3ClientPool()
+        return _pool_instance
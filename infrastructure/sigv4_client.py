@@ -0,0 +1,469 @@
+﻿import datetime
+import hashlib
+import hmac
+import http.client
+import random
+import threading
+import time
+from urllib.parse import quote, urlsplit
+from xml.etree import ElementTree
+
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+
+_MAX_ATTEMPTS = 3
+_BACKOFF_SECONDS = 0.1
+_RETRY_STATUSES = {500, 502, 503, 504}
+_BLOCK_SIZE = 64 * 1024
+_CHECKSUM_HEADERS = {
+    "ChecksumCRC32": "x-amz-checksum-crc32",
+    "ChecksumSHA256": "x-amz-checksum-sha256",
+}
+
+
+class NativeClientError(Exception):
+    """An S3 error response, shaped like botocore's ClientError.
+
+    `response` carries the same Error and ResponseMetadata keys, so the
+    circuit breaker and callers classify it the same way.
+    """
+
+    def __init__(
+        self, operation: str, code: str, message: str, status: int
+    ) -> None:
+        super().__init__(
+            f"An error occurred ({code}) when calling the {operation}"
+            f" operation: {message}"
+        )
+        self.response = {
+            "Error": {"Code": code, "Message": message},
+            "ResponseMetadata": {"HTTPStatusCode": status},
+        }
+
+
+class NoSuchUpload(NativeClientError):
+    """The multipart upload was aborted or has expired."""
+
+
+class _Exceptions:
+    NoSuchUpload = NoSuchUpload
+
+
+class _ConnectionPool:
+    """LIFO pool of keep-alive connections to one host."""
+
+    def __init__(
+        self,
+        scheme: str,
+        host: str,
+        port: int | None,
+        size: int,
+        timeout: float,
+    ) -> None:
+        self._scheme = scheme
+        self._host = host
+        self._port = port
+        self._size = max(1, size)
+        self._timeout = timeout
+        self._idle: list[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+
+    def acquire(self) -> http.client.HTTPConnection:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        if self._scheme == "https":
+            return http.client.HTTPSConnection(
+                self._host,
+                self._port,
+                timeout=self._timeout,
+                blocksize=_BLOCK_SIZE,
+            )
+        return http.client.HTTPConnection(
+            self._host,
+            self._port,
+            timeout=self._timeout,
+            blocksize=_BLOCK_SIZE,
+        )
+
+    def release(self, connection: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+
+class SigV4Client:
+    """Minimal S3 client speaking SigV4 over pooled http.client connections.
+
+    It implements the part of the boto3 S3 client API that
+    S3ClientAdapter uses (put_object, head_object and the multipart
+    calls, abort included) with the same argument names and response
+    keys. There are no event hooks or handler chains: a call is one
+    signature and one request. Bodies are sent as UNSIGNED-PAYLOAD, like
+    the boto3 client is configured to, and 5xx and SlowDown replies are
+    retried twice.
+    """
+
+    exceptions = _Exceptions
+
+    def __init__(
+        self,
+        endpoint: str,
+        region: str,
+        access_key_id: str,
+        secret_access_key: str,
+        use_ssl: bool = True,
+        force_path_style: bool = False,
+        max_connections: int = 10,
+        timeout: float = 60.0,
+    ) -> None:
+        scheme = "https" if use_ssl else "http"
+        if endpoint:
+            if "://" not in endpoint:
+                endpoint = f"{scheme}://{endpoint}"
+            parts = urlsplit(endpoint)
+            scheme = parts.scheme
+            self._host = parts.hostname or ""
+            self._port = parts.port
+        else:
+            self._host = f"s3.{region}.amazonaws.com"
+            self._port = None
+        self._scheme = scheme
+        self._region = region
+        self._access_key_id = access_key_id
+        self._secret_access_key = secret_access_key
+        self._force_path_style = force_path_style
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._pools: dict[str, _ConnectionPool] = {}
+        self._pools_lock = threading.Lock()
+        self._signing_keys: dict[str, bytes] = {}
+
+    def put_object(
+        self,
+        Bucket: str,
+        Key: str,
+        Body=b"",
+        ContentLength: int | None = None,
+        ContentType: str = "",
+        ChecksumCRC32: str = "",
+        ChecksumSHA256: str = "",
+    ) -> dict:
+        """Upload one object from bytes or a seekable stream."""
+        headers = self._checksum_headers(ChecksumCRC32, ChecksumSHA256)
+        if ContentType:
+            headers["content-type"] = ContentType
+        reply = self._request(
+            "PutObject",
+            "PUT",
+            Bucket,
+            Key,
+            headers=headers,
+            body=Body,
+            length=ContentLength,
+        )
+        return {"ETag": reply.getheader("ETag", "")}
+
+    def head_object(self, Bucket: str, Key: str) -> dict:
+        """Return the object's size and ETag, or raise with a 404 code."""
+        reply = self._request("HeadObject", "HEAD", Bucket, Key)
+        return {
+            "ContentLength": int(reply.getheader("Content-Length", "0")),
+            "ETag": reply.getheader("ETag", ""),
+        }
+
+    def create_multipart_upload(
+        self, Bucket: str, Key: str, ContentType: str = ""
+    ) -> dict:
+        """Start a multipart upload and return its UploadId."""
+        headers = {"content-type": ContentType} if ContentType else {}
+        reply = self._request(
+            "CreateMultipartUpload",
+            "POST",
+            Bucket,
+            Key,
+            query={"uploads": ""},
+            headers=headers,
+        )
+        return {"UploadId": _xml_text(reply.body, "UploadId")}
+
+    def upload_part(
+        self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body
+    ) -> dict:
+        """Upload one part and return its ETag."""
+        reply = self._request(
+            "UploadPart",
+            "PUT",
+            Bucket,
+            Key,
+            query={"partNumber": str(PartNumber), "uploadId": UploadId},
+            body=Body,
+        )
+        return {"ETag": reply.getheader("ETag", "")}
+
+    def abort_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str
+    ) -> dict:
+        """Abort a multipart upload, deleting its stored parts."""
+        self._request(
+            "AbortMultipartUpload",
+            "DELETE",
+            Bucket,
+            Key,
+            query={"uploadId": UploadId},
+        )
+        return {}
+
+    def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict
+    ) -> dict:
+        """Assemble the uploaded parts into the final object."""
+        parts = "".join(
+            f"<Part><PartNumber>{part['PartNumber']}</PartNumber>"
+            f"<ETag>{_escape(part['ETag'])}</ETag></Part>"
+            for part in MultipartUpload["Parts"]
+        )
+        body = (
+            f"<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>"
+        ).encode("utf-8")
+        reply = self._request(
+            "CompleteMultipartUpload",
+            "POST",
+            Bucket,
+            Key,
+            query={"uploadId": UploadId},
+            body=body,
+        )
+        # S3 can report a failed completion inside a 200 response.
+        _raise_for_error("CompleteMultipartUpload", 200, reply.body)
+        return {"ETag": _xml_text(reply.body, "ETag")}
+
+    def _request(
+        self,
+        operation: str,
+        method: str,
+        bucket: str,
+        key: str,
+        query: dict | None = None,
+        headers: dict | None = None,
+        body=None,
+        length: int | None = None,
+    ) -> "_Reply":
+        host, path = self._address(bucket, key)
+        query = query or {}
+        headers = dict(headers or {})
+        start = None
+        if body is not None:
+            if hasattr(body, "read"):
+                start = body.tell()
+                if length is None:
+                    length = body.seek(0, 2) - start
+            else:
+                length = len(body)
+            headers["content-length"] = str(length)
+        payload_hash = UNSIGNED_PAYLOAD if body is not None else EMPTY_SHA256
+        url = path + _query_string(query, canonical=False)
+        for attempt in range(1, _MAX_ATTEMPTS + 1):
+            if start is not None:
+                body.seek(start)
+            signed = self._sign(
+                method, host, path, query, headers, payload_hash
+            )
+            try:
+                reply = self._send(host, method, url, signed, body)
+            except (OSError, http.client.HTTPException):
+                if attempt == _MAX_ATTEMPTS:
+                    raise
+            else:
+                if reply.status not in _RETRY_STATUSES:
+                    break
+                if attempt == _MAX_ATTEMPTS:
+                    break
+            time.sleep(_BACKOFF_SECONDS * 2 ** attempt * random.random())
+        if reply.status >= 300:
+            _raise_for_error(operation, reply.status, reply.body, reply.reason)
+        return reply
+
+    def _send(
+        self, host: str, method: str, url: str, headers: dict, body
+    ) -> "_Reply":
+        pool = self._pool(host)
+        connection = pool.acquire()
+        try:
+            connection.request(method, url, body=body, headers=headers)
+            response = connection.getresponse()
+            reply = _Reply(
+                status=response.status,
+                reason=response.reason,
+                headers=response.headers,
+                body=response.read(),
+            )
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            pool.release(connection)
+        return reply
+
+    def _sign(
+        self,
+        method: str,
+        host: str,
+        path: str,
+        query: dict,
+        headers: dict,
+        payload_hash: str,
+    ) -> dict:
+        amz_date = datetime.datetime.now(datetime.timezone.utc).strftime(
+            "%Y%m%dT%H%M%SZ"
+        )
+        datestamp = amz_date[:8]
+        signed = {name.lower(): str(value) for name, value in headers.items()}
+        signed["host"] = host
+        signed["x-amz-date"] = amz_date
+        signed["x-amz-content-sha256"] = payload_hash
+        # Every header sent is signed, as botocore does.
+        names = sorted(signed)
+        canonical_request = "\n".join(
+            [
+                method,
+                path,
+                _query_string(query, canonical=True),
+                "".join(f"{name}:{signed[name].strip()}\n" for name in names),
+                ";".join(names),
+                payload_hash,
+            ]
+        )
+        scope = f"{datestamp}/{self._region}/s3/aws4_request"
+        string_to_sign = "\n".join(
+            [
+                "AWS4-HMAC-SHA256",
+                amz_date,
+                scope,
+                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest(),
+            ]
+        )
+        signature = hmac.new(
+            self._signing_key(datestamp),
+            string_to_sign.encode("utf-8"),
+            hashlib.sha256,
+        ).hexdigest()
+        signed["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self._access_key_id}/{scope},"
+            f" SignedHeaders={';'.join(names)}, Signature={signature}"
+        )
+        return signed
+
+    def _signing_key(self, datestamp: str) -> bytes:
+        key = self._signing_keys.get(datestamp)
+        if key is None:
+            key = f"AWS4{self._secret_access_key}".encode("utf-8")
+            for part in (datestamp, self._region, "s3", "aws4_request"):
+                key = hmac.new(
+                    key, part.encode("utf-8"), hashlib.sha256
+                ).digest()
+            # One key per day; the previous day's is no longer needed.
+            self._signing_keys = {datestamp: key}
+        return key
+
+    def _address(self, bucket: str, key: str) -> tuple[str, str]:
+        quoted = quote(key, safe="/~")
+        host = self._host
+        if self._port is not None:
+            host = f"{host}:{self._port}"
+        if self._force_path_style or "." in bucket:
+            return host, f"/{bucket}/{quoted}"
+        return f"{bucket}.{host}", f"/{quoted}"
+
+    def _pool(self, host: str) -> _ConnectionPool:
+        with self._pools_lock:
+            pool = self._pools.get(host)
+            if pool is None:
+                name, _, port = host.partition(":")
+                pool = _ConnectionPool(
+                    self._scheme,
+                    name,
+                    int(port) if port else None,
+                    self._max_connections,
+                    self._timeout,
+                )
+                self._pools[host] = pool
+            return pool
+
+    def _checksum_headers(self, crc32: str, sha256: str) -> dict:
+        values = {"ChecksumCRC32": crc32, "ChecksumSHA256": sha256}
+        return {
+            _CHECKSUM_HEADERS[param]: value
+            for param, value in values.items()
+            if value
+        }
+
+
+class _Reply:
+    """Status, headers and fully read body of one response."""
+
+    def __init__(self, status: int, reason: str, headers, body: bytes) -> None:
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name: str, default: str = "") -> str:
+        return self.headers.get(name, default)
+
+
+def _query_string(query: dict, canonical: bool) -> str:
+    if not query:
+        return ""
+    pairs = "&".join(
+        f"{quote(name, safe='-_.~')}={quote(value, safe='-_.~')}"
+        if value or canonical
+        else quote(name, safe="-_.~")
+        for name, value in sorted(query.items())
+    )
+    return pairs if canonical else f"?{pairs}"
+
+
+def _raise_for_error(
+    operation: str, status: int, body: bytes, reason: str = ""
+) -> None:
+    code, message = "", ""
+    if body:
+        try:
+            root = ElementTree.fromstring(body)
+        except ElementTree.ParseError:
+            root = None
+        if root is None or _local(root.tag) != "Error":
+            if status < 300:
+                return
+        else:
+            code = _xml_text(body, "Code")
+            message = _xml_text(body, "Message")
+    elif status < 300:
+        return
+    # HEAD replies have no body; botocore reports the status as the code.
+    code = code or str(status)
+    error = NoSuchUpload if code == "NoSuchUpload" else NativeClientError
+    raise error(operation, code, message or reason, status)
+
+
+def _xml_text(body: bytes, tag: str) -> str:
+    root = ElementTree.fromstring(body)
+    for element in root.iter():
+        if _local(element.tag) == tag:
+            return element.text or ""
+    return ""
+
+
+def _local(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+def _escape(text: str) -> str:
+    return (
+        text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    )
@@ -0,0 +1,68 @@
+﻿import importlib
+import importlib.util
+import zlib
+from dataclasses import dataclass
+from typing import Callable
+
+from ..domain.exceptions import DomainException
+
+
+@dataclass(frozen=True)
+class SpoolCodec:
+    """How spooled payloads are compressed on disk."""
+
+    name: str
+    compress: Callable[[bytes], bytes]
+    decompress: Callable[[bytes], bytes]
+    module: str = ""
+
+    def is_available(self) -> bool:
+        """Return whether the codec's optional module is installed."""
+        if not self.module:
+            return True
+        return importlib.util.find_spec(self.module) is not None
+
+
+_codecs: dict[str, SpoolCodec] = {}
+
+
+def register_codec(codec: SpoolCodec) -> None:
+    """Register or replace a spool codec."""
+    _codecs[codec.name] = codec
+
+
+def get_codec(name: str) -> SpoolCodec:
+    """Look up a registered, usable codec by name."""
+    codec = _codecs.get(name.strip().lower())
+    if codec is None:
+        raise DomainException(f"不支持的暂存压缩方式: {name}")
+    if not codec.is_available():
+        raise DomainException(f"使用 {name} 压缩需要安装 {codec.module}")
+    return codec
+
+
+def _zstd_compress(content: bytes) -> bytes:
+    zstandard = importlib.import_module("zstandard")
+    return zstandard.ZstdCompressor(level=3).compress(content)
+
+
+def _zstd_decompress(content: bytes) -> bytes:
+    zstandard = importlib.import_module("zstandard")
+    return zstandard.ZstdDecompressor().decompress(content)
+
+
+register_codec(
+    SpoolCodec(
+        name="zlib",
+        compress=lambda content: zlib.compress(content, 6),
+        decompress=zlib.decompress,
+    )
+)
+register_codec(
+    SpoolCodec(
+        name="zstd",
+        compress=_zstd_compress,
+        decompress=_zstd_decompress,
+        module="zstandard",
+    )
+)
@@ -0,0 +1,442 @@
+﻿import json
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS jobs ("
+    " job_id TEXT PRIMARY KEY,"
+    " due_at REAL,"
+    " payload TEXT NOT NULL"
+    ")",
+    # Dead jobs have a NULL due_at and never enter the due index.
+    "CREATE INDEX IF NOT EXISTS jobs_due ON jobs(due_at)"
+    " WHERE due_at IS NOT NULL",
+)
+_SEGMENT_SCHEMA = (
+    "CREATE INDEX IF NOT EXISTS jobs_segment ON jobs(segment)"
+    " WHERE segment IS NOT NULL",
+)
+_TARGET_SCHEMA = (
+    "CREATE INDEX IF NOT EXISTS jobs_target_due ON jobs(target, due_at)"
+    " WHERE due_at IS NOT NULL",
+    # Jobs per target, kept by triggers, so finding the due targets is
+    # one index probe per target instead of a scan of every due job.
+    "CREATE TABLE IF NOT EXISTS targets ("
+    " target TEXT PRIMARY KEY,"
+    " jobs INTEGER NOT NULL"
+    ")",
+    "CREATE TRIGGER IF NOT EXISTS targets_insert AFTER INSERT ON jobs"
+    " BEGIN INSERT INTO targets (target, jobs) VALUES (NEW.target, 1)"
+    " ON CONFLICT(target) DO UPDATE SET jobs = jobs + 1; END",
+    "CREATE TRIGGER IF NOT EXISTS targets_delete AFTER DELETE ON jobs"
+    " BEGIN UPDATE targets SET jobs = jobs - 1 WHERE target = OLD.target;"
+    " DELETE FROM targets WHERE target = OLD.target AND jobs <= 0; END",
+    "CREATE TRIGGER IF NOT EXISTS targets_update"
+    " AFTER UPDATE OF target ON jobs WHEN OLD.target IS NOT NEW.target"
+    " BEGIN UPDATE targets SET jobs = jobs - 1 WHERE target = OLD.target;"
+    " DELETE FROM targets WHERE target = OLD.target AND jobs <= 0;"
+    " INSERT INTO targets (target, jobs) VALUES (NEW.target, 1)"
+    " ON CONFLICT(target) DO UPDATE SET jobs = jobs + 1; END",
+)
+_TARGET_BACKFILL = (
+    "INSERT INTO targets (target, jobs)"
+    " SELECT target, COUNT(*) FROM jobs GROUP BY target"
+)
+_QUOTA_SCHEMA = (
+    "CREATE INDEX IF NOT EXISTS jobs_created ON jobs(created)",
+    "CREATE INDEX IF NOT EXISTS jobs_priority ON jobs(priority, created)",
+    # Usage is kept by triggers in the same transaction as each write,
+    # so quota checks never have to sum the table.
+    "CREATE TABLE IF NOT EXISTS usage ("
+    " id INTEGER PRIMARY KEY CHECK (id = 0),"
+    " jobs INTEGER NOT NULL,"
+    " bytes INTEGER NOT NULL"
+    ")",
+    "INSERT OR IGNORE INTO usage (id, jobs, bytes)"
+    " SELECT 0, COUNT(*), COALESCE(SUM(size), 0) FROM jobs",
+    "CREATE TRIGGER IF NOT EXISTS usage_insert AFTER INSERT ON jobs BEGIN"
+    " UPDATE usage SET jobs = jobs + 1,"
+    " bytes = bytes + COALESCE(NEW.size, 0) WHERE id = 0; END",
+    "CREATE TRIGGER IF NOT EXISTS usage_delete AFTER DELETE ON jobs BEGIN"
+    " UPDATE usage SET jobs = jobs - 1,"
+    " bytes = bytes - COALESCE(OLD.size, 0) WHERE id = 0; END",
+    "CREATE TRIGGER IF NOT EXISTS usage_update AFTER UPDATE OF size ON jobs"
+    " BEGIN UPDATE usage SET"
+    " bytes = bytes - COALESCE(OLD.size, 0) + COALESCE(NEW.size, 0)"
+    " WHERE id = 0; END",
+)
+# A lease moves due_at to its expiry and keeps the real due time aside,
+# so a leased job is not due for anyone else and falls due again if its
+# holder dies.
+_LEASE_COLUMNS = {
+    "leased_by": "TEXT",
+    "leased_due_at": "REAL",
+}
+_DERIVED_COLUMNS = {
+    "target": "TEXT",
+    "size": "INTEGER",
+    "priority": "INTEGER",
+    "created": "REAL",
+}
+_EVICTION_ORDER = {
+    "dead-first": "(due_at IS NOT NULL), created",
+    "oldest-first": "created",
+    "lowest-priority-first": "priority, created",
+}
+
+
+class SpoolIndex:
+    """SQLite (WAL) index of spool jobs ordered by due time."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(path), check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Writes arrive in group commits, so a full sync per transaction
+        # is affordable and keeps committed jobs across power loss.
+        self._conn.execute("PRAGMA synchronous=FULL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        columns = {
+            row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")
+        }
+        if "segment" not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN segment TEXT")
+        for statement in _SEGMENT_SCHEMA:
+            self._conn.execute(statement)
+        for name, kind in _LEASE_COLUMNS.items():
+            if name not in columns:
+                self._conn.execute(
+                    f"ALTER TABLE jobs ADD COLUMN {name} {kind}"
+                )
+        missing = [name for name in _DERIVED_COLUMNS if name not in columns]
+        for name in missing:
+            self._conn.execute(
+                f"ALTER TABLE jobs ADD COLUMN {name} {_DERIVED_COLUMNS[name]}"
+            )
+        if missing:
+            self._backfill()
+        # Immediate, so two processes opening an old index cannot both
+        # count its targets.
+        self._conn.execute("BEGIN IMMEDIATE")
+        count_targets = not self._has_table("targets")
+        for statement in _TARGET_SCHEMA + _QUOTA_SCHEMA:
+            self._conn.execute(statement)
+        if count_targets:
+            self._conn.execute(_TARGET_BACKFILL)
+        self._conn.execute("COMMIT")
+
+    def put(self, job_id: str, payload: dict, due_at: float | None) -> None:
+        """Insert or replace one job row."""
+        self.put_many([(job_id, payload, due_at)])
+
+    def put_many(
+        self, rows: list[tuple[str, dict, float | None]]
+    ) -> None:
+        """Insert or replace several job rows in one transaction."""
+        self.apply(rows, [])
+
+    def delete(self, job_id: str) -> None:
+        """Remove a job row if present."""
+        self.apply([], [job_id])
+
+    def delete_many(self, job_ids: list[str]) -> None:
+        """Remove several job rows in one transaction."""
+        self.apply([], job_ids)
+
+    def apply(
+        self,
+        rows: list[tuple[str, dict, float | None]],
+        deletes: list[str],
+    ) -> None:
+        """Upsert rows and delete ids in a single transaction."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # An upsert rather than REPLACE, so the usage triggers see
+                # an UPDATE instead of a silent delete. Rewriting a job
+                # ends any lease on it.
+                self._conn.executemany(
+                    "INSERT INTO jobs"
+                    " (job_id, due_at, payload, segment, target, size,"
+                    " priority, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT(job_id) DO UPDATE SET"
+                    " due_at = excluded.due_at, payload = excluded.payload,"
+                    " segment = excluded.segment, target = excluded.target,"
+                    " size = excluded.size, priority = excluded.priority,"
+                    " created = excluded.created, leased_by = NULL,"
+                    " leased_due_at = NULL",
+                    [
+                        (job_id, due_at, json.dumps(payload))
+                        + _derived(payload)
+                        for job_id, payload, due_at in rows
+                    ],
+                )
+                self._conn.executemany(
+                    "DELETE FROM jobs WHERE job_id = ?",
+                    [(job_id,) for job_id in deletes],
+                )
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def lease(
+        self, job_id: str, owner: str, now: float, until: float
+    ) -> bool:
+        """Hold a job for `owner` until `until`; False if someone else is.
+
+        Jobs that are not due yet or dead can be leased too, which is how
+        the drain CLI takes them.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET"
+                " leased_due_at = CASE WHEN leased_by IS NULL"
+                " THEN due_at ELSE leased_due_at END,"
+                " leased_by = ?, due_at = ?"
+                " WHERE job_id = ? AND (leased_by IS NULL"
+                " OR leased_by = ? OR due_at <= ?)",
+                (owner, until, job_id, owner, now),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, job_id: str, owner: str) -> bool:
+        """End `owner`'s lease, restoring the job's own due time."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET due_at = leased_due_at,"
+                " leased_by = NULL, leased_due_at = NULL"
+                " WHERE job_id = ? AND leased_by = ?",
+                (job_id, owner),
+            )
+        return cursor.rowcount == 1
+
+    def all_jobs(self) -> list[dict]:
+        """Return every job payload, live or dead."""
+        with self._lock:
+            rows = self._conn.execute("SELECT payload FROM jobs").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def page(
+        self, after_id: str, limit: int, include_dead: bool
+    ) -> list[dict]:
+        """Return up to `limit` jobs with ids after `after_id`, by id."""
+        query = "SELECT payload FROM jobs WHERE job_id > ?"
+        if not include_dead:
+            query += " AND due_at IS NOT NULL"
+        with self._lock:
+            rows = self._conn.execute(
+                query + " ORDER BY job_id LIMIT ?", (after_id, limit)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def due(self, now: float, limit: int) -> list[dict]:
+        """Return up to `limit` live jobs due at `now`, earliest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT payload FROM jobs"
+                " WHERE due_at IS NOT NULL AND due_at <= ?"
+                " ORDER BY due_at LIMIT ?",
+                (now, limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def due_targets(self, now: float) -> list[str]:
+        """Return the targets that have live jobs due at `now`."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT target FROM targets WHERE ("
+                " SELECT MIN(due_at) FROM jobs WHERE jobs.target ="
+                " targets.target AND due_at IS NOT NULL) <= ?",
+                (now,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def due_for_target(
+        self, target: str, now: float, limit: int
+    ) -> list[dict]:
+        """Return up to `limit` due jobs of one target, earliest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT payload FROM jobs"
+                " WHERE target = ? AND due_at IS NOT NULL AND due_at <= ?"
+                " ORDER BY due_at LIMIT ?",
+                (target, now, limit),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def next_due(
+        self, after: float = -1.0, bounds: dict[str, float] | None = None
+    ) -> float | None:
+        """Return the earliest due time among live jobs due after `after`.
+
+        `bounds` replaces `after` for the targets it names.
+        """
+        with self._lock:
+            if not bounds:
+                row = self._conn.execute(
+                    "SELECT MIN(due_at) FROM jobs"
+                    " WHERE due_at IS NOT NULL AND due_at > ?",
+                    (after,),
+                ).fetchone()
+                return row[0]
+            targets = self._conn.execute(
+                "SELECT target FROM targets"
+            ).fetchall()
+            times = []
+            for (target,) in targets:
+                row = self._conn.execute(
+                    "SELECT MIN(due_at) FROM jobs WHERE target = ?"
+                    " AND due_at IS NOT NULL AND due_at > ?",
+                    (target, bounds.get(target, after)),
+                ).fetchone()
+                if row[0] is not None:
+                    times.append(row[0])
+        return min(times, default=None)
+
+    def get(self, job_id: str) -> dict | None:
+        """Return one job payload by id."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def segment_jobs(self, segment: str) -> list[tuple[dict, float | None]]:
+        """Return (payload, due_at) for every job stored in a segment."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT payload, due_at FROM jobs WHERE segment = ?",
+                (segment,),
+            ).fetchall()
+        return [(json.loads(payload), due_at) for payload, due_at in rows]
+
+    def segment_in_use(self, segment: str) -> bool:
+        """Return whether any job still references a segment."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM jobs WHERE segment = ? LIMIT 1", (segment,)
+            ).fetchone()
+        return row is not None
+
+    def count(self) -> int:
+        """Return the number of indexed jobs, live or dead."""
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()
+        return int(row[0])
+
+    def usage(self) -> tuple[int, int]:
+        """Return (jobs, payload bytes) currently in the spool."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT jobs, bytes FROM usage WHERE id = 0"
+            ).fetchone()
+        return int(row[0]), int(row[1])
+
+    def eviction_candidates(self, policy: str, limit: int) -> list[dict]:
+        """Return up to `limit` jobs in the order a policy evicts them."""
+        order = _EVICTION_ORDER[policy]
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT payload FROM jobs ORDER BY {order} LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def count_dead(self) -> int:
+        """Return the number of dead jobs."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE due_at IS NULL"
+            ).fetchone()
+        return int(row[0])
+
+    def _has_table(self, name: str) -> bool:
+        row = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,),
+        ).fetchone()
+        return row is not None
+
+    def _backfill(self) -> None:
+        rows = self._conn.execute(
+            "SELECT job_id, payload FROM jobs"
+        ).fetchall()
+        updates = []
+        for job_id, payload in rows:
+            data = json.loads(payload)
+            segment, target, size, priority, created = _derived(data)
+            if not size and not data.get("payload_length"):
+                # Rows from before sizes were recorded: ask the file.
+                try:
+                    size = os.path.getsize(data["file_path"])
+                except OSError:
+                    size = 0
+            updates.append((segment, target, size, priority, created, job_id))
+        self._conn.execute("BEGIN")
+        self._conn.executemany(
+            "UPDATE jobs SET segment = ?, target = ?, size = ?,"
+            " priority = ?, created = ? WHERE job_id = ?",
+            updates,
+        )
+        self._conn.execute("COMMIT")
+
+
+def target_key(endpoint: str, bucket: str) -> str:
+    """Return the index key for an (endpoint, bucket) target."""
+    # Bucket names cannot contain "@", so the split is unambiguous.
+    return f"{bucket}@{endpoint}"
+
+
+def split_target(target: str) -> tuple[str, str]:
+    """Return (endpoint, bucket) for an index target key."""
+    bucket, _, endpoint = target.partition("@")
+    return endpoint, bucket
+
+
+def _derived(payload: dict) -> tuple:
+    """Return (segment, target, size, priority, created) for a row."""
+    return (
+        _segment(payload),
+        target_key(payload["endpoint"], payload["bucket"]),
+        payload.get("stored_bytes") or payload.get("payload_length") or 0,
+        payload.get("priority", 0),
+        _created(payload),
+    )
+
+
+def _created(payload: dict) -> float:
+    try:
+        return datetime.fromisoformat(payload["created_at"]).timestamp()
+    except (KeyError, ValueError):
+        return 0.0
+
+
+def _segment(payload: dict) -> str | None:
+    if payload.get("payload_length") is None:
+        return None
+    return Path(payload["file_path"]).name
+
+
+_indexes: dict[Path, SpoolIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_spool_index(path: Path, on_create=None) -> SpoolIndex:
+    """Return the shared index for a path, running `on_create` once."""
+    key = path.resolve()
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = SpoolIndex(key)
+            if on_create is not None:
+                on_create(index)
+            _indexes[key] = index
+        return index
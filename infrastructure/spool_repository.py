@@ -1,10 +1,51 @@
 ﻿import json
+import io
+import logging
+import re
+import time
 import uuid
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Iterable
+from typing import BinaryIO, Iterator
 
+from ..domain.config import S3Config
 from ..domain.spool_job import SpoolJob
+from ..infrastructure.metrics import get_metrics
+from ..infrastructure.multipart_cleanup import get_multipart_cleanup
+from ..infrastructure.spool_compression import get_codec
+from ..infrastructure.spool_index import (
+    SpoolIndex,
+    get_spool_index,
+    split_target,
+    target_key,
+)
+from ..infrastructure.spool_segments import SegmentStore, get_segment_store
+from ..infrastructure.spool_signal import get_spool_signal
+from ..infrastructure.spool_writer import (
+    GroupCommitWriter,
+    get_spool_writer,
+    temp_path_for,
+)
+
+_MIGRATE_BATCH = 500
+# Files younger than this may belong to a writer in another process.
+_ORPHAN_GRACE_SECONDS = 900
+_MB = 1024 * 1024
+_EVICT_BATCH = 64
+# Payload file names as written by every spool version: uuid4 hex + ext.
+_PAYLOAD_NAME = re.compile(r"[0-9a-f]{32}\.[A-Za-z0-9.]+")
+
+logger = logging.getLogger(__name__)
+
+_SPOOL_WRITE_SECONDS = get_metrics().histogram(
+    "s3up_spool_write_seconds", "Time to durably spool one image"
+)
+_SPOOLED_BYTES = get_metrics().counter(
+    "s3up_spooled_bytes_total", "Bytes written to the spool"
+)
+_EVICTED = get_metrics().counter(
+    "s3up_spool_evicted_total", "Jobs evicted to keep the spool in quota"
+)
 
 
 @dataclass(frozen=True)
@@ -12,56 +53,403 @@ class SpoolRepository:
     """Persist and load spool jobs and files."""
 
     base_dir: Path
+    layout: str = "files"
+    segment_bytes: int = 64 * _MB
+    max_bytes: int = 0
+    max_jobs: int = 0
+    eviction: str = "dead-first"
+    compression: str = "none"
+
+    @classmethod
+    def from_config(cls, config: S3Config) -> "SpoolRepository":
+        """Build a repository for the configured spool directory."""
+        if config.spool_compression != "none":
+            get_codec(config.spool_compression)
+        return cls(
+            base_dir=config.spool_dir,
+            layout=config.spool_layout,
+            segment_bytes=config.spool_segment_mb * _MB,
+            max_bytes=config.spool_max_mb * _MB,
+            max_jobs=config.spool_max_jobs,
+            eviction=config.spool_eviction,
+            compression=config.spool_compression,
+        )
+
+    def save_job(self, image_bytes: bytes, job: SpoolJob) -> SpoolJob:
+        """Persist image bytes and job metadata to disk."""
+        stored, job = self._pack(image_bytes, job)
+        with _SPOOL_WRITE_SECONDS.time(layout=self.layout):
+            if self.layout == "segments":
+                saved = self._save_to_segment(stored, job)
+            else:
+                saved = self._save_to_file(stored, job)
+        _SPOOLED_BYTES.inc(len(stored))
+        self._enforce_quota()
+        get_spool_signal(self.base_dir).notify_spooled()
+        return saved
+
+    def read_payload(self, job: SpoolJob) -> bytes:
+        """Return the spooled payload of a job, decompressed."""
+        stored = self._read_stored(job)
+        if job.compression:
+            return get_codec(job.compression).decompress(stored)
+        return stored
+
+    def open_payload(self, job: SpoolJob) -> BinaryIO:
+        """Open a job's payload as a seekable stream for uploading.
+
+        Segment payloads are served from the segment mmap and plain files
+        from their handle, so the payload is only read while it is sent.
+        Compressed payloads are decompressed into memory first.
+        """
+        if job.compression:
+            return io.BytesIO(self.read_payload(job))
+        if job.in_segment():
+            return self._segments().open(
+                Path(job.file_path), job.payload_offset, job.payload_length
+            )
+        return open(job.file_path, "rb")
+
+    def has_job(self, job_id: str) -> bool:
+        """Return whether a job is still in the spool."""
+        return self._index().get(job_id) is not None
+
+    def usage(self) -> tuple[int, int]:
+        """Return (jobs, stored bytes) in the spool, live or dead."""
+        return self._index().usage()
 
-    def save_job(self, image_bytes: bytes, job: SpoolJob) -> SpoolJob:
-        """Persist image bytes and job metadata to disk."""
-        self._ensure_dirs()
-        file_id = uuid.uuid4().hex
-        safe_ext = job.file_ext.lstrip(".") or "bin"
-        file_path = self._files_dir() / f"{file_id}.{safe_ext}"
-        job_path = self._jobs_dir() / f"{job.job_id}.json"
-        file_path.write_bytes(image_bytes)
-        updated = SpoolJob(
-            job_id=job.job_id,
-            object_key=job.object_key,
-            bucket=job.bucket,
-            endpoint=job.endpoint,
-            file_path=str(file_path),
-            file_ext=safe_ext,
-            retry_count=job.retry_count,
-            last_error=job.last_error,
-            created_at=job.created_at,
-        )
-        job_path.write_text(json.dumps(updated.to_dict()), encoding="utf-8")
+    def _pack(
+        self, image_bytes: bytes, job: SpoolJob
+    ) -> tuple[bytes, SpoolJob]:
+        stored = image_bytes
+        compression = ""
+        if self.compression != "none":
+            packed = get_codec(self.compression).compress(image_bytes)
+            # Encoded images are often compressed already; keep the smaller.
+            if len(packed) < len(image_bytes):
+                stored = packed
+                compression = self.compression
+        return stored, replace(
+            job, compression=compression, stored_bytes=len(stored)
+        )
+
+    def _read_stored(self, job: SpoolJob) -> bytes:
+        if job.in_segment():
+            return self._segments().read(
+                Path(job.file_path), job.payload_offset, job.payload_length
+            )
+        return Path(job.file_path).read_bytes()
+
+    def _enforce_quota(self) -> None:
+        if not self.max_bytes and not self.max_jobs:
+            return
+        index = self._index()
+        evicted = 0
+        while True:
+            jobs, used = index.usage()
+            over_jobs = jobs - self.max_jobs if self.max_jobs else 0
+            over_bytes = used - self.max_bytes if self.max_bytes else 0
+            if over_jobs <= 0 and over_bytes <= 0:
+                break
+            victims = index.eviction_candidates(
+                self.eviction, max(over_jobs, _EVICT_BATCH)
+            )
+            if not victims:
+                break
+            for payload in victims:
+                victim = SpoolJob.from_dict(payload)
+                self.delete_job(victim)
+                get_multipart_cleanup().abandon(victim)
+                evicted += 1
+                over_jobs -= 1
+                over_bytes -= victim.stored_bytes
+                if over_jobs <= 0 and over_bytes <= 0:
+                    break
+        if evicted:
+            _EVICTED.inc(evicted, policy=self.eviction)
+            logger.warning(
+                "s3up spool over quota, evicted %d job(s) (%s)",
+                evicted,
+                self.eviction,
+            )
+
+    def _save_to_file(
+        self, image_bytes: bytes, job: SpoolJob, dead: bool = False
+    ) -> SpoolJob:
+        self._ensure_dirs()
+        file_id = uuid.uuid4().hex
+        safe_ext = job.file_ext.lstrip(".") or "bin"
+        file_name = f"{file_id}.{safe_ext}"
+        if job.compression:
+            file_name = f"{file_name}.{job.compression}"
+        file_path = self._files_dir() / file_name
+        temp_path = temp_path_for(file_path)
+        temp_path.write_bytes(image_bytes)
+        updated = replace(
+            job,
+            file_path=str(file_path),
+            file_ext=safe_ext,
+            payload_offset=0,
+            payload_length=None,
+        )
+        due_at = None if dead else updated.due_timestamp()
+        # The payload is fsynced and renamed before its index row commits,
+        # so the index never points at a missing or partial file.
+        self._writer().commit(
+            renames=[(temp_path, file_path)],
+            rows=[(updated.job_id, updated.to_dict(), due_at)],
+        )
+        return updated
+
+    def _save_to_segment(self, image_bytes: bytes, job: SpoolJob) -> SpoolJob:
+        segments = self._segments()
+        segment, offset = segments.append(image_bytes)
+        updated = replace(
+            job,
+            file_path=str(segment),
+            file_ext=job.file_ext.lstrip(".") or "bin",
+            payload_offset=offset,
+            payload_length=len(image_bytes),
+        )
+        try:
+            self._writer().commit(
+                rows=[
+                    (
+                        updated.job_id,
+                        updated.to_dict(),
+                        updated.due_timestamp(),
+                    )
+                ],
+                syncs=[segment],
+            )
+        finally:
+            segments.settle(segment)
         return updated
 
-    def list_jobs(self) -> Iterable[Path]:
-        """Return job file paths currently in the spool."""
-        if not self._jobs_dir().exists():
-            return []
-        return list(self._jobs_dir().glob("*.json"))
+    def due_jobs(self, now: float, limit: int) -> list[SpoolJob]:
+        """Return up to `limit` live jobs due at `now`, oldest due first."""
+        return [
+            SpoolJob.from_dict(payload)
+            for payload in self._index().due(now, limit)
+        ]
+
+    def due_targets(self, now: float) -> list[tuple[str, str]]:
+        """Return the (endpoint, bucket) targets with jobs due at `now`."""
+        return [split_target(key) for key in self._index().due_targets(now)]
+
+    def due_jobs_for(
+        self, endpoint: str, bucket: str, now: float, limit: int
+    ) -> list[SpoolJob]:
+        """Return up to `limit` due jobs of one target, oldest due first."""
+        return [
+            SpoolJob.from_dict(payload)
+            for payload in self._index().due_for_target(
+                target_key(endpoint, bucket), now, limit
+            )
+        ]
+
+    def iter_jobs(
+        self, include_dead: bool = False, page_size: int = 1000
+    ) -> Iterator[SpoolJob]:
+        """Yield every live (or also dead) job, paging through the index."""
+        after_id = ""
+        while True:
+            page = self._index().page(after_id, page_size, include_dead)
+            if not page:
+                return
+            for payload in page:
+                yield SpoolJob.from_dict(payload)
+            after_id = page[-1]["job_id"]
+
+    def next_due_at(
+        self,
+        after: float = -1.0,
+        bounds: dict[tuple[str, str], float] | None = None,
+    ) -> float | None:
+        """Return when the next live job due after `after` becomes due.
 
-    def load_job(self, job_path: Path) -> SpoolJob:
-        """Load a job from a JSON file."""
-        payload = json.loads(job_path.read_text(encoding="utf-8"))
-        return SpoolJob.from_dict(payload)
+        `bounds` maps (endpoint, bucket) targets to their own `after`.
+        """
+        return self._index().next_due(
+            after,
+            {
+                target_key(*target): bound
+                for target, bound in (bounds or {}).items()
+            },
+        )
+
+    def count_jobs(self) -> int:
+        """Return how many jobs are in the spool, live or dead."""
+        return self._index().count()
+
+    def count_dead_jobs(self) -> int:
+        """Return how many jobs ran out of retries."""
+        return self._index().count_dead()
 
     def write_job(self, job: SpoolJob) -> None:
-        """Update a job JSON file in the spool."""
-        job_path = self._jobs_dir() / f"{job.job_id}.json"
-        job_path.write_text(json.dumps(job.to_dict()), encoding="utf-8")
+        """Update a job in the spool index."""
+        self._writer().commit(
+            rows=[(job.job_id, job.to_dict(), job.due_timestamp())]
+        )
+
+    def mark_dead(self, job: SpoolJob) -> None:
+        """Keep a job on disk but drop it from the due index."""
+        self._writer().commit(rows=[(job.job_id, job.to_dict(), None)])
+
+    def lease_job(self, job: SpoolJob, owner: str, seconds: float) -> bool:
+        """Hold a job for `owner` so no other process retries it too.
+
+        Writing or deleting the job ends the lease; so does its expiry,
+        in case the holder dies.
+        """
+        now = time.time()
+        return self._index().lease(job.job_id, owner, now, now + seconds)
+
+    def release_job(self, job: SpoolJob, owner: str) -> None:
+        """End a lease that no write of the job has ended."""
+        if self._index().release(job.job_id, owner):
+            get_spool_signal(self.base_dir).notify_spooled()
 
     def delete_job(self, job: SpoolJob) -> None:
         """Remove job and associated file from disk."""
-        job_path = self._jobs_dir() / f"{job.job_id}.json"
+        # Row first: a crash before the unlink leaves an orphan file that
+        # recovery removes, never a row without its payload.
+        self._writer().commit(deletes=[job.job_id])
         file_path = Path(job.file_path)
-        if job_path.exists():
-            job_path.unlink()
-        if file_path.exists():
+        if job.in_segment():
+            self._collect_segment(file_path)
+        elif file_path.exists():
             file_path.unlink()
 
+    def compact_segments(self) -> None:
+        """Free sealed segments pinned only by dead jobs.
+
+        Dead jobs are never retried, so their payloads are moved out to
+        plain files and the segment is deleted. Segments with live jobs
+        are left alone and drain normally.
+        """
+        index = self._index()
+        for segment in self._segments().sealed_segments():
+            jobs = index.segment_jobs(segment.name)
+            if any(due_at is not None for _, due_at in jobs):
+                continue
+            for payload, _ in jobs:
+                job = SpoolJob.from_dict(payload)
+                # Written dead in one step, so the move never makes the
+                # job due for the retry worker.
+                self._save_to_file(self._read_stored(job), job, dead=True)
+            self._collect_segment(segment)
+
+    def _collect_segment(self, segment: Path) -> None:
+        if not self._index().segment_in_use(segment.name):
+            self._segments().discard(segment)
+
+    def _index(self) -> SpoolIndex:
+        return get_spool_index(
+            self.base_dir / "index.sqlite3", self._open_index
+        )
+
+    def _segments(self) -> SegmentStore:
+        return get_segment_store(self._segments_dir(), self.segment_bytes)
+
+    def _writer(self) -> GroupCommitWriter:
+        return get_spool_writer(self._index())
+
+    def _open_index(self, index: SpoolIndex) -> None:
+        self._migrate_json_jobs(index)
+        self._recover(index)
+
+    def _recover(self, index: SpoolIndex) -> None:
+        # Reconcile what a crash may have left behind: rows whose payload
+        # is gone, and payload or temp files that no row references.
+        files_dir = self._files_dir()
+        referenced: set[str] = set()
+        missing: list[str] = []
+        for payload in index.all_jobs():
+            file_path = Path(payload["file_path"])
+            if file_path.exists():
+                referenced.add(file_path.name)
+            else:
+                missing.append(payload["job_id"])
+        if missing:
+            index.delete_many(missing)
+        # Segments go by their seal, not their age: an idle process can
+        # keep an old, still unreferenced segment open for appends.
+        segments = self._segments()
+        for segment in segments.sealed_segments():
+            if segment.name not in referenced:
+                segments.discard(segment)
+        jobs_dir = self._jobs_dir()
+        if jobs_dir.exists() and any(jobs_dir.glob("*.json")):
+            # Legacy job files that could not be migrated may still own
+            # payloads in files/, so those are not orphans yet.
+            return
+        if not files_dir.exists():
+            return
+        cutoff = time.time() - _ORPHAN_GRACE_SECONDS
+        for entry in files_dir.iterdir():
+            if entry.name in referenced:
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    entry.unlink()
+            except OSError:
+                continue
+
+    def _migrate_json_jobs(self, index: SpoolIndex) -> None:
+        # Spools written before the index kept one JSON file per job.
+        jobs_dir = self._jobs_dir()
+        if not jobs_dir.exists():
+            return
+        rows = []
+        paths = []
+        for job_path in jobs_dir.glob("*.json"):
+            try:
+                payload = json.loads(job_path.read_text(encoding="utf-8"))
+                job = SpoolJob.from_dict(payload)
+            except OSError:
+                logger.warning(
+                    "s3up could not read legacy spool job %s; "
+                    "leaving it in place",
+                    job_path,
+                )
+                continue
+            except (ValueError, KeyError, TypeError):
+                self._quarantine(job_path)
+                continue
+            rows.append((job.job_id, job.to_dict(), job.due_timestamp()))
+            paths.append(job_path)
+            if len(rows) >= _MIGRATE_BATCH:
+                _commit_migrated(index, rows, paths)
+        _commit_migrated(index, rows, paths)
+
+    def _quarantine(self, job_path: Path) -> None:
+        # A job file that no longer parses still names its payload, so the
+        # two are moved aside together instead of the payload being swept
+        # as an orphan by _recover.
+        quarantine_dir = self.base_dir / "quarantine"
+        try:
+            text = job_path.read_text(encoding="utf-8", errors="replace")
+            quarantine_dir.mkdir(parents=True, exist_ok=True)
+            for name in set(_PAYLOAD_NAME.findall(text)):
+                payload_path = self._files_dir() / name
+                if payload_path.exists():
+                    payload_path.replace(quarantine_dir / name)
+            job_path.replace(quarantine_dir / job_path.name)
+        except OSError:
+            logger.warning(
+                "s3up could not quarantine corrupt spool job %s; "
+                "leaving it in place",
+                job_path,
+            )
+            return
+        logger.warning(
+            "s3up moved corrupt spool job %s to %s",
+            job_path.name,
+            quarantine_dir,
+        )
+
     def _ensure_dirs(self) -> None:
-        self._jobs_dir().mkdir(parents=True, exist_ok=True)
         self._files_dir().mkdir(parents=True, exist_ok=True)
 
     def _jobs_dir(self) -> Path:
@@ -70,3 +458,16 @@ class SpoolRepository:
     def _files_dir(self) -> Path:
         return self.base_dir / "files"
 
+    def _segments_dir(self) -> Path:
+        return self.base_dir / "segments"
+
+
+def _commit_migrated(
+    index: SpoolIndex, rows: list, paths: list[Path]
+) -> None:
+    if rows:
+        index.put_many(rows)
+    for job_path in paths:
+        job_path.unlink()
+    rows.clear()
+    paths.clear()
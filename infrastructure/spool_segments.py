@@ -0,0 +1,243 @@
+﻿import io
+import mmap
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from ..infrastructure.file_lock import FileLock
+
+SEGMENT_SUFFIX = ".seg"
+SEAL_SUFFIX = ".sealed"
+LOCK_SUFFIX = ".lock"
+
+
+class SegmentStore:
+    """Append-only segment files holding many spooled payloads.
+
+    Payloads are appended to the active segment until it reaches
+    `segment_bytes`, then a new one is started. Jobs address their payload
+    by (segment path, offset, length); reads go through cached read-only
+    mmaps so a retry costs a page-cache slice instead of a file open.
+
+    Several processes may share the directory. The writer holds a lock
+    file next to each segment until it is sealed: rolled over and with
+    no append still waiting for its index commit. Sealing writes a marker
+    file. Only sealed segments are ever deleted; an unsealed one whose
+    lock can be taken belonged to a process that died, and is sealed by
+    whoever finds it.
+    """
+
+    def __init__(self, segments_dir: Path, segment_bytes: int) -> None:
+        self._dir = segments_dir
+        self._segment_bytes = max(1, segment_bytes)
+        self._lock = threading.Lock()
+        self._active: Path | None = None
+        self._handle = None
+        self._size = 0
+        self._maps: dict[Path, tuple[mmap.mmap, int]] = {}
+        self._locks: dict[Path, FileLock] = {}
+        self._pending: dict[Path, int] = {}
+
+    @property
+    def active(self) -> Path | None:
+        """Return the segment currently receiving appends."""
+        return self._active
+
+    def append(self, payload: bytes) -> tuple[Path, int]:
+        """Append a payload and return (segment path, offset).
+
+        The data is written but not synced; commit the segment through
+        the group-commit writer before indexing the job, then call
+        `settle` whether or not the commit succeeded.
+        """
+        with self._lock:
+            if self._handle is None or self._size >= self._segment_bytes:
+                self._roll()
+            offset = self._size
+            self._handle.write(payload)
+            self._handle.flush()
+            self._size += len(payload)
+            self._pending[self._active] = (
+                self._pending.get(self._active, 0) + 1
+            )
+            return self._active, offset
+
+    def settle(self, path: Path) -> None:
+        """Mark one append to `path` as committed or abandoned."""
+        with self._lock:
+            remaining = self._pending.get(path, 0) - 1
+            if remaining > 0:
+                self._pending[path] = remaining
+                return
+            self._pending.pop(path, None)
+            if path != self._active:
+                self._seal(path)
+
+    def read(self, path: Path, offset: int, length: int) -> bytes:
+        """Read one payload slice from a segment."""
+        view = self._map(path, offset + length)
+        return view[offset : offset + length]
+
+    def open(self, path: Path, offset: int, length: int) -> "MappedSlice":
+        """Return a file-like reader over one payload, without copying."""
+        view = self._map(path, offset + length)
+        return MappedSlice(view, offset, length)
+
+    def discard(self, path: Path) -> None:
+        """Delete a sealed segment that no job references any more."""
+        with self._lock:
+            if not self._is_sealed(path):
+                return
+            self._maps.pop(path, None)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # Still mapped by a reader (Windows); recovery retries later.
+            return
+        for extra in (_lock_path(path), _seal_path(path)):
+            try:
+                extra.unlink()
+            except OSError:
+                pass
+
+    def sealed_segments(self) -> list[Path]:
+        """Return segment files that no longer receive appends."""
+        if not self._dir.exists():
+            return []
+        with self._lock:
+            return [
+                path
+                for path in self._dir.glob(f"*{SEGMENT_SUFFIX}")
+                if self._is_sealed(path)
+            ]
+
+    def _is_sealed(self, path: Path) -> bool:
+        if path == self._active or path in self._locks:
+            return False
+        if _seal_path(path).exists():
+            return True
+        if not path.exists():
+            return False
+        lock = FileLock(_lock_path(path))
+        try:
+            if not lock.try_acquire():
+                return False
+            # The writer died before sealing; seal on its behalf.
+            _seal_path(path).touch()
+        except OSError:
+            return False
+        finally:
+            lock.release()
+        return True
+
+    def _roll(self) -> None:
+        previous = self._active
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+            self._active = None
+            if previous not in self._pending:
+                self._seal(previous)
+        self._dir.mkdir(parents=True, exist_ok=True)
+        while True:
+            # Names sort by creation time; the random part keeps processes
+            # sharing a spool from appending to the same file.
+            name = f"{time.time_ns()}_{uuid.uuid4().hex[:8]}{SEGMENT_SUFFIX}"
+            path = self._dir / name
+            # The lock exists before the segment does, so another process
+            # never sees this segment without a live lock.
+            lock = FileLock(_lock_path(path))
+            if lock.try_acquire():
+                break
+        self._locks[path] = lock
+        self._active = path
+        self._handle = open(path, "ab")
+        self._size = 0
+
+    def _seal(self, path: Path) -> None:
+        lock = self._locks.pop(path, None)
+        try:
+            _seal_path(path).touch()
+        except OSError:
+            # Without the marker the released lock still lets the next
+            # recovery seal it.
+            pass
+        if lock is not None:
+            lock.release()
+
+    def _map(self, path: Path, end: int) -> mmap.mmap:
+        with self._lock:
+            cached = self._maps.get(path)
+            if cached is not None and cached[1] >= end:
+                return cached[0]
+            with open(path, "rb") as handle:
+                mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            # A replaced map is left to the GC; a reader may still hold it.
+            self._maps[path] = (mapped, len(mapped))
+            return mapped
+
+
+def _seal_path(path: Path) -> Path:
+    return path.with_name(path.name + SEAL_SUFFIX)
+
+
+def _lock_path(path: Path) -> Path:
+    return path.with_name(path.name + LOCK_SUFFIX)
+
+
+class MappedSlice(io.RawIOBase):
+    """Seekable read-only stream over a byte range of a mapped segment.
+
+    Uploads read it in blocks straight from the page cache, so a retry
+    never materializes the payload as one bytes object.
+    """
+
+    def __init__(self, mapped: mmap.mmap, offset: int, length: int) -> None:
+        super().__init__()
+        self._view = memoryview(mapped)[offset : offset + length]
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = max(0, min(len(buffer), len(self._view) - self._position))
+        buffer[:count] = self._view[self._position : self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        self._view.release()
+        super().close()
+
+
+_stores: dict[Path, SegmentStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_segment_store(segments_dir: Path, segment_bytes: int) -> SegmentStore:
+    """Return the shared segment store for a directory."""
+    key = segments_dir.resolve()
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = SegmentStore(key, segment_bytes)
+            _stores[key] = store
+        return store
@@ -0,0 +1,160 @@
+﻿import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import threading
+from pathlib import Path
+
+# Touched after every spooled job is committed, so a watcher in another
+# process only wakes once the job's index row is readable.
+DOORBELL_NAME = ".spooled"
+
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+
+logger = logging.getLogger(__name__)
+
+Target = tuple[str, str]
+
+
+class SpoolSignal:
+    """Wake the retry workers of one spool directory.
+
+    The upload path rings it when it spools a job and when a target
+    answers again after failures; the workers block on it instead of
+    polling. Jobs spooled by other processes ring the doorbell file,
+    which an inotify watch turns into the same wakeup on Linux.
+    """
+
+    def __init__(self, spool_dir: Path) -> None:
+        self.spool_dir = spool_dir
+        self._listeners: set[threading.Event] = set()
+        self._recovered: set[Target] = set()
+        self._lock = threading.Lock()
+        self._watching: bool | None = None
+
+    def subscribe(self, event: threading.Event) -> None:
+        """Set `event` whenever the spool gains work."""
+        with self._lock:
+            self._listeners.add(event)
+
+    def unsubscribe(self, event: threading.Event) -> None:
+        """Stop setting `event`."""
+        with self._lock:
+            self._listeners.discard(event)
+
+    def notify_spooled(self) -> None:
+        """Report a newly committed job, to this and other processes."""
+        try:
+            (self.spool_dir / DOORBELL_NAME).touch()
+        except OSError:
+            # Only other processes miss out; they still poll.
+            pass
+        self._wake()
+
+    def notify_recovered(self, endpoint: str, bucket: str) -> None:
+        """Report that a target accepted an upload after failing."""
+        with self._lock:
+            self._recovered.add((endpoint, bucket))
+        self._wake()
+
+    def take_recovered(self) -> set[Target]:
+        """Return and clear the targets reported as recovered."""
+        with self._lock:
+            recovered, self._recovered = self._recovered, set()
+            return recovered
+
+    def watch(self) -> bool:
+        """Watch the doorbell for other processes; False if unsupported."""
+        with self._lock:
+            if self._watching is None:
+                self._watching = self._start_watch()
+            return self._watching
+
+    def _wake(self) -> None:
+        with self._lock:
+            listeners = list(self._listeners)
+        for event in listeners:
+            event.set()
+
+    def _start_watch(self) -> bool:
+        fd = _inotify_watch(
+            self.spool_dir, _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_CREATE
+        )
+        if fd is None:
+            return False
+        threading.Thread(
+            target=self._read_events,
+            args=(fd,),
+            name="s3up-spool-watch",
+            daemon=True,
+        ).start()
+        return True
+
+    def _read_events(self, fd: int) -> None:
+        while True:
+            try:
+                data = os.read(fd, 64 * 1024)
+            except OSError:
+                logger.warning("s3up spool watch stopped; polling instead")
+                with self._lock:
+                    self._watching = False
+                self._wake()
+                return
+            offset = 0
+            rang = False
+            while offset < len(data):
+                _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                start = offset + _EVENT_HEADER.size
+                name = data[start : start + length].rstrip(b"\0")
+                offset = start + length
+                if mask & _IN_Q_OVERFLOW or name == DOORBELL_NAME.encode():
+                    rang = True
+            if rang:
+                self._wake()
+
+
+def _inotify_watch(directory: Path, mask: int) -> int | None:
+    """Return an inotify fd watching `directory`, or None if unavailable."""
+    library = ctypes.util.find_library("c")
+    if library is None:
+        return None
+    try:
+        libc = ctypes.CDLL(library, use_errno=True)
+        init = libc.inotify_init1
+        add_watch = libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+    except OSError:
+        return None
+    fd = init(_IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if add_watch(fd, os.fsencode(directory), mask) < 0:
+        # Usually the per-user watch limit; polling still works.
+        os.close(fd)
+        return None
+    return fd
+
+
+_signals: dict[Path, SpoolSignal] = {}
+_signals_lock = threading.Lock()
+
+
+def get_spool_signal(spool_dir: Path) -> SpoolSignal:
+    """Return the shared signal of a spool directory."""
+    key = spool_dir.resolve()
+    with _signals_lock:
+        signal = _signals.get(key)
+        if signal is None:
+            signal = SpoolSignal(key)
+            _signals[key] = signal
+        return signal
@@ -0,0 +1,155 @@
+﻿import os
+import queue
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from ..infrastructure.spool_index import SpoolIndex
+
+TEMP_SUFFIX = ".tmp"
+_MAX_BATCH = 256
+
+
+@dataclass
+class _Commit:
+    renames: list[tuple[Path, Path]]
+    rows: list[tuple[str, dict, float | None]]
+    deletes: list[str]
+    syncs: list[Path]
+    done: threading.Event = field(default_factory=threading.Event)
+    error: BaseException | None = None
+
+
+class GroupCommitWriter:
+    """Make spool writes durable in batches.
+
+    Callers write payloads to temp files in parallel and then block in
+    `commit`. A single committer thread takes every commit waiting at
+    that moment, fsyncs and renames their payloads, fsyncs the parent
+    directories once and writes all index rows in one transaction, so a
+    burst of spooled jobs shares a handful of fsyncs.
+    """
+
+    def __init__(self, index: SpoolIndex) -> None:
+        self._index = index
+        self._queue: queue.Queue[_Commit] = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="s3up-spool-commit", daemon=True
+        )
+        self._thread.start()
+
+    def commit(
+        self,
+        renames: list[tuple[Path, Path]] = (),
+        rows: list[tuple[str, dict, float | None]] = (),
+        deletes: list[str] = (),
+        syncs: list[Path] = (),
+    ) -> None:
+        """Durably apply temp-file renames and index changes, then return.
+
+        `syncs` lists files appended in place (segments) that must reach
+        disk before the rows referencing them commit.
+        """
+        request = _Commit(
+            renames=list(renames),
+            rows=list(rows),
+            deletes=list(deletes),
+            syncs=list(syncs),
+        )
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < _MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._flush(batch)
+            except BaseException as exc:
+                for request in batch:
+                    if request.error is None:
+                        request.error = exc
+            for request in batch:
+                request.done.set()
+
+    def _flush(self, batch: list[_Commit]) -> None:
+        # A failure only fails the requests it touches; the rows of every
+        # other request in the batch still commit.
+        failed: dict[Path, OSError] = {}
+        for path in {path for request in batch for path in request.syncs}:
+            try:
+                _fsync_file(path)
+            except OSError as exc:
+                failed[path] = exc
+        directories: dict[Path, list[_Commit]] = {}
+        for request in batch:
+            for path in request.syncs:
+                if path in failed:
+                    request.error = failed[path]
+                    break
+            if request.error is not None:
+                continue
+            try:
+                for temp_path, final_path in request.renames:
+                    _fsync_file(temp_path)
+                    os.replace(temp_path, final_path)
+                    directories.setdefault(final_path.parent, []).append(
+                        request
+                    )
+            except OSError as exc:
+                request.error = exc
+        for directory, requests in directories.items():
+            try:
+                _fsync_dir(directory)
+            except OSError as exc:
+                for request in requests:
+                    if request.error is None:
+                        request.error = exc
+        committed = [request for request in batch if request.error is None]
+        rows = [row for request in committed for row in request.rows]
+        deletes = [
+            job_id for request in committed for job_id in request.deletes
+        ]
+        if rows or deletes:
+            self._index.apply(rows, deletes)
+
+
+def temp_path_for(final_path: Path) -> Path:
+    """Return the temp path a payload is written to before commit."""
+    return final_path.with_name(final_path.name + TEMP_SUFFIX)
+
+
+def _fsync_file(path: Path) -> None:
+    with open(path, "rb+") as handle:
+        os.fsync(handle.fileno())
+
+
+def _fsync_dir(directory: Path) -> None:
+    if os.name == "nt":
+        # Windows cannot open directories; NTFS journals the rename.
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+_writers: dict[int, GroupCommitWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_spool_writer(index: SpoolIndex) -> GroupCommitWriter:
+    """Return the group-commit writer bound to an index."""
+    with _writers_lock:
+        writer = _writers.get(id(index))
+        if writer is None:
+            writer = GroupCommitWriter(index)
+            _writers[id(index)] = writer
+        return writer
@@ -1,46 +1,442 @@
-﻿import uuid
+﻿import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
+from ..domain.backoff import backoff_delay
+from ..domain.checksum import PayloadChecksum
 from ..domain.config import S3Config
+from ..domain.multipart import MultipartProgress
 from ..domain.object_key_strategy import ObjectKeyStrategy
 from ..domain.spool_job import SpoolJob
-from ..infrastructure.s3_client import S3ClientAdapter
+from ..infrastructure.circuit_breaker import get_circuit_breaker
+from ..infrastructure.dedup_cache import (
+    DigestCache,
+    content_digest,
+    get_digest_cache,
+)
+from ..infrastructure.image_serializer import EncodedImage
+from ..infrastructure.metrics import get_metrics
+from ..infrastructure.s3_client import MultipartUploadError, S3ClientAdapter
 from ..infrastructure.spool_repository import SpoolRepository
+from ..infrastructure.spool_signal import get_spool_signal
+
+_SPOOLED = get_metrics().counter(
+    "s3up_spooled_total", "Images spooled instead of uploaded, by reason"
+)
+_DEDUP_HITS = get_metrics().counter(
+    "s3up_dedup_hits_total", "Uploads skipped because the content exists"
+)
 
 
 @dataclass(frozen=True)
 class UploadOrchestrator:
-    """Coordinate upload and spool fallback."""
+    """Coordinate upload and spool fallback.
+
+    Mirrors are further destinations that receive every object under the
+    same key. They upload concurrently with this one, and each spools its
+    own failures for its own target. Derivatives of an image upload
+    concurrently too, under sibling keys of the original.
+    """
 
     config: S3Config
     s3_client: S3ClientAdapter
     spool_repository: SpoolRepository
     key_strategy: ObjectKeyStrategy
+    mirrors: tuple["UploadOrchestrator", ...] = ()
 
-    def upload_or_spool(self, image_bytes: bytes, extension: str) -> None:
-        """Upload bytes or spool if upload fails."""
-        object_key = self.key_strategy.build_key(extension)
+    def upload_or_spool(
+        self,
+        image_bytes: bytes,
+        extension: str,
+        content_type: str = "",
+        checksum: PayloadChecksum | None = None,
+        derivatives: tuple[EncodedImage, ...] = (),
+    ) -> str:
+        """Upload bytes or spool if upload fails, returning the key."""
+        digest = self.digest(image_bytes, checksum)
+        existing = self.find_existing(digest, extension)
+        if existing is not None:
+            # Mirrors and derivatives may have been added, or failed,
+            # since the stored copy went up; only what is missing is sent.
+            self._complete_existing(
+                image_bytes,
+                existing,
+                extension,
+                content_type,
+                digest,
+                checksum,
+                derivatives,
+            )
+            return existing
+        object_key = self.key_strategy.build_key(extension, digest=digest)
+        self.upload_key_or_spool(
+            image_bytes,
+            object_key,
+            extension,
+            content_type,
+            digest,
+            checksum,
+            derivatives,
+        )
+        return object_key
+
+    def digest(
+        self, image_bytes: bytes, checksum: PayloadChecksum | None = None
+    ) -> str:
+        """Hash bytes when dedup or content keys need it, else ""."""
+        if self.config.dedup or self.key_strategy.content_addressed:
+            if checksum is not None and checksum.sha256_hex():
+                return checksum.sha256_hex()
+            return content_digest(image_bytes)
+        return ""
+
+    def checksum(
+        self,
+        image_bytes: bytes,
+        digest: str = "",
+        checksum: PayloadChecksum | None = None,
+    ) -> PayloadChecksum | None:
+        """Return the upload checksum, computing it only if still missing."""
+        algorithm = self.config.upload_checksum
+        if checksum is not None and checksum.algorithm == algorithm:
+            return checksum
+        if algorithm == "sha256" and digest:
+            return PayloadChecksum.from_sha256_hex(digest)
+        return PayloadChecksum.compute(image_bytes, algorithm)
+
+    def find_existing(self, digest: str, extension: str) -> str | None:
+        """Return the key of an already stored copy of this content."""
+        if not self.config.dedup or not digest:
+            return None
+        cache = self._digest_cache()
+        scope = self._scope()
+        object_key = cache.get(scope, digest)
+        verify = self.config.dedup_verify
+        if object_key is None and self.key_strategy.content_addressed:
+            # The key is derived from the content, so a HEAD can find
+            # copies uploaded by other machines or before the cache.
+            object_key = self.key_strategy.build_key(extension, digest=digest)
+            verify = True
+        if object_key is None:
+            return None
+        if not verify:
+            _DEDUP_HITS.inc()
+            return object_key
+        if not get_circuit_breaker(self.config).allow_request():
+            object_key = cache.get(scope, digest)
+            if object_key is not None:
+                _DEDUP_HITS.inc()
+            return object_key
+        try:
+            exists = self.s3_client.object_exists(object_key)
+        except Exception:
+            # Let the upload path deal with (and spool on) the failure.
+            return None
+        if not exists:
+            cache.forget(scope, digest)
+            return None
+        cache.put(scope, digest, object_key)
+        _DEDUP_HITS.inc()
+        return object_key
+
+    def upload_key_or_spool(
+        self,
+        image_bytes: bytes,
+        object_key: str,
+        extension: str,
+        content_type: str = "",
+        digest: str = "",
+        checksum: PayloadChecksum | None = None,
+        derivatives: tuple[EncodedImage, ...] = (),
+    ) -> None:
+        """Upload bytes under a prepared key or spool if upload fails."""
+        pending = []
+        if derivatives:
+            # Derivative uploads wait on their own mirror uploads, so they
+            # get a pool of their own and can never wait on themselves.
+            pool = _executor("derivative", self._pool_size(len(derivatives)))
+            pending += [
+                pool.submit(
+                    self.upload_key_or_spool,
+                    image.content,
+                    self.derivative_key(object_key, image),
+                    image.extension,
+                    image.content_type,
+                    "",
+                    image.checksum,
+                )
+                for image in derivatives
+            ]
+        if self.mirrors:
+            pool = _executor("mirror", self._pool_size(len(self.mirrors)))
+            pending += [
+                pool.submit(
+                    mirror._upload_one,
+                    image_bytes,
+                    object_key,
+                    extension,
+                    content_type,
+                    digest,
+                    checksum,
+                )
+                for mirror in self.mirrors
+            ]
+        self._upload_one(
+            image_bytes, object_key, extension, content_type, digest, checksum
+        )
+        for future in pending:
+            future.result()
+
+    def defer(
+        self,
+        image_bytes: bytes,
+        object_key: str,
+        extension: str,
+        content_type: str = "",
+        checksum: PayloadChecksum | None = None,
+        derivatives: tuple[EncodedImage, ...] = (),
+    ) -> None:
+        """Spool bytes without an upload attempt for the retry worker."""
+        for orchestrator in (self, *self.mirrors):
+            orchestrator._defer_one(
+                image_bytes, object_key, extension, content_type, checksum
+            )
+        for image in derivatives:
+            self.defer(
+                image.content,
+                self.derivative_key(object_key, image),
+                image.extension,
+                image.content_type,
+                image.checksum,
+            )
+
+    def derivative_key(self, object_key: str, image: EncodedImage) -> str:
+        """Return the sibling key a derivative is stored under."""
+        return self.key_strategy.derivative_key(
+            object_key, image.derivative, image.extension
+        )
+
+    def _complete_existing(
+        self,
+        image_bytes: bytes,
+        object_key: str,
+        extension: str,
+        content_type: str,
+        digest: str,
+        checksum: PayloadChecksum | None,
+        derivatives: tuple[EncodedImage, ...],
+    ) -> None:
+        copies = [
+            (
+                mirror,
+                image_bytes,
+                object_key,
+                extension,
+                content_type,
+                digest,
+                checksum,
+            )
+            for mirror in self.mirrors
+        ]
+        for image in derivatives:
+            derivative_key = self.derivative_key(object_key, image)
+            copies += [
+                (
+                    orchestrator,
+                    image.content,
+                    derivative_key,
+                    image.extension,
+                    image.content_type,
+                    "",
+                    image.checksum,
+                )
+                for orchestrator in (self, *self.mirrors)
+            ]
+        if not copies:
+            return
+        # Copies never wait on other fan-out work. They get their own
+        # pool, sized for every copy a hit can need, rather than sharing
+        # the mirror pool sized for uploads.
+        pool = _executor("copy", self._pool_size(len(copies)))
+        pending = [
+            pool.submit(orchestrator._ensure_copy, *arguments)
+            for orchestrator, *arguments in copies
+        ]
+        for future in pending:
+            future.result()
+
+    def _ensure_copy(
+        self,
+        image_bytes: bytes,
+        object_key: str,
+        extension: str,
+        content_type: str,
+        digest: str,
+        checksum: PayloadChecksum | None,
+    ) -> None:
+        """Upload bytes under a key unless this target already has them."""
+        if self.config.dedup and not digest:
+            digest = content_digest(image_bytes)
+        cache = self._digest_cache() if self.config.dedup else None
+        if (
+            cache is not None
+            and not self.config.dedup_verify
+            and cache.get(self._scope(), digest) == object_key
+        ):
+            return
+        if get_circuit_breaker(self.config).allow_request():
+            try:
+                exists = self.s3_client.object_exists(object_key)
+            except Exception:
+                # Let the upload path deal with (and spool on) the failure.
+                exists = False
+            if exists:
+                if cache is not None:
+                    cache.put(self._scope(), digest, object_key)
+                return
+        self._upload_one(
+            image_bytes, object_key, extension, content_type, digest, checksum
+        )
+
+    def _upload_one(
+        self,
+        image_bytes: bytes,
+        object_key: str,
+        extension: str,
+        content_type: str,
+        digest: str,
+        checksum: PayloadChecksum | None,
+    ) -> None:
+        checksum = self.checksum(image_bytes, digest, checksum)
+        breaker = get_circuit_breaker(self.config)
+        if not breaker.allow_request():
+            # The endpoint is known to be down; go straight to disk.
+            self._defer_one(
+                image_bytes, object_key, extension, content_type, checksum
+            )
+            return
         try:
-            self.s3_client.upload_bytes(image_bytes, object_key)
+            self.s3_client.upload_bytes(
+                image_bytes, object_key, content_type, checksum=checksum
+            )
+            if breaker.record_success():
+                # Jobs spooled while it was failing need not sit out
+                # their backoff now that the target answers again.
+                get_spool_signal(self.config.spool_dir).notify_recovered(
+                    self.config.endpoint, self.config.bucket
+                )
+            if self.config.dedup and digest:
+                self._digest_cache().put(self._scope(), digest, object_key)
+        except MultipartUploadError as exc:
+            breaker.record_failure()
+            self._spool(
+                image_bytes,
+                object_key,
+                extension,
+                content_type,
+                checksum,
+                str(exc),
+                exc.progress,
+            )
         except Exception as exc:
-            self._spool(image_bytes, object_key, extension, str(exc))
+            breaker.record_result(exc)
+            self._spool(
+                image_bytes,
+                object_key,
+                extension,
+                content_type,
+                checksum,
+                str(exc),
+            )
+
+    def _defer_one(
+        self,
+        image_bytes: bytes,
+        object_key: str,
+        extension: str,
+        content_type: str,
+        checksum: PayloadChecksum | None,
+    ) -> None:
+        _SPOOLED.inc(reason="deferred")
+        job = self._new_job(
+            object_key,
+            extension,
+            content_type,
+            self.checksum(image_bytes, checksum=checksum),
+        )
+        self.spool_repository.save_job(image_bytes, job)
 
     def _spool(
         self,
         image_bytes: bytes,
         object_key: str,
         extension: str,
+        content_type: str,
+        checksum: PayloadChecksum | None,
         error: str,
+        multipart: MultipartProgress | None = None,
     ) -> None:
+        _SPOOLED.inc(reason="upload_failed")
+        job = self._new_job(object_key, extension, content_type, checksum)
+        delay = backoff_delay(
+            1,
+            self.config.retry_backoff_seconds,
+            self.config.retry_backoff_max_seconds,
+        )
+        updated = job.with_multipart(multipart).increment_retry(error, delay)
+        self.spool_repository.save_job(image_bytes, updated)
+
+    def _pool_size(self, fan_out: int) -> int:
+        # Every upload thread may be fanning out at the same time.
+        return max(1, self.config.upload_concurrency) * max(1, fan_out)
+
+    def _digest_cache(self) -> DigestCache:
+        return get_digest_cache(
+            self.config.spool_dir / "dedup.sqlite3",
+            self.config.dedup_cache_size,
+        )
+
+    def _scope(self) -> str:
+        return f"{self.config.endpoint}/{self.config.bucket}"
+
+    def _new_job(
+        self,
+        object_key: str,
+        extension: str,
+        content_type: str,
+        checksum: PayloadChecksum | None = None,
+    ) -> SpoolJob:
         job_id = uuid.uuid4().hex
-        job = SpoolJob.create(
+        return SpoolJob.create(
             job_id=job_id,
             object_key=object_key,
             bucket=self.config.bucket,
             endpoint=self.config.endpoint,
             file_path="",
             file_ext=extension,
+            content_type=content_type,
+            credential_ref=self.config.credential_ref(),
+            priority=self.config.spool_priority,
+            checksum=checksum,
         )
-        updated = job.increment_retry(error)
-        self.spool_repository.save_job(image_bytes, updated)
 
+
+_pools: dict[tuple[str, int], ThreadPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _executor(kind: str, workers: int) -> ThreadPoolExecutor:
+    """Return the shared fan-out pool of a kind and size.
+
+    Pools are never shut down, since another upload may be submitting to
+    any of them. Sizes follow the node settings, so only a few exist.
+    """
+    with _pools_lock:
+        executor = _pools.get((kind, workers))
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix=f"s3up-{kind}"
+            )
+            _pools[kind, workers] = executor
+        return executor
@@ -0,0 +1,42 @@
+﻿from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable
+
+from ..infrastructure.image_serializer import EncodedImage
+from ..infrastructure.upload_orchestrator import UploadOrchestrator
+
+
+@dataclass(frozen=True)
+class UploadPipeline:
+    """Encode the next image while earlier images are uploading."""
+
+    orchestrator: UploadOrchestrator
+    max_in_flight: int
+
+    def run(self, encoded: Iterable[EncodedImage]) -> list[str]:
+        """Upload every encoded image and return their object keys."""
+        in_flight = max(1, self.max_in_flight)
+        pending: deque[Future] = deque()
+        keys: list[str] = []
+        with ThreadPoolExecutor(
+            max_workers=in_flight, thread_name_prefix="s3up-upload"
+        ) as executor:
+            # Pulling from the generator encodes the next image, so the
+            # encode of image N+1 runs while image N is on the wire.
+            for image in encoded:
+                if len(pending) >= in_flight:
+                    keys.append(pending.popleft().result())
+                pending.append(
+                    executor.submit(
+                        self.orchestrator.upload_or_spool,
+                        image.content,
+                        image.extension,
+                        image.content_type,
+                        image.checksum,
+                        image.derivatives,
+                    )
+                )
+            while pending:
+                keys.append(pending.popleft().result())
+        return keys
@@ -0,0 +1,195 @@
+﻿import atexit
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass
+
+from ..domain.checksum import PayloadChecksum
+from ..domain.config import S3Config
+from ..infrastructure.image_serializer import EncodedImage
+from ..infrastructure.metrics import get_metrics
+from ..infrastructure.upload_orchestrator import UploadOrchestrator
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class _UploadTask:
+    orchestrator: UploadOrchestrator
+    image_bytes: bytes
+    object_key: str
+    extension: str
+    content_type: str
+    digest: str
+    checksum: PayloadChecksum | None
+    derivatives: tuple[EncodedImage, ...]
+
+
+class UploadQueue:
+    """Bounded in-memory upload queue drained by background threads."""
+
+    def __init__(self, max_size: int, workers: int) -> None:
+        self._queue: queue.Queue[_UploadTask] = queue.Queue(
+            maxsize=max(1, max_size)
+        )
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+        self.ensure_workers(workers)
+
+    def submit(
+        self,
+        orchestrator: UploadOrchestrator,
+        image_bytes: bytes,
+        extension: str,
+        content_type: str = "",
+        checksum: PayloadChecksum | None = None,
+        derivatives: tuple[EncodedImage, ...] = (),
+    ) -> str:
+        """Queue bytes for upload, spilling to the spool when full."""
+        digest = orchestrator.digest(image_bytes, checksum)
+        existing = orchestrator.find_existing(digest, extension)
+        if existing is not None:
+            return existing
+        object_key = orchestrator.key_strategy.build_key(
+            extension, digest=digest
+        )
+        task = _UploadTask(
+            orchestrator=orchestrator,
+            image_bytes=image_bytes,
+            object_key=object_key,
+            extension=extension,
+            content_type=content_type,
+            digest=digest,
+            checksum=checksum,
+            derivatives=derivatives,
+        )
+        try:
+            self._queue.put_nowait(task)
+        except queue.Full:
+            orchestrator.defer(
+                image_bytes,
+                object_key,
+                extension,
+                content_type,
+                checksum,
+                derivatives,
+            )
+        return object_key
+
+    def submit_when_encoded(
+        self, orchestrator: UploadOrchestrator, future: Future
+    ) -> None:
+        """Queue an image as soon as its pooled encode completes."""
+
+        def _enqueue(done: Future) -> None:
+            try:
+                image = done.result()
+            except Exception:
+                logger.exception("s3up image encode failed")
+                return
+            try:
+                self.submit(
+                    orchestrator,
+                    image.content,
+                    image.extension,
+                    image.content_type,
+                    image.checksum,
+                    image.derivatives,
+                )
+            except Exception:
+                # Nothing above this callback would report the failure.
+                logger.exception("s3up could not queue or spool an image")
+
+        future.add_done_callback(_enqueue)
+
+    def resize(self, max_size: int, workers: int) -> None:
+        """Apply new queue bounds; workers are only ever added."""
+        with self._queue.mutex:
+            self._queue.maxsize = max(1, max_size)
+        self.ensure_workers(workers)
+
+    def ensure_workers(self, workers: int) -> None:
+        """Start uploader threads until at least `workers` are running."""
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < max(1, workers):
+                thread = threading.Thread(
+                    target=self._run,
+                    name=f"s3up-async-upload-{len(self._threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def pending(self) -> int:
+        """Return the approximate number of queued uploads."""
+        return self._queue.qsize()
+
+    def flush_to_spool(self) -> None:
+        """Spool every queued item so nothing is lost on shutdown."""
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                task.orchestrator.defer(
+                    task.image_bytes,
+                    task.object_key,
+                    task.extension,
+                    task.content_type,
+                    task.checksum,
+                    task.derivatives,
+                )
+            finally:
+                self._queue.task_done()
+
+    def _run(self) -> None:
+        while True:
+            task = self._queue.get()
+            try:
+                task.orchestrator.upload_key_or_spool(
+                    task.image_bytes,
+                    task.object_key,
+                    task.extension,
+                    task.content_type,
+                    task.digest,
+                    task.checksum,
+                    task.derivatives,
+                )
+            except Exception:
+                # Spooling itself failed; keep the uploader alive.
+                logger.exception(
+                    "s3up could not upload or spool %s", task.object_key
+                )
+            finally:
+                self._queue.task_done()
+
+
+_queue_instance: UploadQueue | None = None
+_queue_lock = threading.Lock()
+
+
+def get_upload_queue(config: S3Config) -> UploadQueue:
+    """Return the singleton async upload queue."""
+    global _queue_instance
+    with _queue_lock:
+        if _queue_instance is None:
+            _queue_instance = UploadQueue(
+                max_size=config.upload_queue_size,
+                workers=config.upload_concurrency,
+            )
+            atexit.register(_queue_instance.flush_to_spool)
+            upload_queue = _queue_instance
+            get_metrics().gauge(
+                "s3up_upload_queue_pending",
+                "Images waiting in the async upload queue",
+                lambda: [({}, upload_queue.pending())],
+            )
+        else:
+            _queue_instance.resize(
+                max_size=config.upload_queue_size,
+                workers=config.upload_concurrency,
+            )
+        return _queue_instance
@@ -0,0 +1,30 @@
+﻿from ..infrastructure.metrics import get_metrics
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def register_routes() -> bool:
+    """Add the metrics endpoints to the ComfyUI server, if running in one."""
+    try:
+        from aiohttp import web
+        from server import PromptServer
+    except ImportError:
+        return False
+    if getattr(PromptServer, "instance", None) is None:
+        return False
+    routes = PromptServer.instance.routes
+
+    @routes.get("/s3up/metrics")
+    async def metrics(request):
+        if request.query.get("format") == "json":
+            return web.json_response(get_metrics().snapshot())
+        return web.Response(
+            text=get_metrics().render_prometheus(),
+            headers={"Content-Type": PROMETHEUS_CONTENT_TYPE},
+        )
+
+    @routes.get("/s3up/metrics.json")
+    async def metrics_json(request):
+        return web.json_response(get_metrics().snapshot())
+
+    return True
@@ -1,21 +1,31 @@
-﻿from pathlib import Path
+﻿import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator
 
-from ..domain.config import S3Config
-from ..domain.object_key_strategy import ObjectKeyStrategy
-from ..infrastructure.image_serializer import (
-    image_tensor_to_bytes,
-)
-from ..infrastructure.retry_worker import get_retry_worker
-from ..infrastructure.s3_client import S3ClientAdapter
-from ..infrastructure.spool_repository import (
-    SpoolRepository,
-)
-from ..infrastructure.upload_orchestrator import (
-    UploadOrchestrator,
+from ..domain.config import (
+    ENCODE_EXECUTORS,
+    IMAGE_FORMATS,
+    PNG_STRATEGIES,
+    SPOOL_COMPRESSIONS,
+    SPOOL_EVICTIONS,
+    SPOOL_LAYOUTS,
+    TRANSPORTS,
+    UPLOAD_CHECKSUMS,
+    S3Config,
 )
+from ..domain.object_key_strategy import ObjectKeyStrategy
+
+# The infrastructure modules pull in boto3, numpy and PIL. They are
+# imported on the first store() call so that loading the plugin at
+# ComfyUI startup costs next to nothing.
+if TYPE_CHECKING:
+    from ..infrastructure.image_serializer import EncodedImage
+    from ..infrastructure.upload_orchestrator import UploadOrchestrator
+
+logger = logging.getLogger(__name__)
 
 
-def _opt(input_type: str, default, label: str, tooltip: str) -> tuple:
+def _opt(input_type: str | list, default, label: str, tooltip: str) -> tuple:
     options = {"label": label, "tooltip": tooltip}
     if default is not None:
         options["default"] = default
@@ -87,7 +97,7 @@ class S3UploadNode:
                     "INT",
                     env["retry_interval_seconds"],
                     "扫描间隔秒数",
-                    "后台补传扫描间隔",
+                    "无法监听暂存目录时的轮询间隔",
                 ),
                 "retry_concurrency": _opt(
                     "INT",
@@ -95,6 +105,222 @@ class S3UploadNode:
                     "补传并发",
                     "同时补传的任务数量",
                 ),
+                "upload_concurrency": _opt(
+                    "INT",
+                    env["upload_concurrency"],
+                    "上传并发",
+                    "同时上传的连接数量",
+                ),
+                "async_upload": _opt(
+                    "BOOLEAN",
+                    env["async_upload"],
+                    "后台上传",
+                    "图像放入上传队列后立即返回",
+                ),
+                "upload_queue_size": _opt(
+                    "INT",
+                    env["upload_queue_size"],
+                    "上传队列长度",
+                    "队列满时直接落盘暂存",
+                ),
+                "encode_workers": _opt(
+                    "INT",
+                    env["encode_workers"],
+                    "编码并发",
+                    "同时编码图像的线程或进程数",
+                ),
+                "encode_executor": _opt(
+                    list(ENCODE_EXECUTORS),
+                    env["encode_executor"],
+                    "编码执行器",
+                    "thread 使用线程池，process 使用进程池",
+                ),
+                "png_compress_level": _opt(
+                    "INT",
+                    env["png_compress_level"],
+                    "PNG压缩级别",
+                    "0 最快，9 最小",
+                ),
+                "png_optimize": _opt(
+                    "BOOLEAN",
+                    env["png_optimize"],
+                    "PNG优化",
+                    "开启后体积更小但编码更慢",
+                ),
+                "png_strategy": _opt(
+                    list(PNG_STRATEGIES),
+                    env["png_strategy"],
+                    "PNG压缩策略",
+                    "zlib 压缩策略，照片类可试 filtered 或 rle",
+                ),
+                "image_format": _opt(
+                    list(IMAGE_FORMATS),
+                    env["image_format"],
+                    "图像格式",
+                    "有损格式体积更小，上传更快",
+                ),
+                "image_quality": _opt(
+                    "INT",
+                    env["image_quality"],
+                    "图像质量",
+                    "webp/jpeg/avif 的质量 1-100",
+                ),
+                "image_lossless": _opt(
+                    "BOOLEAN",
+                    env["image_lossless"],
+                    "无损压缩",
+                    "webp/avif 使用无损模式",
+                ),
+                "multipart_threshold_mb": _opt(
+                    "INT",
+                    env["multipart_threshold_mb"],
+                    "分片上传阈值MB",
+                    "超过该大小时使用并发分片上传",
+                ),
+                "multipart_chunk_mb": _opt(
+                    "INT",
+                    env["multipart_chunk_mb"],
+                    "分片大小MB",
+                    "每个分片的大小，至少 5MB",
+                ),
+                "multipart_concurrency": _opt(
+                    "INT",
+                    env["multipart_concurrency"],
+                    "分片并发",
+                    "同一对象同时上传的分片数",
+                ),
+                "retry_backoff_max_seconds": _opt(
+                    "INT",
+                    env["retry_backoff_max_seconds"],
+                    "最大退避秒数",
+                    "指数退避的等待上限",
+                ),
+                "breaker_failure_threshold": _opt(
+                    "INT",
+                    env["breaker_failure_threshold"],
+                    "断路失败次数",
+                    "连续失败达到该次数后直接落盘，不再尝试上传",
+                ),
+                "breaker_reset_seconds": _opt(
+                    "INT",
+                    env["breaker_reset_seconds"],
+                    "断路探测秒数",
+                    "断路后多久由补传线程发起一次探测",
+                ),
+                "spool_layout": _opt(
+                    list(SPOOL_LAYOUTS),
+                    env["spool_layout"],
+                    "暂存布局",
+                    "segments 将图像追加到大分段文件，减少小文件数量",
+                ),
+                "spool_segment_mb": _opt(
+                    "INT",
+                    env["spool_segment_mb"],
+                    "分段文件MB",
+                    "分段布局下单个分段文件的大小",
+                ),
+                "dedup": _opt(
+                    "BOOLEAN",
+                    env["dedup"],
+                    "内容去重",
+                    "相同内容的图像只上传一次，返回已有对象",
+                ),
+                "dedup_verify": _opt(
+                    "BOOLEAN",
+                    env["dedup_verify"],
+                    "去重时确认",
+                    "命中缓存时先用 HEAD 确认对象仍然存在",
+                ),
+                "content_addressed_keys": _opt(
+                    "BOOLEAN",
+                    env["content_addressed_keys"],
+                    "哈希命名",
+                    "用内容哈希作为文件名，忽略时间戳前缀",
+                ),
+                "dedup_cache_size": _opt(
+                    "INT",
+                    env["dedup_cache_size"],
+                    "去重缓存条数",
+                    "内存中保留的哈希条数，其余保存在本地数据库",
+                ),
+                "spool_max_mb": _opt(
+                    "INT",
+                    env["spool_max_mb"],
+                    "暂存上限MB",
+                    "暂存目录的容量上限，0 表示不限制",
+                ),
+                "spool_max_jobs": _opt(
+                    "INT",
+                    env["spool_max_jobs"],
+                    "暂存任务上限",
+                    "暂存任务数量上限，0 表示不限制",
+                ),
+                "spool_eviction": _opt(
+                    list(SPOOL_EVICTIONS),
+                    env["spool_eviction"],
+                    "淘汰策略",
+                    "超出上限时先删除哪些任务",
+                ),
+                "spool_compression": _opt(
+                    list(SPOOL_COMPRESSIONS),
+                    env["spool_compression"],
+                    "暂存压缩",
+                    "落盘时压缩图像数据，zstd 需要安装 zstandard",
+                ),
+                "spool_priority": _opt(
+                    "INT",
+                    env["spool_priority"],
+                    "暂存优先级",
+                    "数值越小越先被淘汰",
+                ),
+                "upload_checksum": _opt(
+                    list(UPLOAD_CHECKSUMS),
+                    env["upload_checksum"],
+                    "上传校验",
+                    "默认 none 不发送；启用后编码时预先计算校验和并随上传发送，补传不再重复计算",
+                ),
+                "key_shard_depth": _opt(
+                    "INT",
+                    env["key_shard_depth"],
+                    "分片层数",
+                    "在文件名前加入几级哈希目录以分散写入压力，0 表示不分片",
+                ),
+                "key_shard_width": _opt(
+                    "INT",
+                    env["key_shard_width"],
+                    "分片宽度",
+                    "每级分片目录的十六进制字符数，1 为 16 路，2 为 256 路",
+                ),
+                "key_date_partition": _opt(
+                    "BOOLEAN",
+                    env["key_date_partition"],
+                    "日期目录",
+                    "在文件名前加入 yyyy/mm/dd 日期目录（哈希命名时不加）",
+                ),
+                "destinations": _opt(
+                    "STRING",
+                    env["destinations"],
+                    "镜像目标",
+                    "JSON 列表，每项写出镜像目标与主目标不同的配置",
+                ),
+                "derivatives": _opt(
+                    "STRING",
+                    env["derivatives"],
+                    "衍生图",
+                    "JSON 列表，每项为 name、size，可选 format、quality",
+                ),
+                "transport": _opt(
+                    list(TRANSPORTS),
+                    env["transport"],
+                    "传输实现",
+                    "boto3 或内置的轻量 SigV4 客户端（native）",
+                ),
+                "jpeg_optimize": _opt(
+                    "BOOLEAN",
+                    env["jpeg_optimize"],
+                    "JPEG 优化",
+                    "JPEG 额外优化霍夫曼表，文件更小但更慢",
+                ),
             },
         }
 
@@ -123,8 +349,53 @@ class S3UploadNode:
         retry_interval_seconds=None,
         retry_concurrency=None,
         use_timestamp_prefix=None,
+        upload_concurrency=None,
+        async_upload=None,
+        upload_queue_size=None,
+        encode_workers=None,
+        encode_executor="",
+        png_compress_level=None,
+        png_optimize=None,
+        png_strategy="",
+        image_format="",
+        image_quality=None,
+        image_lossless=None,
+        multipart_threshold_mb=None,
+        multipart_chunk_mb=None,
+        multipart_concurrency=None,
+        retry_backoff_max_seconds=None,
+        breaker_failure_threshold=None,
+        breaker_reset_seconds=None,
+        spool_layout="",
+        spool_segment_mb=None,
+        dedup=None,
+        dedup_verify=None,
+        content_addressed_keys=None,
+        dedup_cache_size=None,
+        spool_max_mb=None,
+        spool_max_jobs=None,
+        spool_eviction="",
+        spool_compression="",
+        spool_priority=None,
+        upload_checksum="",
+        key_shard_depth=None,
+        key_shard_width=None,
+        key_date_partition=None,
+        destinations="",
+        derivatives="",
+        transport="",
+        jpeg_optimize=None,
     ):
         """Store images to S3 or spool on failure."""
+        from ..infrastructure.image_encoder import get_image_encoder
+        from ..infrastructure.image_serializer import (
+            EncodeOptions,
+            iter_image_arrays,
+        )
+        from ..infrastructure.retry_worker import get_retry_worker
+        from ..infrastructure.upload_pipeline import UploadPipeline
+        from ..infrastructure.upload_queue import get_upload_queue
+
         overrides = {
             "endpoint": endpoint,
             "bucket": bucket,
@@ -140,27 +411,106 @@ class S3UploadNode:
             "retry_backoff_seconds": retry_backoff_seconds,
             "retry_interval_seconds": retry_interval_seconds,
             "retry_concurrency": retry_concurrency,
+            "upload_concurrency": upload_concurrency,
+            "async_upload": async_upload,
+            "upload_queue_size": upload_queue_size,
+            "encode_workers": encode_workers,
+            "encode_executor": encode_executor,
+            "png_compress_level": png_compress_level,
+            "png_optimize": png_optimize,
+            "png_strategy": png_strategy,
+            "image_format": image_format,
+            "image_quality": image_quality,
+            "image_lossless": image_lossless,
+            "multipart_threshold_mb": multipart_threshold_mb,
+            "multipart_chunk_mb": multipart_chunk_mb,
+            "multipart_concurrency": multipart_concurrency,
+            "retry_backoff_max_seconds": retry_backoff_max_seconds,
+            "breaker_failure_threshold": breaker_failure_threshold,
+            "breaker_reset_seconds": breaker_reset_seconds,
+            "spool_layout": spool_layout,
+            "spool_segment_mb": spool_segment_mb,
+            "dedup": dedup,
+            "dedup_verify": dedup_verify,
+            "content_addressed_keys": content_addressed_keys,
+            "dedup_cache_size": dedup_cache_size,
+            "spool_max_mb": spool_max_mb,
+            "spool_max_jobs": spool_max_jobs,
+            "spool_eviction": spool_eviction,
+            "spool_compression": spool_compression,
+            "spool_priority": spool_priority,
+            "upload_checksum": upload_checksum,
+            "key_shard_depth": key_shard_depth,
+            "key_shard_width": key_shard_width,
+            "key_date_partition": key_date_partition,
+            "destinations": destinations,
+            "derivatives": derivatives,
+            "transport": transport,
+            "jpeg_optimize": jpeg_optimize,
         }
         config = S3Config.from_sources(self._base_dir, overrides)
-        s3_client = S3ClientAdapter(config=config)
-        spool_repository = SpoolRepository(base_dir=config.spool_dir)
-        key_strategy = ObjectKeyStrategy(
-            prefix=config.prefix,
-            use_timestamp_prefix=config.use_timestamp_prefix,
-        )
-        orchestrator = UploadOrchestrator(
-            config=config,
-            s3_client=s3_client,
-            spool_repository=spool_repository,
-            key_strategy=key_strategy,
+        mirror_configs = config.mirror_configs()
+        orchestrator = _build_orchestrator(
+            config,
+            tuple(_build_orchestrator(mirror) for mirror in mirror_configs),
         )
-        worker = get_retry_worker(
-            config=config,
-            s3_client=s3_client,
-            spool_repository=spool_repository,
+        for target_config in (config, *mirror_configs):
+            get_retry_worker(target_config).start()
+        encoder = get_image_encoder(config)
+        options = EncodeOptions.from_config(config)
+        derivatives = EncodeOptions.derivatives_from_config(config)
+        if config.async_upload:
+            upload_queue = get_upload_queue(config)
+            for array in iter_image_arrays(images):
+                future = encoder.submit_with_derivatives(
+                    array, options, derivatives
+                )
+                upload_queue.submit_when_encoded(orchestrator, future)
+            return ()
+        pipeline = UploadPipeline(
+            orchestrator=orchestrator,
+            max_in_flight=config.upload_concurrency,
         )
-        worker.start()
-        image_bytes, extension = image_tensor_to_bytes(images)
-        orchestrator.upload_or_spool(image_bytes, extension)
+        encoded = encoder.encode_images(images, options, derivatives)
+        pipeline.run(_log_encode_time(encoded))
         return ()
+
+
+def _build_orchestrator(
+    config: S3Config, mirrors: tuple["UploadOrchestrator", ...] = ()
+) -> "UploadOrchestrator":
+    from ..infrastructure.s3_client import S3ClientAdapter
+    from ..infrastructure.spool_repository import SpoolRepository
+    from ..infrastructure.upload_orchestrator import UploadOrchestrator
+
+    return UploadOrchestrator(
+        config=config,
+        s3_client=S3ClientAdapter(config=config),
+        spool_repository=SpoolRepository.from_config(config),
+        key_strategy=ObjectKeyStrategy(
+            prefix=config.prefix,
+            use_timestamp_prefix=config.use_timestamp_prefix,
+            content_addressed=config.content_addressed_keys,
+            shard_depth=config.key_shard_depth,
+            shard_width=config.key_shard_width,
+            date_partition=config.key_date_partition,
+        ),
+        mirrors=mirrors,
+    )
 
+
+def _log_encode_time(
+    encoded: Iterable["EncodedImage"],
+) -> Iterator["EncodedImage"]:
+    count = 0
+    total_seconds = 0.0
+    for image in encoded:
+        count += 1
+        total_seconds += image.encode_seconds
+        yield image
+    logger.info(
+        "s3up encoded %d image(s), %.3fs total encode time",
+        count,
+        total_seconds,
+    )
+